@@ -0,0 +1,85 @@
+import os
+import shutil
+import random
+import tempfile
+import unittest
+
+from ott.loader.deploy.transfer import Transfer, TransferReport
+
+
+@unittest.skipUnless(shutil.which('zstd'), "needs zstd")
+class TestDeltaPatches(unittest.TestCase):
+    """ delta patches of one file, sent to two remote paths that were last deployed from different bases """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.base_dir = os.path.join(self.tmp_dir, "deployed")
+        os.makedirs(self.base_dir)
+        self.transfer = Transfer("ott", ["server1"], delta=True, base_dir=self.base_dir)
+
+        r = random.Random(1)
+        self.old = bytearray(r.getrandbits(8) for i in range(200000))
+        self.new = bytearray(self.old)
+        self.new[1000:1010] = b"0123456789"
+        self.local_path = self.write(os.path.join(self.tmp_dir, "Graph.obj"), self.new)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @classmethod
+    def write(cls, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def write_base(self, remote_path, data):
+        return self.write(self.transfer.get_base_path(self.local_path, remote_path), data)
+
+    def test_base_path(self):
+        self.assertEqual(self.transfer.get_base_path(self.local_path, "/otp/prod/Graph.obj"),
+                         os.path.join(self.base_dir, "otp_prod_Graph.obj.base"))
+        t = Transfer("ott", [], delta=True)
+        self.assertEqual(t.get_base_path(self.local_path, "prod/Graph.obj"),
+                         os.path.join(self.tmp_dir, ".deployed", "prod_Graph.obj.base"))
+
+    def test_patch_per_base(self):
+        """ each remote path gets a patch against its own base, made once for all the servers """
+        self.write_base("prod/Graph.obj", self.old)
+        other = bytearray(self.old)
+        other[50000:50010] = b"abcdefghij"
+        self.write_base("mod/Graph.obj", other)
+
+        prod = self.transfer.get_patch(self.local_path, "prod/Graph.obj")
+        mod = self.transfer.get_patch(self.local_path, "mod/Graph.obj")
+        self.assertTrue(prod and mod)
+        self.assertNotEqual(prod, mod)
+        self.assertTrue(os.path.getsize(prod) < len(self.new) * self.transfer.max_patch_ratio)
+        self.assertEqual(self.transfer.get_patch(self.local_path, "prod/Graph.obj"), prod)
+        self.assertEqual(len(self.transfer.patches), 2)
+
+        # a new base (e.g., after update_bases) gets a new patch
+        self.write_base("prod/Graph.obj", other)
+        self.transfer.sha_cache.clear()
+        self.assertNotEqual(self.transfer.get_patch(self.local_path, "prod/Graph.obj"), prod)
+        self.assertEqual(len(self.transfer.patches), 3)
+
+    def test_no_patch(self):
+        # no base
+        self.assertIsNone(self.transfer.get_patch(self.local_path, "prod/Graph.obj"))
+
+        # nothing in common with the base ... the patch is too big, and is thrown away
+        self.write_base("prod/Graph.obj", bytearray(random.Random(2).getrandbits(8) for i in range(200000)))
+        self.assertIsNone(self.transfer.get_patch(self.local_path, "prod/Graph.obj"))
+        self.assertFalse([f for f in os.listdir(self.tmp_dir) if f.endswith(Transfer.patch_ext)])
+
+    def test_update_bases(self):
+        """ the files that made it to a server become the bases, and the patches are cleaned up """
+        self.write_base("prod/Graph.obj", self.old)
+        patch = self.transfer.get_patch(self.local_path, "prod/Graph.obj")
+        report = TransferReport()
+        report.add("server1", self.local_path, "prod/Graph.obj", bytes=len(self.new), verified=True)
+        self.transfer.update_bases([(self.local_path, "prod/Graph.obj"), (self.local_path, "mod/Graph.obj")], report)
+
+        self.assertFalse(os.path.exists(patch))
+        self.assertEqual(self.transfer.patches, {})
+        with open(self.transfer.get_base_path(self.local_path, "prod/Graph.obj"), 'rb') as f:
+            self.assertEqual(f.read(), bytes(self.new))
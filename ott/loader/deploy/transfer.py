@@ -0,0 +1,343 @@
+from ott.utils import web_utils
+
+import os
+import time
+import shlex
+import shutil
+import hashlib
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+log = logging.getLogger(__file__)
+
+
+def file_sha256(file_path, chunk_size=1024*1024):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ServerSession(object):
+    """
+    one persistent ssh / sftp session to a server, re-used for every command and file sent to that server
+    note: remote paths are relative to the user's home dir (same as the scp paths in the [deploy] config)
+    """
+    def __init__(self, server, user, bwlimit=None):
+        """ :param bwlimit: max upload rate to this server, in bytes / sec (None for no limit) """
+        self.server = server
+        self.user = user
+        self.bwlimit = bwlimit
+        self.copies = {}
+        self.scp, self.ssh = web_utils.scp_client(host=server, user=user)
+        self.sftp = self.ssh.open_sftp()
+
+    def run(self, cmd):
+        """ :return: exit status and stdout of a remote command
+        """
+        stdin, stdout, stderr = self.ssh.exec_command(cmd)
+        out = stdout.read().decode('utf-8', 'replace')
+        return stdout.channel.recv_exit_status(), out
+
+    def mkdir(self, remote_dir):
+        return self.run("mkdir -p {}".format(shlex.quote(remote_dir)))
+
+    def put(self, local_path, remote_path, callback=None):
+        """ upload to <remote>.part, then rename, so a partial upload never sits at the remote path
+        """
+        part = remote_path + ".part"
+        self.sftp.put(local_path, part, callback=self.throttle(callback))
+        self.sftp.posix_rename(part, remote_path)
+
+    def throttle(self, callback=None):
+        """ :return: an sftp progress callback that sleeps whenever the upload gets ahead of bwlimit """
+        if not self.bwlimit:
+            return callback
+        start = time.time()
+
+        def cb(sent, total):
+            ahead = sent / float(self.bwlimit) - (time.time() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+            if callback:
+                callback(sent, total)
+        return cb
+
+    def copy(self, src_path, remote_path):
+        """ server side copy (via <remote>.part, like put) """
+        part = shlex.quote(remote_path + ".part")
+        return self.run("cp {} {} && mv {} {}".format(shlex.quote(src_path), part, part, shlex.quote(remote_path)))[0] == 0
+
+    def sha256(self, remote_path):
+        status, out = self.run("sha256sum {}".format(shlex.quote(remote_path)))
+        return out.split()[0] if status == 0 and out else None
+
+    def close(self):
+        for c in (self.sftp, self.scp, self.ssh):
+            try:
+                c.close()
+            except Exception:
+                pass
+
+
+class TransferReport(object):
+    """ per-server, per-file results of a Transfer: bytes, seconds, MB/s, checksum verified and any error
+    """
+    def __init__(self):
+        self.results = []
+        self.lock = threading.Lock()
+
+    def add(self, server, local_path, remote_path, bytes=0, secs=0.0, verified=None, error=None, sent=None):
+        """ :param sent: bytes that went over the wire (less than bytes when only a delta patch was sent) """
+        sent = bytes if sent is None else sent
+        r = {
+            'server': server, 'file': local_path, 'remote': remote_path, 'bytes': bytes, 'sent': sent, 'secs': round(secs, 2),
+            'mbps': round(sent / secs / 1048576.0, 2) if secs > 0 else 0.0, 'verified': verified, 'error': error
+        }
+        with self.lock:
+            self.results.append(r)
+        return r
+
+    def is_ok(self, r):
+        return r['error'] is None and r['verified'] is not False
+
+    def ok(self, server=None, local_path=None):
+        return [r for r in self.results if self.is_ok(r) and server in (None, r['server']) and local_path in (None, r['file'])]
+
+    def failed(self):
+        return [r for r in self.results if not self.is_ok(r)]
+
+    def servers_ok(self, local_path):
+        """ :return: list of servers that got a verified copy of the file """
+        return [r['server'] for r in self.ok(local_path=local_path)]
+
+    def files_ok(self):
+        """ :return: list of the files that got a verified copy onto at least one server """
+        return sorted(set(r['file'] for r in self.ok()))
+
+    def log_summary(self):
+        for r in self.results:
+            if self.is_ok(r):
+                log.info("{server}: {file} -> {remote} {bytes} bytes ({sent} sent) in {secs} secs ({mbps} MB/s)".format(**r))
+            else:
+                log.warning("{server}: {file} -> {remote} FAILED ({error})".format(**r))
+        log.info("transferred {} files ok, {} failed".format(len(self.ok()), len(self.failed())))
+
+
+class Transfer(object):
+    """
+    push files to a set of servers: one ssh / sftp session per server, with the servers loaded in parallel (up to
+    max_workers at once), and each upload checked with a remote sha256sum
+
+    delta mode: the last deployed copy of each file is kept on both ends (locally in base_dir, and beside the remote
+    file as <remote>.base).  when the remote .base checksum matches our local copy, only a zstd --patch-from patch is
+    sent, and the file is rebuilt & checksum verified on the server (as <remote>.part) before it's renamed into place.
+    anything off (no zstd, no base, base mismatch, big patch, failed rebuild) falls back to sending the whole file
+
+    dedupe mode: a file isn't sent to a server that already has an identical copy at the remote path, and a file that's
+    identical to one already sent to the server (e.g., the same osm .pbf in several graph dirs) is copied there on
+    the server, rather than sent again
+    """
+    base_ext = ".base"
+    patch_ext = ".patch.zst"
+
+    def __init__(self, user, servers, max_workers=4, verify=True, delta=False, base_dir=None, max_patch_ratio=0.5,
+                 dedupe=False, bwlimit_mbps=None):
+        """
+        :param delta: send zstd patches against the last deployed copy of a file (requires zstd on both ends)
+        :param base_dir: where to keep the local copies of the last deployed files (default: a .deployed/ dir beside each file)
+        :param max_patch_ratio: send the whole file when the patch is bigger than this fraction of the file
+        :param dedupe: don't send files a server already has (at the remote path, or elsewhere from this upload)
+        :param bwlimit_mbps: max upload rate per server, in MB / sec
+        """
+        self.user = user
+        self.servers = servers
+        self.max_workers = max(1, max_workers)
+        self.verify = verify or delta
+        self.delta = delta
+        self.base_dir = base_dir
+        self.max_patch_ratio = max_patch_ratio
+        self.dedupe = dedupe
+        self.bwlimit = int(bwlimit_mbps * 1048576) if bwlimit_mbps else None
+        self.sha_cache = {}
+        self.sha_lock = threading.Lock()
+        self.patches = {}
+        self.patch_lock = threading.Lock()
+
+    def get_sha256(self, local_path):
+        """ local checksums are computed once, no matter how many servers get the file """
+        with self.sha_lock:
+            if local_path not in self.sha_cache:
+                self.sha_cache[local_path] = file_sha256(local_path)
+            return self.sha_cache[local_path]
+
+    def upload(self, files, remote_dir=None):
+        """
+        :param files: list of local paths (sent to remote_dir) or (local path, remote path) tuples
+        :return: TransferReport
+        """
+        report = TransferReport()
+        pairs = []
+        for f in files:
+            if isinstance(f, (list, tuple)):
+                pairs.append((f[0], f[1]))
+            else:
+                pairs.append((f, os.path.join(remote_dir or '', os.path.basename(f))))
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, max(len(self.servers), 1))) as pool:
+            for s in self.servers:
+                pool.submit(self.upload_to_server, s, pairs, report)
+        if self.delta:
+            self.update_bases(pairs, report)
+        report.log_summary()
+        return report
+
+    def get_base_path(self, local_path, remote_path):
+        """ local copy of the last deployed file, named after the remote path (so Graph.obj-new of each graph gets its own) """
+        base_dir = self.base_dir or os.path.join(os.path.dirname(os.path.abspath(local_path)), ".deployed")
+        return os.path.join(base_dir, remote_path.strip('/').replace('/', '_') + self.base_ext)
+
+    def get_patch(self, local_path, remote_path):
+        """ :return: path to a zstd patch of the file against its local base, or None
+            a patch is made once per (file, remote path, base checksum), for all the servers ... so the same file sent
+            to two remote paths (with different bases) gets a patch against each base
+        """
+        base_path = self.get_base_path(local_path, remote_path)
+        if not os.path.exists(base_path) or not shutil.which('zstd'):
+            return None
+        base_sha = self.get_sha256(base_path)
+        key = (local_path, remote_path, base_sha)
+
+        with self.patch_lock:
+            if key in self.patches:
+                return self.patches[key]
+
+            ret_val = None
+            tag = hashlib.sha1("{}\0{}".format(remote_path, base_sha).encode('utf-8')).hexdigest()[:12]
+            patch_path = "{}.{}{}".format(local_path, tag, self.patch_ext)
+            try:
+                subprocess.check_call(['zstd', '-q', '-f', '--long=31', '--patch-from=' + base_path, local_path, '-o', patch_path])
+                ratio = os.path.getsize(patch_path) / float(max(os.path.getsize(local_path), 1))
+                if ratio <= self.max_patch_ratio:
+                    log.info("{} patch is {:.1%} of the file".format(patch_path, ratio))
+                    ret_val = patch_path
+                else:
+                    log.info("{} patch is {:.1%} of the file, so sending the whole file".format(patch_path, ratio))
+            except Exception as e:
+                log.warning("can't make a patch of {}: {}".format(local_path, e))
+            if ret_val is None and os.path.exists(patch_path):
+                os.remove(patch_path)
+            self.patches[key] = ret_val
+            return ret_val
+
+    def upload_delta(self, session, local_path, remote_path):
+        """ send a patch, and rebuild the file on the server
+            :return: bytes sent, or None if the whole file needs to be sent
+        """
+        patch_path = self.get_patch(local_path, remote_path)
+        if patch_path is None:
+            return None
+
+        # step 1: the server's base has to be the same file our patch was made against
+        remote_base = remote_path + self.base_ext
+        if session.sha256(remote_base) != self.get_sha256(self.get_base_path(local_path, remote_path)):
+            log.info("{}:{} doesn't match our base, so sending the whole file".format(session.server, remote_base))
+            return None
+
+        # step 2: send the patch, and rebuild the file beside the remote file
+        remote_patch = remote_path + self.patch_ext
+        remote_part = remote_path + ".part"
+        log.info("sftp patch {} over to {}@{}:{}".format(patch_path, self.user, session.server, remote_patch))
+        session.put(patch_path, remote_patch)
+        cmd = "zstd -d -q -f --long=31 --patch-from={} {} -o {}; s=$?; rm -f {}; exit $s".format(
+            shlex.quote(remote_base), shlex.quote(remote_patch), shlex.quote(remote_part), shlex.quote(remote_patch))
+        status, out = session.run(cmd)
+
+        # step 3: check the rebuilt file before moving it into place
+        if status != 0 or session.sha256(remote_part) != self.get_sha256(local_path):
+            log.warning("{}:{} didn't rebuild from the patch, so sending the whole file".format(session.server, remote_path))
+            session.run("rm -f {}".format(shlex.quote(remote_part)))
+            return None
+        session.sftp.posix_rename(remote_part, remote_path)
+        return os.path.getsize(patch_path)
+
+    def update_bases(self, pairs, report):
+        """ after a delta upload, the files that made it to a server become the local bases for the next upload
+            (a server that missed this upload will have a mismatched .base next time, and get the whole file)
+        """
+        for patch_path in self.patches.values():
+            if patch_path and os.path.exists(patch_path):
+                os.remove(patch_path)
+        for local_path, remote_path in pairs:
+            if report.servers_ok(local_path):
+                base_path = self.get_base_path(local_path, remote_path)
+                if not os.path.exists(os.path.dirname(base_path)):
+                    os.makedirs(os.path.dirname(base_path))
+                shutil.copyfile(local_path, base_path + ".tmp")
+                os.replace(base_path + ".tmp", base_path)
+                with self.sha_lock:
+                    self.sha_cache.pop(base_path, None)
+        self.patches = {}
+
+    def upload_to_server(self, server, pairs, report):
+        session = None
+        try:
+            session = ServerSession(server, self.user, self.bwlimit)
+            for d in set(os.path.dirname(r) for l, r in pairs if os.path.dirname(r)):
+                session.mkdir(d)
+            for local_path, remote_path in pairs:
+                self.upload_file(session, local_path, remote_path, report)
+        except Exception as e:
+            # couldn't connect (or lost the session), so fail whatever files didn't get a result
+            done = set(r['file'] for r in report.results if r['server'] == server)
+            for local_path, remote_path in pairs:
+                if local_path not in done:
+                    report.add(server, local_path, remote_path, error=str(e))
+        finally:
+            if session:
+                session.close()
+
+    def upload_dedupe(self, session, local_path, remote_path):
+        """ :return: True if the server already had the file (at the remote path), 0 bytes sent if it was copied from
+                     an identical file sent earlier in this session, or None if the file needs to be sent
+        """
+        sha = self.get_sha256(local_path)
+        if session.sha256(remote_path) == sha:
+            log.info("{}:{} is already up to date".format(session.server, remote_path))
+            return True
+        src_path = session.copies.get(sha)
+        if src_path and session.copy(src_path, remote_path):
+            log.info("{}:{} copied from identical {}".format(session.server, remote_path, src_path))
+            return 0
+        return None
+
+    def upload_file(self, session, local_path, remote_path, report):
+        start = time.time()
+        try:
+            sent = None
+            verified = None
+            if self.dedupe:
+                sent = self.upload_dedupe(session, local_path, remote_path)
+                if sent is True:
+                    sent, verified = 0, True
+            if sent is None and self.delta:
+                sent = self.upload_delta(session, local_path, remote_path)
+            if sent is None:
+                log.info("sftp {} over to {}@{}:{}".format(local_path, self.user, session.server, remote_path))
+                session.put(local_path, remote_path)
+            secs = time.time() - start
+            if self.verify and verified is None:
+                verified = session.sha256(remote_path) == self.get_sha256(local_path)
+            error = None if verified is not False else "checksum mismatch"
+            if self.dedupe and error is None:
+                session.copies.setdefault(self.get_sha256(local_path), remote_path)
+
+            # delta mode: the server keeps a copy of what we just deployed, as the base for the next patch
+            if self.delta and error is None:
+                session.run("cp {0} {1}.tmp && mv {1}.tmp {1}".format(shlex.quote(remote_path), shlex.quote(remote_path + self.base_ext)))
+            report.add(session.server, local_path, remote_path, os.path.getsize(local_path), secs, verified, error, sent)
+        except Exception as e:
+            report.add(session.server, local_path, remote_path, secs=time.time() - start, error=str(e))
@@ -0,0 +1,154 @@
+import datetime
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class ServiceCoverage(object):
+    """ vectorized service coverage check of a gtfs.zip (no db needed, so it can run before a feed is cached or loaded)
+
+        calendar.txt, calendar_dates.txt and trips.txt are read straight from the zip into numpy arrays, which are
+        turned into a [service x date] active bitmap for the whole feed window, and from there trips & services per date
+
+        a date is flagged when it has fewer than min_trips trips or min_services services, or when its trip count is
+        below min_ratio of the median trip count for that day of the week (e.g., no MAX trips on Labor Day 2016 ... see
+        the notes in gtfsdb/preflight.py)
+    """
+    def __init__(self, gtfs_path, min_trips=1, min_services=1, min_ratio=0.25):
+        self.gtfs_path = gtfs_path
+        self.min_trips = min_trips
+        self.min_services = min_services
+        self.min_ratio = min_ratio
+        self.days = None
+        self.trips = None
+        self.services = None
+        self.dow = None
+        self.anomalies = []
+
+    @classmethod
+    def to_dates(cls, values):
+        import numpy as np
+        return np.array(["{}-{}-{}".format(v[:4], v[4:6], v[6:8]) for v in values], dtype='datetime64[D]')
+
+    @classmethod
+    def read_columns(cls, zip_file, member, columns):
+        """ :return: dict of {column: list of values} for a .txt file in the zip (empty lists if it's not there)
+        """
+        from ott.loader.gtfs.zip_rewriter import ZipRewriter
+        ret_val = dict((c, []) for c in columns)
+        if member in zip_file.namelist():
+            header, rows = ZipRewriter.read_rows(zip_file, member)
+            header = [h.strip() for h in header]
+            indexes = [(c, header.index(c)) for c in columns if c in header]
+            for row in rows:
+                for c, i in indexes:
+                    ret_val[c].append(row[i].strip())
+        return ret_val
+
+    def compute(self):
+        """ build the per-date active service bitmap, and the trip & service counts per date
+        """
+        import zipfile
+        import numpy as np
+
+        # step 1: the raw tables, as column lists
+        week = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+        with zipfile.ZipFile(self.gtfs_path) as z:
+            cal = self.read_columns(z, 'calendar.txt', ['service_id', 'start_date', 'end_date'] + week)
+            cd = self.read_columns(z, 'calendar_dates.txt', ['service_id', 'date', 'exception_type'])
+            trips = self.read_columns(z, 'trips.txt', ['service_id'])
+
+        # step 2: index the service ids, and count trips per service
+        cal_start = self.to_dates(cal['start_date'])
+        cal_end = self.to_dates(cal['end_date'])
+        cd_dates = self.to_dates(cd['date'])
+        service_ids, inverse = np.unique(np.array(cal['service_id'] + cd['service_id'] + trips['service_id'], dtype=str), return_inverse=True)
+        cal_svc = inverse[:len(cal['service_id'])]
+        cd_svc = inverse[len(cal['service_id']):len(cal['service_id']) + len(cd['service_id'])]
+        trip_svc = inverse[len(cal['service_id']) + len(cd['service_id']):]
+        trips_per_service = np.bincount(trip_svc, minlength=len(service_ids))
+
+        # step 3: the feed window
+        all_dates = np.concatenate([cal_start, cal_end, cd_dates])
+        if len(all_dates) == 0:
+            self.days = np.array([], dtype='datetime64[D]')
+            self.trips = self.services = self.dow = np.array([], dtype=int)
+            return
+        self.days = np.arange(all_dates.min(), all_dates.max() + 1)
+        dow = (self.days.astype('int64') + 3) % 7  # 1970-01-01 was a thursday ... monday is 0
+
+        # step 4: calendar.txt ... in the date range, and running on that day of the week
+        active = np.zeros((len(service_ids), len(self.days)), dtype=bool)
+        if len(cal_svc) > 0:
+            flags = np.array([cal[d] or ['0'] * len(cal_svc) for d in week], dtype=str).T == '1'
+            in_range = (self.days[None, :] >= cal_start[:, None]) & (self.days[None, :] <= cal_end[:, None])
+            np.logical_or.at(active, cal_svc, in_range & flags[:, dow])
+
+        # step 5: calendar_dates.txt exceptions ... 1 adds service for the date, 2 removes it
+        if len(cd_svc) > 0:
+            day_i = (cd_dates - self.days[0]).astype('int64')
+            exception = np.array(cd['exception_type'], dtype=str)
+            active[cd_svc[exception == '1'], day_i[exception == '1']] = True
+            active[cd_svc[exception == '2'], day_i[exception == '2']] = False
+
+        # step 6: trips & services (with trips) per date
+        self.trips = trips_per_service @ active
+        self.services = (active & (trips_per_service > 0)[:, None]).sum(axis=0)
+        self.dow = dow
+
+    def check(self, from_date=None):
+        """
+        :param from_date: only flag dates on or after this date ('YYYYMMDD' or date ... default is today)
+        :return: True if no dates were flagged (see self.anomalies for the flagged dates)
+        """
+        import numpy as np
+        if self.days is None:
+            self.compute()
+
+        if from_date is None:
+            from_date = datetime.date.today()
+        if isinstance(from_date, str):
+            from_date = self.to_dates([from_date])[0]
+        from_date = np.datetime64(from_date, 'D')
+
+        # typical trips per day of the week, over the whole feed window
+        median = np.zeros(7)
+        for d in range(7):
+            if np.any(self.dow == d):
+                median[d] = np.median(self.trips[self.dow == d])
+
+        self.anomalies = []
+        low_trips = self.trips < self.min_trips
+        low_services = self.services < self.min_services
+        low_ratio = self.trips < self.min_ratio * median[self.dow]
+        for i in np.nonzero((low_trips | low_services | low_ratio) & (self.days >= from_date))[0]:
+            reasons = []
+            if low_trips[i]:
+                reasons.append("fewer than {} trips".format(self.min_trips))
+            if low_services[i]:
+                reasons.append("fewer than {} services".format(self.min_services))
+            if low_ratio[i] and not low_trips[i]:
+                reasons.append("under {:.0%} of the usual {:.0f} trips".format(self.min_ratio, median[self.dow[i]]))
+            self.anomalies.append({
+                'date': str(self.days[i]), 'trips': int(self.trips[i]), 'services': int(self.services[i]), 'reason': ", ".join(reasons)
+            })
+
+        for a in self.anomalies:
+            log.warning("SERVICE COVERAGE: {} on {date}: {trips} trips, {services} services ({reason})".format(self.gtfs_path, **a))
+        return len(self.anomalies) == 0
+
+    @classmethod
+    def is_feed_ok(cls, gtfs_path, mode='warn', min_ratio=0.25):
+        """
+        run the coverage check per the [gtfs] coverage_check setting: 'off', 'warn' (log the flagged dates) or 'block'
+        :return: False only in 'block' mode, when the feed has flagged dates
+        """
+        ret_val = True
+        if mode and mode != 'off':
+            try:
+                c = ServiceCoverage(gtfs_path, min_ratio=min_ratio)
+                if not c.check() and mode == 'block':
+                    ret_val = False
+            except Exception as e:
+                log.warning("can't check the service coverage of {}: {}".format(gtfs_path, e))
+        return ret_val
@@ -1,37 +1,199 @@
-import logging
+import os
+import json
+import zipfile
+import hashlib
 
-from ott.utils import file_utils
 from ott.utils.cache_base import CacheBase
 from ott.loader.gtfs.gtfs_info import GtfsInfo
 
+import logging
+log = logging.getLogger(__file__)
+
+
+class ChangeSet(object):
+    """ structured report of what changed between two gtfs zips: which tables (.txt files) were added, removed or
+        modified, plus the row count delta of each of those tables
+
+        used by the loaders to skip work a change doesn't affect (e.g., a feed_info.txt version bump doesn't need a
+        new OTP graph built)
+    """
+    metadata_tables = ('feed_info.txt',)
+
+    def __init__(self, tables=None, row_deltas=None, is_new=False):
+        """ :param is_new: no previous feed to compare against (or a forced update), so treat everything as changed
+        """
+        self.tables = tables or []
+        self.row_deltas = row_deltas or {}
+        self.is_new = is_new
+
+    def is_empty(self):
+        return not self.is_new and len(self.tables) == 0
+
+    def affects_db(self):
+        """ gtfsdb loads every .txt table (including feed_info.txt), so any table change means a db reload
+        """
+        return self.is_new or any(t.endswith('.txt') for t in self.tables)
+
+    def affects_graph(self):
+        """ OTP graphs don't need rebuilding when only metadata tables (feed_info.txt) changed
+        """
+        return self.is_new or any(t.endswith('.txt') and t not in self.metadata_tables for t in self.tables)
+
+    def to_dict(self):
+        return {'tables': self.tables, 'row_deltas': self.row_deltas, 'is_new': self.is_new}
+
+    @classmethod
+    def from_dict(cls, d):
+        return ChangeSet(d.get('tables'), d.get('row_deltas'), d.get('is_new', False))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        """ :return: ChangeSet saved at path, or None if there isn't one
+        """
+        ret_val = None
+        if os.path.exists(path):
+            with open(path) as f:
+                ret_val = cls.from_dict(json.load(f))
+        return ret_val
+
+    def __str__(self):
+        if self.is_new:
+            return "new feed"
+        return ", ".join("{} ({:+d} rows)".format(t, self.row_deltas.get(t, 0)) for t in self.tables) or "no changes"
+
 
 class Diff(CacheBase):
-    """ Diff Two Gtfs Zip Files, looking at feed_info.txt & calendar_date.txt file to see differences between them
+    """ Diff Two Gtfs Zip Files, by comparing a manifest of each zip: the name, CRC32 and size of every member, as read
+        from the zip's central directory (optionally with a streamed SHA-256 of each member, too)
+
+        nothing is extracted, so the compare is O(number of members) ... and any table that changed (stop_times.txt,
+        shapes.txt, etc...) shows up, not just feed_info.txt and the calendars
+
+        with save_manifest, the manifest of the old (cached) zip is saved beside it as <zip>.manifest.json, and re-used
+        until the zip changes (GtfsCache turns this on for its cache compares)
     """
     old_info = None
     new_info = None
     old_gtfs_zip = None
     new_gtfs_zip = None
+    use_sha = False
+    changed_tables = None
+    manifest_ext = ".manifest.json"
 
-    def __init__(self, old_gtfs_zip, new_gtfs_zip):
+    def __init__(self, old_gtfs_zip, new_gtfs_zip, use_sha=False, save_manifest=False):
         # step 1: set up some dirs
         self.old_gtfs_zip = old_gtfs_zip
         self.new_gtfs_zip = new_gtfs_zip
+        self.use_sha = use_sha
+        self.save_manifest = save_manifest
 
         # step 2: make our  stuff
         self.old_info = GtfsInfo(self.old_gtfs_zip, "old_")
         self.new_info = GtfsInfo(self.new_gtfs_zip, "new_")
 
+    @classmethod
+    def make_manifest(cls, gtfs_zip, use_sha=False, chunk_size=1024*1024):
+        """ :return: dict of {member name: {'crc': crc32, 'size': uncompressed size (, 'sha256': hex digest)}}
+        """
+        ret_val = {}
+        with zipfile.ZipFile(gtfs_zip) as z:
+            for i in z.infolist():
+                if i.is_dir():
+                    continue
+                m = {'crc': i.CRC, 'size': i.file_size}
+                if use_sha:
+                    sha = hashlib.sha256()
+                    with z.open(i) as f:
+                        for chunk in iter(lambda: f.read(chunk_size), b''):
+                            sha.update(chunk)
+                    m['sha256'] = sha.hexdigest()
+                ret_val[i.filename] = m
+        return ret_val
+
+    @classmethod
+    def get_manifest(cls, gtfs_zip, use_sha=False, save=False):
+        """ :return: the manifest of a gtfs zip, re-using the <zip>.manifest.json sidecar when it's still current
+        """
+        st = os.stat(gtfs_zip)
+        manifest_path = gtfs_zip + cls.manifest_ext
+
+        # step 1: the sidecar is good as long as the zip hasn't changed (and it has sha's, if we're asking for them)
+        try:
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    m = json.load(f)
+                if m.get('mtime') == st.st_mtime and m.get('size') == st.st_size and (m.get('sha256') or not use_sha):
+                    return m.get('members')
+        except Exception as e:
+            log.warning("can't read manifest {}: {}".format(manifest_path, e))
+
+        # step 2: read the zip's central directory (and maybe stream the members for their sha's)
+        members = cls.make_manifest(gtfs_zip, use_sha)
+
+        # step 3: save the manifest beside the zip
+        if save:
+            try:
+                with open(manifest_path, 'w') as f:
+                    json.dump({'mtime': st.st_mtime, 'size': st.st_size, 'sha256': use_sha, 'members': members}, f)
+            except Exception as e:
+                log.warning("can't write manifest {}: {}".format(manifest_path, e))
+        return members
+
+    @classmethod
+    def cmp_manifests(cls, old_manifest, new_manifest):
+        """ :return: sorted list of member names that were added, removed or changed between the two manifests
+        """
+        ret_val = []
+        for name in set(old_manifest) | set(new_manifest):
+            if old_manifest.get(name) != new_manifest.get(name):
+                ret_val.append(name)
+        return sorted(ret_val)
+
+    def get_changed_tables(self):
+        """ compare the two zips' manifests
+            :return: sorted list of gtfs .txt files that differ between the two zips
+        """
+        if self.changed_tables is None:
+            old_manifest = self.get_manifest(self.old_gtfs_zip, self.use_sha, self.save_manifest)
+            new_manifest = self.get_manifest(self.new_gtfs_zip, self.use_sha)
+            self.changed_tables = self.cmp_manifests(old_manifest, new_manifest)
+            if self.changed_tables:
+                log.info("{} has changes in {}".format(self.new_gtfs_zip, ", ".join(self.changed_tables)))
+        return self.changed_tables
+
+    @classmethod
+    def count_rows(cls, gtfs_zip, file_name, chunk_size=1024*1024):
+        """ :return: number of (data) rows in a .txt file in the zip, streamed without extracting it to disk
+            note: counts lines, so quoted values with embedded newlines will over count
+        """
+        ret_val = 0
+        with zipfile.ZipFile(gtfs_zip) as z:
+            if file_name not in z.namelist():
+                return 0
+            last = b'\n'
+            with z.open(file_name) as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    ret_val += chunk.count(b'\n')
+                    last = chunk[-1:]
+            if last != b'\n':
+                ret_val += 1
+        return max(ret_val - 1, 0)
+
+    def get_change_set(self):
+        """ :return: ChangeSet with the changed tables, and the row count delta of each of those tables
+        """
+        row_deltas = {}
+        tables = self.get_changed_tables()
+        for t in tables:
+            if t.endswith('.txt'):
+                row_deltas[t] = self.count_rows(self.new_gtfs_zip, t) - self.count_rows(self.old_gtfs_zip, t)
+        return ChangeSet(tables, row_deltas)
+
     def is_different(self):
-        """ compare feed_info.txt and calendar_dates.txt between two zips
-        """
-        feed_info_diff = file_utils.diff_files(self.old_info.unzip_feed_info_txt(), self.new_info.unzip_feed_info_txt())
-        if feed_info_diff:
-            logging.info("{} feed_info.txt files ARE VERY different".format(self.new_gtfs_zip))
-        calendar_dates_diff = file_utils.diff_files(self.old_info.unzip_calendar_dates_txt(), self.new_info.unzip_calendar_dates_txt())
-        if calendar_dates_diff:
-            logging.info("{} calender_dates.txt files ARE VERY different".format(self.new_gtfs_zip))
-        calendar_diff = file_utils.diff_files(self.old_info.unzip_calendar_txt(), self.new_info.unzip_calendar_txt())
-        if calendar_diff:
-            logging.info("{} calender.txt files ARE VERY different".format(self.new_gtfs_zip))
-        return feed_info_diff or calendar_diff or calendar_dates_diff
+        """ compare the manifests of the two zips
+        """
+        return len(self.get_changed_tables()) > 0
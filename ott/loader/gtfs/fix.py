@@ -1,8 +1,8 @@
 import os
-import csv
 
 from ott.utils import file_utils
 from ott.utils.cache_base import CacheBase
+from ott.loader.gtfs.fix_plan import FixPlan
 
 import logging
 log = logging.getLogger(__file__)
@@ -47,10 +47,9 @@ class Fix(CacheBase):
         BECOMES:
           9683134,18:03:00,18:03:00,8169,1,Portland,0,0,0.0,1,,
 
-        grep a stop from stop_times.txt (w/in a gtfs.zip feed file)
-        writes a stop_times.txt.tmp file with
-        got dict read/write ideas from:
-          https://stackoverflow.com/questions/2982023/how-to-write-header-row-with-csv-dictwriter/2982117
+        streams stop_times.txt out of the gtfs.zip (rows as lists, using column indexes), and writes the fixed rows
+        straight into a new stop_times.txt member ... the other members of the zip are copied over as is
+        (@see FixPlan and ZipRewriter)
         """
 
         # step 0: warn if things don't look right
@@ -62,58 +61,35 @@ class Fix(CacheBase):
             log.error("gtfs file {} does not exist".format(self.gtfs_path))
             return
 
-        # step 1: extract file from gtfs -- open temp file to write stuff
-        in_file = file_utils.unzip_file(self.gtfs_path, file_name)
-        out_file = in_file + ".tmp"
-
-        # step 2: open this input csv
-        with open(in_file, 'r') as csv_in:
-            dr = csv.DictReader(csv_in)
-            prev_row = None
-            perm_count = 0
-            cull_count = 0
-
-            # step 3: open .csv output
-            with open(out_file, 'w+') as csv_out:
-                dw = csv.DictWriter(csv_out, fieldnames=dr.fieldnames)
-                dw.writerow(dict(zip(dr.fieldnames, dr.fieldnames)))
-                for row in dr:
-                    # step 4: find target stop and process...
-                    if row.get('stop_id') == stop:
-                        # step 4a: set perms to board & alight
-                        if perms:
-                            row['pickup_type'] = "0"
-                            row['drop_off_type'] = "0"
-                            perm_count += 1
-
-                        # step 4n: NOTE: any other stop_time work must preceed step 4z due to the 'continue' below
-
-                        # step 4z: cull the preceding stop_time to our target stop, and move a few vars over
-                        if cull and prev_row and row.get('trip_id') == prev_row.get('trip_id'):
-                            row['stop_sequence'] = prev_row['stop_sequence']
-                            row['shape_dist_traveled'] = prev_row['shape_dist_traveled']
-                            dw.writerow(row)
-                            prev_row = None
-                            cull_count += 1
-                            continue
-
-                    # step 5: write out normal (prev) row and move on to next row
-                    if prev_row:
-                        dw.writerow(prev_row)
-                    prev_row = row
-
-                # step 6: outside the read/write loop, write last row
-                if prev_row:
-                    dw.writerow(prev_row)
-
-            log.warning("culls {}\nperms changes {}".format(cull_count, perm_count))
+        # step 1: the perms change happens on the target stop_time before the preceding stop_time is culled
+        rules = []
+        if perms:
+            rules.append({'table': file_name, 'type': 'perms', 'stop': stop})
+        if cull:
+            rules.append({'table': file_name, 'type': 'cull', 'stop': stop})
+        plan = FixPlan(rules)
 
+        # step 2: stream the fixed stop_times.txt either back into the zip, or out to a .tmp file
         if repack:
             log.warning("repacking {} into {}".format(file_name, self.gtfs_path))
-            file_utils.replace_file_in_zipfile(self.gtfs_path, out_file, file_name)
+            stats = plan.apply(self.gtfs_path)
         else:
+            out_file = os.path.join(self.cache_dir, file_name + ".tmp")
+            stats = plan.export(self.gtfs_path, file_name, out_file)
             log.warning("changes saved to file {}".format(out_file))
 
+        hits = dict((s['name'].split(':')[0], s['hits']) for s in stats)
+        log.warning("culls {}\nperms changes {}".format(hits.get('cull', 0), hits.get('perms', 0)))
+
+    def apply_rules(self, rules_path):
+        """
+        apply a rule file (@see FixPlan) to the gtfs.zip, in a single read/write pass over the archive
+        :return: list of per-rule stats (name, table, hits and secs)
+        """
+        if file_utils.exists(self.gtfs_path) is False:
+            log.error("gtfs file {} does not exist".format(self.gtfs_path))
+            return []
+        return FixPlan.from_file(rules_path).apply(self.gtfs_path)
 
     @classmethod
     def get_args(cls):
@@ -134,6 +110,7 @@ class Fix(CacheBase):
         parser.add_argument('--stop',    '-s', default=False, help="change gtfs.zip/stop_times.txt to eliminate previous stop from trip (e.g., BTC deadhead / boarding 8169)")
         parser.add_argument('--perms',   '-p', default=False, action='store_true', help="change stop board/alight permissions")
         parser.add_argument('--cull',    '-c', default=False, action='store_true', help="cull previous stop_time (deadhead)")
+        parser.add_argument('--rules',  '-rf', help="rule file (.json or .yml) of renames, culls, perms and filters to apply in one pass")
 
         args = parser.parse_args()
         return args
@@ -158,6 +135,8 @@ def main():
         fix.rename_agency_in_agency_txt(args.regex, args.replace)
     if args.stop:
         fix.remove_deadhead_stop_times(args.stop, args.cull, args.perms)
+    if args.rules:
+        fix.apply_rules(args.rules)
 
 
 if __name__ == '__main__':
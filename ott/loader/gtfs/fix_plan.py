@@ -0,0 +1,218 @@
+import re
+import json
+import time
+
+from ott.loader.gtfs.zip_rewriter import ZipRewriter
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class FixRule(object):
+    """
+    base class for a single gtfs fix rule, which is applied to the rows of one table (.txt file) in the gtfs.zip
+    rules are built from a rule file entry: {"table": "routes.txt", "type": "rename", ...}
+    """
+    type = None
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.table = rule.get('table')
+        self.name = rule.get('name', "{}:{}".format(self.type, self.table))
+        self.hits = 0
+        self.secs = 0.0
+
+    def apply(self, header, rows):
+        """ generator of fixed rows ... override me """
+        for row in rows:
+            yield row
+
+    def index(self, header, column):
+        if column not in header:
+            raise ValueError("rule '{}': {} has no column '{}'".format(self.name, self.table, column))
+        return header.index(column)
+
+
+class RenameRule(FixRule):
+    """ regex rename of values: {"type": "rename", "regex": "(PSC|TRAM)", "replace": "TRIMET", "columns": ["agency_id"]}
+        note: without "columns", every value in the row is renamed
+    """
+    type = 'rename'
+
+    def apply(self, header, rows):
+        regex = re.compile(self.rule['regex'])
+        replace = self.rule.get('replace', '')
+        columns = self.rule.get('columns')
+        indexes = [self.index(header, c) for c in columns] if columns else range(len(header))
+        for row in rows:
+            for i in indexes:
+                v, n = regex.subn(replace, row[i])
+                if n > 0:
+                    row[i] = v
+                    self.hits += 1
+            yield row
+
+
+class PermsRule(FixRule):
+    """ set the board & alight permissions of a stop: {"type": "perms", "stop": "8169", "pickup_type": "0", "drop_off_type": "0"}
+    """
+    type = 'perms'
+
+    def apply(self, header, rows):
+        stop = self.rule['stop']
+        stop_i = self.index(header, 'stop_id')
+        pickup_i = self.index(header, 'pickup_type')
+        drop_off_i = self.index(header, 'drop_off_type')
+        pickup = self.rule.get('pickup_type', "0")
+        drop_off = self.rule.get('drop_off_type', "0")
+        for row in rows:
+            if row[stop_i] == stop:
+                row[pickup_i] = pickup
+                row[drop_off_i] = drop_off
+                self.hits += 1
+            yield row
+
+
+class CullRule(FixRule):
+    """
+    remove the stop_time preceding a target stop in the same trip (e.g., BTC deadhead / boarding 8169), moving the culled
+    stop_time's stop_sequence and shape_dist_traveled over to the target stop: {"type": "cull", "stop": "8169"}
+    """
+    type = 'cull'
+
+    def apply(self, header, rows):
+        stop = self.rule['stop']
+        trip_i = self.index(header, 'trip_id')
+        stop_i = self.index(header, 'stop_id')
+        seq_i = self.index(header, 'stop_sequence')
+        dist_i = header.index('shape_dist_traveled') if 'shape_dist_traveled' in header else None
+
+        prev_row = None
+        for row in rows:
+            # cull the preceding stop_time to our target stop, and move a few vars over
+            if row[stop_i] == stop and prev_row and row[trip_i] == prev_row[trip_i]:
+                row[seq_i] = prev_row[seq_i]
+                if dist_i is not None:
+                    row[dist_i] = prev_row[dist_i]
+                yield row
+                prev_row = None
+                self.hits += 1
+                continue
+
+            # write out normal (prev) row and move on to next row
+            if prev_row:
+                yield prev_row
+            prev_row = row
+
+        # outside the read/write loop, write last row
+        if prev_row:
+            yield prev_row
+
+
+class FilterRule(FixRule):
+    """ drop rows: {"type": "filter", "column": "route_id", "regex": "^9\\d\\d$", "keep": false}
+        note: with "keep": true, only the matching rows are kept
+    """
+    type = 'filter'
+
+    def apply(self, header, rows):
+        regex = re.compile(self.rule['regex'])
+        col_i = self.index(header, self.rule['column'])
+        keep = self.rule.get('keep', False)
+        for row in rows:
+            if bool(regex.search(row[col_i])) == keep:
+                yield row
+            else:
+                self.hits += 1
+
+
+class FixPlan(object):
+    """
+    compiles a rule file (.json, or .yml if PyYAML is installed) into a plan of rules per gtfs table, then applies every
+    rule in a single streaming read/write pass over the gtfs.zip (@see ZipRewriter)
+
+    rule file is a list of rules, applied in order per table:
+      [
+        {"table": "routes.txt", "type": "rename", "regex": "(PSC|TRAM)", "replace": "TRIMET", "columns": ["agency_id"]},
+        {"table": "stop_times.txt", "type": "perms", "stop": "8169"},
+        {"table": "stop_times.txt", "type": "cull", "stop": "8169"}
+      ]
+    """
+    rule_types = dict((r.type, r) for r in (RenameRule, PermsRule, CullRule, FilterRule))
+
+    def __init__(self, rules):
+        self.rules = []
+        self.tables = {}
+        for r in rules:
+            rule_cls = self.rule_types.get(r.get('type'))
+            if rule_cls is None or not r.get('table'):
+                raise ValueError("bad gtfs fix rule (needs a 'table' and a 'type' of {}): {}".format(sorted(self.rule_types), r))
+            rule = rule_cls(r)
+            self.rules.append(rule)
+            self.tables.setdefault(rule.table, []).append(rule)
+
+    @classmethod
+    def from_file(cls, rules_path):
+        with open(rules_path) as f:
+            if rules_path.endswith(('.yml', '.yaml')):
+                import yaml
+                rules = yaml.safe_load(f)
+            else:
+                rules = json.load(f)
+        return FixPlan(rules)
+
+    def _table_transform(self, rules):
+        """ chain the table's rules into a single transform, timing each rule as rows flow thru it """
+        def timed(gen, timer):
+            while True:
+                start = time.time()
+                try:
+                    row = next(gen)
+                except StopIteration:
+                    timer[0] += time.time() - start
+                    return
+                timer[0] += time.time() - start
+                yield row
+
+        def transform(header, rows):
+            timers = []
+            for r in rules:
+                timer = [0.0]
+                timers.append((r, timer))
+                rows = timed(r.apply(header, rows), timer)
+            for row in rows:
+                yield row
+
+            # each timer includes the time of the rules upstream of it, so back that out
+            upstream = 0.0
+            for r, timer in timers:
+                r.secs += max(timer[0] - upstream, 0.0)
+                upstream = timer[0]
+        return transform
+
+    def apply(self, gtfs_path, out_path=None):
+        """
+        apply the plan to a gtfs.zip in one pass
+        :return: list of per-rule stats (name, table, hits and secs)
+        """
+        start = time.time()
+        transforms = dict((t, self._table_transform(rules)) for t, rules in self.tables.items())
+        ZipRewriter(gtfs_path).rewrite(transforms, out_path)
+        return self.stats(gtfs_path, start)
+
+    def export(self, gtfs_path, table, out_file):
+        """
+        apply the plan's rules for one table, streaming the fixed rows out to a .csv file (the gtfs.zip is left alone)
+        :return: list of per-rule stats (name, table, hits and secs)
+        """
+        start = time.time()
+        ZipRewriter(gtfs_path).export(table, self._table_transform(self.tables.get(table, [])), out_file)
+        return self.stats(gtfs_path, start)
+
+    def stats(self, gtfs_path, start):
+        ret_val = []
+        for r in self.rules:
+            ret_val.append({'name': r.name, 'table': r.table, 'hits': r.hits, 'secs': round(r.secs, 3)})
+            log.info("gtfs fix rule {}: {} hits in {:.3f} secs".format(r.name, r.hits, r.secs))
+        log.info("applied {} gtfs fix rules to {} in {:.2f} secs".format(len(self.rules), gtfs_path, time.time() - start))
+        return ret_val
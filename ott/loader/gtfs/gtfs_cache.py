@@ -1,13 +1,19 @@
 import os
+import time
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
 
 from ott.utils import gtfs_utils
 from ott.utils import file_utils
 from ott.utils import object_utils
-from ott.utils import web_utils
 from ott.utils.cache_base import CacheBase
 
 from ott.loader.gtfs.gtfs_info import GtfsInfo
-from ott.loader.gtfs.diff import Diff
+from ott.loader.gtfs.diff import Diff, ChangeSet
+from ott.loader.gtfs.fix_plan import FixPlan
+from ott.loader.gtfs.coverage import ServiceCoverage
 
 import logging
 logging.basicConfig()
@@ -19,27 +25,186 @@ class GtfsCache(CacheBase):
     Does a 'smart' cache of a gtfs file
          1. it will look to see if a gtfs.zip file is in the cache, and download it and put it in the cache if not
          2. once cached, it will check to see that the file in the cache is the most up to date data...
+         3. the http headers (ETag, Last-Modified, Content-Length) of each cached feed are kept in a <feed>.http.json
+            sidecar, so the next check can send a conditional request and skip everything on a 304 Not Modified
+         4. a feed configured with a "fix" rule file (@see FixPlan) gets those fixes applied right after it's downloaded,
+            so the cache (and the diffs against it) always hold the fixed feed
     """
     feeds = []
+    feed_stats = {}
+    change_sets = {}
+    download_workers = 4
+    download_timeout = 600
+    download_retries = 2
+    diff_sha256 = False
+    num_not_modified = 0
+    bytes_saved = 0
+    http_meta_ext = ".http.json"
+    changes_ext = ".changes.json"
 
     def __init__(self):
         super(GtfsCache, self).__init__(section='gtfs')
         self.feeds = gtfs_utils.get_feeds_from_config(self.config)
+        self.feed_stats = {}
+        self.change_sets = {}
+        self.download_workers = int(self.config.get('download_workers', def_val=self.download_workers))
+        self.download_timeout = int(self.config.get('download_timeout', def_val=self.download_timeout))
+        self.download_retries = int(self.config.get('download_retries', def_val=self.download_retries))
+        self.diff_sha256 = self.config.get_bool('diff_sha256', def_val=self.diff_sha256)
 
     def check_cached_feeds(self, force_update=False):
         """
         will check all feeds from an .ini file
-        :return: array of feed names that were updated
+        the feeds are downloaded concurrently (see download_workers in [gtfs]), and each feed is diff'd and
+        validated against the cache as soon as its download finishes
+        :return: array of feed names that were updated (per-feed timing stats end up in self.feed_stats)
         """
         updated_gtfs_names = []
-        for f in self.feeds:
-            url, name = GtfsCache.get_url_filename(f)
-            update = self.check_feed(url, name, force_update)
-            if update:
-                updated_gtfs_names.append(name)
+        self.feed_stats = {}
+        self.num_not_modified = 0
+        self.bytes_saved = 0
+
+        # step 1: start downloading all the feeds at once (bounded by the number of download workers)
+        num_workers = max(1, min(self.download_workers, len(self.feeds)))
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            downloads = {}
+            for f in self.feeds:
+                url, name = GtfsCache.get_url_filename(f)
+                downloads[pool.submit(self.download_feed, url, name, force_update, f.get('fix'))] = (url, name)
+
+            # step 2: check each feed against the cache in the order the downloads finish
+            for d in as_completed(downloads):
+                url, name = downloads[d]
+                stats = d.result()
+                if stats.get('not_modified'):
+                    self.num_not_modified += 1
+                    self.bytes_saved += stats.get('bytes_saved', 0)
+                start = time.time()
+                update = self.check_feed(url, name, force_update, stats=stats)
+                stats['check_secs'] = round(time.time() - start, 2)
+                stats['updated'] = update
+                self.feed_stats[name] = stats
+                if update:
+                    updated_gtfs_names.append(name)
+
+        for name, s in self.feed_stats.items():
+            log.info("{}: download {}s ({} attempts, not modified={}), check {}s, updated={}".format(
+                name, s['download_secs'], s['attempts'], s['not_modified'], s['check_secs'], s['updated']))
+        if self.num_not_modified > 0:
+            log.info("{} feed(s) not modified, saving {} bytes of downloads".format(self.num_not_modified, self.bytes_saved))
         return updated_gtfs_names
 
-    def check_feed(self, url, file_name, force_update=False):
+    def get_http_meta_path(self, file_name, dir_path=None):
+        return os.path.join(dir_path or self.cache_dir, file_name + self.http_meta_ext)
+
+    def read_http_meta(self, file_name):
+        """
+        :return: the http headers saved alongside a cached feed (empty dict if the feed or sidecar isn't cached)
+        """
+        ret_val = {}
+        meta_path = self.get_http_meta_path(file_name)
+        if os.path.exists(meta_path) and os.path.exists(os.path.join(self.cache_dir, file_name)):
+            try:
+                with open(meta_path) as f:
+                    ret_val = json.load(f)
+            except Exception as e:
+                log.warning("can't read {}: {}".format(meta_path, e))
+        return ret_val
+
+    def download_feed(self, url, file_name, force_update=False, fix_rules=None):
+        """
+        download a feed into the tmp dir, retrying (see download_retries in [gtfs]) on errors and timeouts
+        the request is conditional (If-None-Match / If-Modified-Since) when we have http headers for the cached feed
+        note: a tmp file younger than 2 hours is re-used rather than downloaded again
+        :param fix_rules: optional rule file of gtfs fixes to apply to a freshly downloaded feed
+        :return: dict of timing stats for this feed's download (callers total up not_modified & bytes_saved, since
+                 this runs in the download worker threads)
+        """
+        tmp_path = os.path.join(self.tmp_dir, file_name)
+        stats = {'name': file_name, 'downloaded': False, 'not_modified': False, 'attempts': 0, 'download_secs': 0.0}
+
+        start = time.time()
+        if os.path.exists(tmp_path) is False or file_utils.file_age_seconds(tmp_path) > 7200:
+            cached_meta = {} if force_update else self.read_http_meta(file_name)
+            num_attempts = self.download_retries + 1
+            for n in range(1, num_attempts + 1):
+                stats['attempts'] = n
+                try:
+                    status, meta = self.fetch(url, tmp_path, self.download_timeout, cached_meta)
+                    if status == 304:
+                        stats['not_modified'] = True
+                        saved = stats['bytes_saved'] = int(cached_meta.get('content_length') or 0)
+                        log.info("{} not modified since last download (saved {} bytes)".format(url, saved))
+                    else:
+                        stats['downloaded'] = True
+                        with open(self.get_http_meta_path(file_name, self.tmp_dir), 'w') as f:
+                            json.dump(meta, f)
+                    break
+                except Exception as e:
+                    log.warning("download attempt {} of {} for {} failed: {}".format(n, num_attempts, url, e))
+                    if n < num_attempts:
+                        time.sleep(min(2 ** n, 30))
+
+            # fix the new feed (once) ... a feed the fixes can't be applied to is treated as invalid, and dropped
+            if fix_rules and stats['downloaded']:
+                try:
+                    stats['fixes'] = FixPlan.from_file(fix_rules).apply(tmp_path)
+                except Exception as e:
+                    log.warning("can't apply fixes {} to {}, so not using this download: {}".format(fix_rules, url, e))
+                    stats['fix_failed'] = True
+                    file_utils.rm(tmp_path)
+                    file_utils.rm(self.get_http_meta_path(file_name, self.tmp_dir))
+        stats['download_secs'] = round(time.time() - start, 2)
+        return stats
+
+    @classmethod
+    def fetch(cls, url, file_path, timeout=600, cached_meta=None, chunk_size=1024*1024):
+        """
+        stream url into file_path, giving up if the whole download takes longer than timeout seconds
+        note: the data is written to a .part file first, so a failed download never clobbers file_path
+        :param cached_meta: http headers from the last download, used to make a conditional request
+        :return: http status and the ETag, Last-Modified and Content-Length headers of the response
+        """
+        headers = {}
+        if cached_meta:
+            if cached_meta.get('etag'):
+                headers['If-None-Match'] = cached_meta.get('etag')
+            if cached_meta.get('last_modified'):
+                headers['If-Modified-Since'] = cached_meta.get('last_modified')
+
+        deadline = time.time() + timeout
+        part_path = file_path + ".part"
+        try:
+            with urlopen(Request(url, headers=headers), timeout=timeout) as response, open(part_path, 'wb') as f:
+                status = response.status
+                meta = {
+                    'url': url,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'content_length': response.headers.get('Content-Length')
+                }
+                num_bytes = 0
+                while True:
+                    chunk = response.read(chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    num_bytes += len(chunk)
+                    if time.time() > deadline:
+                        raise IOError("download of {} took longer than {} seconds".format(url, timeout))
+            if meta['content_length'] is None:
+                meta['content_length'] = str(num_bytes)
+            os.replace(part_path, file_path)
+        except HTTPError as e:
+            if e.code != 304:
+                raise
+            status, meta = 304, cached_meta
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        return status, meta
+
+    def check_feed(self, url, file_name, force_update=False, stats=None):
         """
         download feed from url, and check it against the cache
         if newer, then replace cached feed .zip file with new version
@@ -48,46 +213,79 @@ class GtfsCache(CacheBase):
         file_name = file_name
         file_path = os.path.join(self.cache_dir, file_name)
 
-        # step 2: download new gtfs file
+        # step 2: download new gtfs file (unless check_cached_feeds() already did that for us)
         url = url
         tmp_path = os.path.join(self.tmp_dir, file_name)
+        if stats is None:
+            stats = self.download_feed(url, file_name, force_update)
 
-        # step 2b: don't keep downloading a file ... make sure the tmp file is at least 2 hours
-        if os.path.exists(tmp_path) is False or file_utils.file_age_seconds(tmp_path) > 7200:
-            web_utils.wget(url, tmp_path)
+        # step 2b: server says the cached feed is current, so there's nothing to unzip or diff
+        if stats.get('not_modified') and not force_update:
+            return False
+
+        # step 2c: nothing to check if the download failed (or its fixes did)
+        if stats.get('fix_failed'):
+            log.warning("something *WRONG* with feed {}: its fixes failed, so keeping the cached feed".format(url))
+            return False
+        if not os.path.exists(tmp_path):
+            log.warning("no downloaded file {} for feed {}".format(tmp_path, url))
+            return False
 
         # step 3: check the cache whether we should update or not
         update = force_update
+        is_valid = True
+        change_set = ChangeSet(is_new=True)
         if not force_update:
             if self.is_fresh_in_cache(file_path):
                 log.info("diff {} against cached {}".format(tmp_path, file_path))
-                diff = Diff(file_path, tmp_path)
+                diff = Diff(file_path, tmp_path, use_sha=self.diff_sha256, save_manifest=True)
                 if diff.is_different():
                     update = True
+                    change_set = diff.get_change_set()
             else:
                 update = True
 
         # step 4: test new .zip for validity and also
         if update:
             # step 4a: make sure this new .zip feed has a trips.txt, routes.txt and stops.txt file ... if not no update
-            if GtfsInfo.feed_looks_valid(tmp_path):
+            #          (and that it has trips on all the coming days ... see ServiceCoverage and [gtfs] coverage_check)
+            if GtfsInfo.feed_looks_valid(tmp_path) and self.check_coverage(tmp_path):
                 # step 4b: mv old file to backup then mv new file in tmp dir to cache
                 log.info("cp {} to cache {}".format(tmp_path, file_path))
                 file_utils.bkup(file_path)
                 file_utils.cp(tmp_path, file_path)
+
+                # step 4c: keep a record of what changed in this feed (see ChangeSet), so loaders can skip unaffected work
+                log.info("{} changes: {}".format(file_name, change_set))
+                change_set.save(self.get_changes_path(file_name))
+                self.change_sets[file_name] = change_set
             else:
                 log.warning("something *WRONG* with file: {}".format(tmp_path))
                 update = False
+                is_valid = False
+
+        # step 5: the cache now matches what the server sent, so keep the http headers for the next conditional request
+        tmp_meta_path = self.get_http_meta_path(file_name, self.tmp_dir)
+        if stats.get('downloaded') and is_valid and os.path.exists(tmp_meta_path):
+            os.replace(tmp_meta_path, self.get_http_meta_path(file_name))
 
         return update
 
+    def check_coverage(self, gtfs_path):
+        mode = self.config.get('coverage_check', section='gtfs', def_val='warn')
+        min_ratio = float(self.config.get('coverage_min_ratio', section='gtfs', def_val=0.25))
+        return ServiceCoverage.is_feed_ok(gtfs_path, mode, min_ratio)
+
+    def get_changes_path(self, file_name):
+        return os.path.join(self.cache_dir, file_name + self.changes_ext)
+
     def cmp_file_to_cached(self, gtfs_zip_name, cmp_dir):
         """
         returns a Diff object with cache/gtfs_zip_name & cmp_dir/gtfs_zip_name
         """
         cache_path = os.path.join(self.cache_dir, gtfs_zip_name)
         other_path = os.path.join(cmp_dir, gtfs_zip_name)
-        diff = Diff(cache_path, other_path)
+        diff = Diff(cache_path, other_path, use_sha=self.diff_sha256, save_manifest=True)
         return diff
 
     @classmethod
@@ -100,9 +298,11 @@ class GtfsCache(CacheBase):
         return ret_val
 
     @classmethod
-    def compare_feed_against_cache(cls, gtfs_feed, app_dir, force_update=False):
+    def compare_feed_against_cache(cls, gtfs_feed, app_dir, force_update=False, change_filter=None):
         """
         check the ott.loader.gtfs cache for any feed updates
+        :param change_filter: optional test of the diff's ChangeSet (e.g., ChangeSet.affects_graph) ... when the
+                              changes don't pass the filter, the app's copy of the feed is left alone (no update)
         """
         update_cache = force_update
         try:
@@ -111,9 +311,16 @@ class GtfsCache(CacheBase):
 
             # if we aren't forcing an update, then compare for difference before updating the cache
             if not force_update:
-                diff = cache.cmp_file_to_cached(name, app_dir)
-                if diff.is_different():
+                if not os.path.exists(os.path.join(app_dir, name)):
                     update_cache = True
+                else:
+                    diff = cache.cmp_file_to_cached(name, app_dir)
+                    if diff.is_different():
+                        change_set = diff.get_change_set()
+                        if change_filter is None or change_filter(change_set):
+                            update_cache = True
+                        else:
+                            log.info("skipping {} update in {}, since the changes don't matter here: {}".format(name, app_dir, change_set))
 
             # update the local cache
             if update_cache:
@@ -123,7 +330,7 @@ class GtfsCache(CacheBase):
         return update_cache
 
     @classmethod
-    def check_feeds_against_cache(cls, gtfs_feeds, app_dir, force_update=False, filter=None):
+    def check_feeds_against_cache(cls, gtfs_feeds, app_dir, force_update=False, filter=None, change_filter=None):
         """
         check the ott.loader.gtfs cache for any feed updates
         """
@@ -131,7 +338,7 @@ class GtfsCache(CacheBase):
         for feed in gtfs_feeds:
             if filter and feed.get('name', 'XXX') not in filter:
                 continue
-            if GtfsCache.compare_feed_against_cache(feed, app_dir, force_update):
+            if GtfsCache.compare_feed_against_cache(feed, app_dir, force_update, change_filter):
                 update_cache = True
         return update_cache
 
@@ -1,6 +1,9 @@
 import os
+import io
 import csv
+import zipfile
 import datetime
+import functools
 
 from ott.utils import file_utils
 from ott.utils import object_utils
@@ -14,13 +17,18 @@ log = logging.getLogger(__file__)
 
 class GtfsInfo(CacheBase):
     """ Get info on a gtfs.zip file:
-         1. will unzip the two calendar plus the feed_info .txt files
+         1. will stream the two calendar plus the feed_info .txt files straight out of the .zip (no unzipping to disk)
          2. will read the calendar .txt files, and provide date ranges and the like
          3. will calulate based on the calendar how old the feed is (and how many days it has left)
          4. will read the feed_info and pull out various date ranges and feed ids
+
+        note: the parsed calendar and feed_info summaries are memoized per gtfs.zip (keyed on the zip's mtime and size,
+              plus today's date, since the summary includes today's position in the calendar), so repeated info calls on
+              the same feed don't re-read the .zip ... only the last summary_cache_size summaries are kept
     """
     gtfs_path = None
     file_prefix = None
+    summary_cache_size = 32
 
     def __init__(self, gtfs_path, file_prefix=''):
         """ note: file_prefix allows us to have old_gtfs.zip and new_gtfs.zip names to compare against either other
@@ -32,27 +40,27 @@ class GtfsInfo(CacheBase):
         self.dir_path = os.path.dirname(gtfs_path)
         self.file_prefix = file_prefix
 
-    def is_feed_valid(self):
+    def is_feed_valid(self, min_size=100):
+        """ check that the routes, stops and trips .txt files are in the .zip (and aren't empty)
+        """
         ret_val = True
+        sizes = self.get_member_sizes()
+        for f in ('routes.txt', 'stops.txt', 'trips.txt'):
+            if sizes.get(f, 0) < min_size:
+                log.warning("VALID FEED?: {} {} looks wrong".format(self.gtfs_path, f))
+                ret_val = False
+        return ret_val
 
-        # check routes
-        r = self.unzip_routes()
-        if not file_utils.exists_and_sized(r, 100):
-            log.warning("VALID FEED?: {} routes.txt looks wrong".format(self.gtfs_path))
-            ret_val = False
-
-        # check stops
-        s = self.unzip_stops()
-        if not file_utils.exists_and_sized(s, 100):
-            log.warning("VALID FEED?: {} stops.txt looks wrong".format(self.gtfs_path))
-            ret_val = False
-
-        # check trips
-        t = self.unzip_trips()
-        if not file_utils.exists_and_sized(t, 100):
-            log.warning("VALID FEED?: {} trips.txt looks wrong".format(self.gtfs_path))
-            ret_val = False
-
+    def get_member_sizes(self):
+        """ :return: dict of .zip member names to their uncompressed sizes (read from the zip's central directory)
+        """
+        ret_val = {}
+        try:
+            with zipfile.ZipFile(self.gtfs_path) as z:
+                for i in z.infolist():
+                    ret_val[i.filename] = i.file_size
+        except Exception as e:
+            log.warning("can't read {}: {}".format(self.gtfs_path, e))
         return ret_val
 
     def get_feed_version(self):
@@ -162,16 +170,68 @@ class GtfsInfo(CacheBase):
     def unzip_trips(self, trips_name='trips.txt'):
         return file_utils.unzip_file(self.gtfs_path, file_name=trips_name)
 
+    @classmethod
+    def open_csv(cls, zip_file, file_name):
+        """ :return: csv.DictReader streaming file_name straight out of an open ZipFile (None if not in the .zip)
+        """
+        ret_val = None
+        if file_name in zip_file.namelist():
+            ret_val = csv.DictReader(io.TextIOWrapper(zip_file.open(file_name), encoding='utf-8-sig', newline=''))
+        return ret_val
+
+    def read_csv(self, file_name):
+        """ generator of the (dict) rows of a .txt file in the gtfs.zip
+        """
+        with zipfile.ZipFile(self.gtfs_path) as z:
+            reader = self.open_csv(z, file_name)
+            if reader:
+                for row in reader:
+                    yield row
+
+    def _get_summary(self):
+        """ open the .zip once, and parse calendar.txt, calendar_dates.txt and feed_info.txt in a single pass
+            the summary is memoized, and only re-parsed when the .zip changes (mtime or size) or the day changes
+        """
+        st = os.stat(self.gtfs_path)
+        today = datetime.datetime.now().strftime("%Y%m%d")
+        return self._read_summary(os.path.abspath(self.gtfs_path), st.st_mtime, st.st_size, today)
+
+    @classmethod
+    @functools.lru_cache(maxsize=summary_cache_size)
+    def _read_summary(cls, gtfs_path, mtime, size, today):
+        """ note: mtime and size aren't used here, but are part of the lru_cache key """
+        with zipfile.ZipFile(gtfs_path) as z:
+            ret_val = {
+                'calendar_range': cls._parse_calendar_range(cls.open_csv(z, 'calendar.txt')),
+                'calendar_dates_range': cls._parse_calendar_dates_range(cls.open_csv(z, 'calendar_dates.txt'), today),
+                'feed_info': cls._parse_feed_info(cls.open_csv(z, 'feed_info.txt'))
+            }
+        logging.debug(" summary of {}: {}".format(gtfs_path, ret_val))
+        return ret_val
+
     def _get_calendar_range(self):
         """ get the date range from calendar.txt
         """
+        return self._get_summary()['calendar_range']
+
+    def _get_calendar_dates_range(self):
+        """ get the date range from calendar_dates.txt (as well as today's position, etc...)
+        """
+        return self._get_summary()['calendar_dates_range']
+
+    def _get_feed_info(self):
+        """ return feed version, start/end dates and id info from the feed_info.txt file...
+        """
+        return self._get_summary()['feed_info']
+
+    @classmethod
+    def _parse_calendar_range(cls, reader):
+        """ get the date range from calendar.txt rows
+        """
         start_date = None
         end_date = None
 
-        calendar_path = self.unzip_calendar_txt()
-        file = open(calendar_path, 'r')
-        reader = csv.DictReader(file)
-        for i, row in enumerate(reader):
+        for row in reader or []:
             # step 1: grab dates from .csv
             sdate = row['start_date']
             edate = row['end_date']
@@ -186,23 +246,20 @@ class GtfsInfo(CacheBase):
             if edate and edate > end_date:
                 end_date = edate
 
-        logging.debug(" date range of file {}: {} to {}".format(calendar_path, start_date, end_date))
-        file.close()
         return start_date, end_date
 
-    def _get_calendar_dates_range(self):
-        """ get the date range from calendar_dates.txt (as well as today's position, etc...)
+    @classmethod
+    def _parse_calendar_dates_range(cls, reader, today=None):
+        """ get the date range from calendar_dates.txt rows (as well as today's position, etc...)
         """
         start_date = None
         end_date = None
-        today = datetime.datetime.now().strftime("%Y%m%d")
+        if today is None:
+            today = datetime.datetime.now().strftime("%Y%m%d")
         today_position = -111
         total_positions = 0
 
-        calendar_dates_path = self.unzip_calendar_dates_txt()
-        file = open(calendar_dates_path, 'r')
-        reader = csv.DictReader(file)
-        for i, row in enumerate(reader):
+        for i, row in enumerate(reader or []):
             # step 1: grab date from .csv
             date = row['date']
 
@@ -223,30 +280,23 @@ class GtfsInfo(CacheBase):
         if today_position < 0:
             today_position = total_positions
 
-        logging.debug(" date range of file {}: {} to {}, and today {} position is {} of {}".format(calendar_dates_path, start_date, end_date, today, today_position, total_positions))
-        file.close()
         return start_date, end_date, today_position, total_positions
 
-    def _get_feed_info(self):
-        """ return feed version, start/end dates and id info from the feed_info.txt file...
+    @classmethod
+    def _parse_feed_info(cls, reader):
+        """ return feed version, start/end dates and id info from feed_info.txt rows...
         """
-        #import pdb; pdb.set_trace()
         version = '???'
         start_date = 'ZZZ'
         end_date = ''
         id = '???'
 
-        feed_info_path = self.unzip_feed_info_txt()
-        file = open(feed_info_path, 'r')
-        reader = csv.DictReader(file)
-        for i, row in enumerate(reader):
+        for row in reader or []:
             id = row.get('feed_id', id)
             start_date = row.get('feed_start_date', start_date)
             end_date = row.get('feed_end_date', end_date)
             version = row.get('feed_version', version)
 
-        logging.debug("feed version {0} ... date range {1} to {2}".format(version, start_date, end_date))
-        file.close()
         return start_date, end_date, id, version
 
     def _get_feed_date_range(self):
@@ -1,10 +1,17 @@
 import os
+import shutil
+import datetime
 import inspect
+import zipfile
+import tempfile
 import unittest
 
 from ott.loader.gtfs.gtfs_cache import GtfsCache
 from ott.loader.gtfs.gtfs_info import GtfsInfo
-from ott.loader.gtfs.diff import Diff
+from ott.loader.gtfs.diff import Diff, ChangeSet
+from ott.loader.gtfs.zip_rewriter import ZipRewriter
+from ott.loader.gtfs.fix_plan import FixPlan
+from ott.loader.gtfs.coverage import ServiceCoverage
 
 
 class TestGtfsDiff(unittest.TestCase):
@@ -40,6 +47,52 @@ class TestGtfsDiff(unittest.TestCase):
         self.assertFalse(d.is_different())
         pass
 
+    def test_changed_tables(self):
+        this_module_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+        gtfsA = os.path.join(this_module_dir, "gtfsA.zip")
+        gtfsB = os.path.join(this_module_dir, "gtfsB.zip")
+        gtfsC = os.path.join(this_module_dir, "gtfsC.zip")
+        self.assertEqual(Diff(gtfsA, gtfsB).get_changed_tables(), ['calendar_dates.txt'])
+        self.assertEqual(Diff(gtfsB, gtfsC).get_changed_tables(), ['feed_info.txt'])
+        self.assertEqual(Diff(gtfsB, gtfsC, use_sha=True).get_changed_tables(), ['feed_info.txt'])
+
+    def test_manifest(self):
+        """ a plain Diff doesn't leave manifests beside its zips ... save_manifest (GtfsCache's compares) does """
+        this_module_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            gtfsA = os.path.join(tmp_dir, "gtfsA.zip")
+            gtfsB = os.path.join(tmp_dir, "gtfsB.zip")
+            shutil.copy2(os.path.join(this_module_dir, "gtfsA.zip"), gtfsA)
+            shutil.copy2(os.path.join(this_module_dir, "gtfsB.zip"), gtfsB)
+
+            Diff(gtfsA, gtfsB).get_changed_tables()
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['gtfsA.zip', 'gtfsB.zip'])
+
+            Diff(gtfsA, gtfsB, save_manifest=True).get_changed_tables()
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['gtfsA.zip', 'gtfsA.zip' + Diff.manifest_ext, 'gtfsB.zip'])
+            self.assertEqual(Diff.get_manifest(gtfsA), Diff.make_manifest(gtfsA))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_change_set(self):
+        this_module_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+        gtfsA = os.path.join(this_module_dir, "gtfsA.zip")
+        gtfsB = os.path.join(this_module_dir, "gtfsB.zip")
+        gtfsC = os.path.join(this_module_dir, "gtfsC.zip")
+
+        # feed_info.txt only change ... no need to rebuild graphs
+        cs = Diff(gtfsB, gtfsC).get_change_set()
+        self.assertEqual(cs.row_deltas, {'feed_info.txt': 0})
+        self.assertTrue(cs.affects_db())
+        self.assertFalse(cs.affects_graph())
+
+        # a calendar_dates.txt row was dropped
+        cs = Diff(gtfsA, gtfsB).get_change_set()
+        self.assertEqual(cs.row_deltas, {'calendar_dates.txt': -1})
+        self.assertTrue(cs.affects_graph())
+        self.assertTrue(ChangeSet(is_new=True).affects_graph())
+
     def main():
         ## todo test diff, etc...
         ## this was from diff.py
@@ -105,3 +158,257 @@ class TestGtfsInfo(unittest.TestCase):
         self.assertTrue(r[0] >= 3200)
         self.assertTrue(r[1] <= -1750)
         self.assertTrue(i.is_gtfs_out_of_date())
+
+
+class TestFixPlan(unittest.TestCase):
+    """ the fix rules, run over in-memory rows """
+    stop_times = ['trip_id', 'stop_id', 'stop_sequence', 'pickup_type', 'drop_off_type', 'shape_dist_traveled']
+
+    def setUp(self):
+        self.rows = [
+            ['t1', 'A', '1', '', '', '0.0'],
+            ['t1', 'BTC', '2', '1', '1', '5.0'],
+            ['t1', '8169', '3', '1', '1', '10.0'],
+            ['t1', 'C', '4', '', '', '15.0'],
+            ['t2', '8169', '1', '1', '1', '0.0'],
+            ['t2', 'D', '2', '', '', '5.0'],
+        ]
+
+    def tearDown(self):
+        pass
+
+    def run_plan(self, rules, header, rows):
+        plan = FixPlan(rules)
+        transform = plan._table_transform(plan.tables[rules[0]['table']])
+        return [list(r) for r in transform(header, [list(r) for r in rows])], plan
+
+    def test_rename(self):
+        header = ['route_id', 'agency_id', 'route_short_name']
+        rows = [['1', 'PSC', 'PSC'], ['2', 'TRAM', 'T'], ['3', 'TRIMET', 'X']]
+        rule = {"table": "routes.txt", "type": "rename", "regex": "(PSC|TRAM)", "replace": "TRIMET", "columns": ["agency_id"]}
+        out, plan = self.run_plan([rule], header, rows)
+        self.assertEqual(out, [['1', 'TRIMET', 'PSC'], ['2', 'TRIMET', 'T'], ['3', 'TRIMET', 'X']])
+        self.assertEqual(plan.rules[0].hits, 2)
+
+        # no columns ... every value gets renamed
+        del rule['columns']
+        out, plan = self.run_plan([rule], header, rows)
+        self.assertEqual(out[0], ['1', 'TRIMET', 'TRIMET'])
+        self.assertEqual(plan.rules[0].hits, 3)
+
+    def test_perms(self):
+        rule = {"table": "stop_times.txt", "type": "perms", "stop": "8169"}
+        out, plan = self.run_plan([rule], self.stop_times, self.rows)
+        self.assertEqual([(r[3], r[4]) for r in out if r[1] == '8169'], [('0', '0'), ('0', '0')])
+        self.assertEqual((out[1][3], out[1][4]), ('1', '1'))
+        self.assertEqual(plan.rules[0].hits, 2)
+
+    def test_cull(self):
+        """ the stop_time before 8169 in the same trip goes, and 8169 takes its sequence & distance """
+        out, plan = self.run_plan([{"table": "stop_times.txt", "type": "cull", "stop": "8169"}], self.stop_times, self.rows)
+        self.assertEqual([(r[0], r[1], r[2], r[5]) for r in out], [
+            ('t1', 'A', '1', '0.0'), ('t1', '8169', '2', '5.0'), ('t1', 'C', '4', '15.0'),
+            ('t2', '8169', '1', '0.0'), ('t2', 'D', '2', '5.0')
+        ])
+        self.assertEqual(plan.rules[0].hits, 1)
+
+    def test_filter(self):
+        header = ['route_id', 'service_id', 'trip_id']
+        rows = [['1', 'W', 'a'], ['901', 'W', 'b'], ['2', 'S', 'c']]
+        out, plan = self.run_plan([{"table": "trips.txt", "type": "filter", "column": "route_id", "regex": r"^9\d\d$"}], header, rows)
+        self.assertEqual([r[2] for r in out], ['a', 'c'])
+        self.assertEqual(plan.rules[0].hits, 1)
+
+        out, plan = self.run_plan([{"table": "trips.txt", "type": "filter", "column": "service_id", "regex": "^W$", "keep": True}], header, rows)
+        self.assertEqual([r[2] for r in out], ['a', 'b'])
+
+    def test_rule_order(self):
+        """ a table's rules run in order, each on the rows the one before it yields """
+        rules = [
+            {"table": "stop_times.txt", "type": "rename", "regex": "^BTC$", "replace": "8169", "columns": ["stop_id"]},
+            {"table": "stop_times.txt", "type": "filter", "column": "stop_id", "regex": "^8169$"}
+        ]
+        out, plan = self.run_plan(rules, self.stop_times, self.rows)
+        self.assertEqual([r[1] for r in out], ['A', 'C', 'D'])
+        self.assertEqual([r.hits for r in plan.rules], [1, 3])
+
+    def test_bad_rules(self):
+        self.assertRaises(ValueError, FixPlan, [{"table": "routes.txt", "type": "nope"}])
+        self.assertRaises(ValueError, FixPlan, [{"type": "rename", "regex": "x"}])
+        rule = {"table": "trips.txt", "type": "filter", "column": "block_id", "regex": "x"}
+        self.assertRaises(ValueError, self.run_plan, [rule], ['route_id', 'trip_id'], [['1', 'a']])
+
+
+class TestServiceCoverage(unittest.TestCase):
+    """ four weeks of service starting next monday: 10 weekday trips (W) and 2 weekend trips (S) a day ... the first
+        monday's weekday service is removed, and the first tuesday only runs a 1 trip holiday service (H)
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        today = datetime.date.today()
+        self.monday = today + datetime.timedelta(days=7 - today.weekday())
+        self.tuesday = self.monday + datetime.timedelta(days=1)
+        end = self.monday + datetime.timedelta(days=27)
+
+        def ymd(d):
+            return d.strftime("%Y%m%d")
+
+        self.gtfs = os.path.join(self.tmp_dir, "coverage.zip")
+        with zipfile.ZipFile(self.gtfs, 'w') as z:
+            z.writestr('calendar.txt', "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+                       "W,1,1,1,1,1,0,0,{s},{e}\nS,0,0,0,0,0,1,1,{s},{e}\n".format(s=ymd(self.monday), e=ymd(end)))
+            z.writestr('calendar_dates.txt', "service_id,date,exception_type\nW,{m},2\nW,{t},2\nH,{t},1\n".format(
+                m=ymd(self.monday), t=ymd(self.tuesday)))
+            z.writestr('trips.txt', "route_id,service_id,trip_id\n" + "".join(
+                "1,{},{}{}\n".format(svc, svc, i) for svc, n in (('W', 10), ('S', 2), ('H', 1)) for i in range(n)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_counts(self):
+        c = ServiceCoverage(self.gtfs)
+        c.compute()
+        self.assertEqual(len(c.days), 28)
+        self.assertEqual([int(t) for t in c.trips[:7]], [0, 1, 10, 10, 10, 2, 2])
+        self.assertEqual([int(s) for s in c.services[:7]], [0, 1, 1, 1, 1, 1, 1])
+        self.assertEqual([int(d) for d in c.dow[:7]], [0, 1, 2, 3, 4, 5, 6])
+
+    def test_check(self):
+        c = ServiceCoverage(self.gtfs)
+        self.assertFalse(c.check())
+        self.assertEqual([(a['date'], a['trips'], a['services']) for a in c.anomalies], [
+            (self.monday.isoformat(), 0, 0), (self.tuesday.isoformat(), 1, 1)
+        ])
+        self.assertIn("fewer than 1 trips", c.anomalies[0]['reason'])
+        self.assertIn("under 25% of the usual 10 trips", c.anomalies[1]['reason'])
+
+        # only dates on or after from_date get flagged
+        self.assertTrue(c.check(self.tuesday + datetime.timedelta(days=1)))
+        self.assertFalse(c.check(self.tuesday.strftime("%Y%m%d")))
+        self.assertEqual(len(c.anomalies), 1)
+
+        # a lower ratio lets the 1 trip day thru
+        c = ServiceCoverage(self.gtfs, min_ratio=0.05)
+        self.assertFalse(c.check())
+        self.assertEqual([a['date'] for a in c.anomalies], [self.monday.isoformat()])
+
+    def test_is_feed_ok(self):
+        self.assertTrue(ServiceCoverage.is_feed_ok(self.gtfs, 'off'))
+        self.assertTrue(ServiceCoverage.is_feed_ok(self.gtfs, 'warn'))
+        self.assertFalse(ServiceCoverage.is_feed_ok(self.gtfs, 'block'))
+        self.assertTrue(ServiceCoverage.is_feed_ok(os.path.join(self.tmp_dir, "missing.zip"), 'block'))
+
+
+class TestZipRewriter(unittest.TestCase):
+    def setUp(self):
+        this_module_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gtfs = os.path.join(self.tmp_dir, "gtfsA.zip")
+        shutil.copy(os.path.join(this_module_dir, "gtfsA.zip"), self.gtfs)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_rewrite(self):
+        def lower_stop_ids(header, rows):
+            i = header.index('stop_id')
+            for r in rows:
+                r[i] = r[i].lower()
+                yield r
+
+        before = dict((i.filename, (i.CRC, i.compress_size)) for i in zipfile.ZipFile(self.gtfs).infolist())
+        ZipRewriter(self.gtfs).rewrite({'stops.txt': lower_stop_ids})
+
+        z = zipfile.ZipFile(self.gtfs)
+        self.assertIsNone(z.testzip())
+        self.assertIn(b'\nbeatty_airport,', z.read('stops.txt'))
+        for i in z.infolist():
+            if i.filename != 'stops.txt':
+                self.assertEqual(before[i.filename], (i.CRC, i.compress_size))
+
+    def test_fix_plan(self):
+        plan = FixPlan([
+            {"table": "routes.txt", "type": "rename", "regex": "^DTA$", "replace": "TRIMET", "columns": ["agency_id"]},
+            {"table": "trips.txt", "type": "filter", "column": "route_id", "regex": "^AB$"},
+            {"table": "stop_times.txt", "type": "cull", "stop": "BEATTY_AIRPORT"}
+        ])
+        stats = dict((s['name'], s['hits']) for s in plan.apply(self.gtfs))
+        self.assertEqual(stats, {'rename:routes.txt': 5, 'filter:trips.txt': 2, 'cull:stop_times.txt': 4})
+
+        z = zipfile.ZipFile(self.gtfs)
+        self.assertNotIn(b'DTA', z.read('routes.txt'))
+        self.assertNotIn(b'\nAB,', z.read('trips.txt'))
+
+    def make_zip(self, path, streamed=False):
+        """ zip with a zip64 member ... streamed=True writes it to a non-seekable file, so every member gets a data
+            descriptor (and the zip64 member's descriptor has 8 byte sizes)
+        """
+        class Unseekable(object):
+            def __init__(self, f):
+                self.f = f
+
+            def write(self, b):
+                return self.f.write(b)
+
+            def flush(self):
+                self.f.flush()
+
+        with open(path, 'wb') as f:
+            with zipfile.ZipFile(Unseekable(f) if streamed else f, 'w', zipfile.ZIP_DEFLATED) as z:
+                z.writestr('stops.txt', "stop_id,stop_name\nA,Alpha\nB,Beta\n")
+                with z.open('shapes.txt', 'w', force_zip64=True) as m:
+                    m.write(b"shape_id,shape_pt_lat,shape_pt_lon\n" + b"1,45.5,-122.6\n" * 5000)
+                with z.open('trips.txt', 'w') as m:
+                    m.write(b"route_id,service_id,trip_id\n1,W,1\n1,W,2\n")
+        return path
+
+    def check_rewrite(self, path, rewriter=ZipRewriter):
+        def lower_stop_ids(header, rows):
+            for r in rows:
+                r[0] = r[0].lower()
+                yield r
+
+        with zipfile.ZipFile(path) as z:
+            before = dict((i.filename, (z.read(i), i.flag_bits, i.compress_size)) for i in z.infolist())
+        rewriter(path).rewrite({'stops.txt': lower_stop_ids})
+
+        with zipfile.ZipFile(path) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(z.read('stops.txt'), b"stop_id,stop_name\r\na,Alpha\r\nb,Beta\r\n")
+            after = dict((i.filename, (z.read(i), i.flag_bits, i.compress_size)) for i in z.infolist())
+        for n in ('shapes.txt', 'trips.txt'):
+            self.assertEqual(before[n][0], after[n][0])
+        return before, after
+
+    def test_rewrite_zip64(self):
+        path = self.make_zip(os.path.join(self.tmp_dir, "zip64.zip"))
+        before, after = self.check_rewrite(path)
+        self.assertEqual(before['shapes.txt'], after['shapes.txt'])
+
+    @classmethod
+    def read_span(cls, path, name, next_name):
+        """ :return: the raw bytes of a member (local header, data and data descriptor), up to the next member """
+        with zipfile.ZipFile(path) as z:
+            start, end = z.getinfo(name).header_offset, z.getinfo(next_name).header_offset
+        with open(path, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def test_rewrite_data_descriptors(self):
+        path = self.make_zip(os.path.join(self.tmp_dir, "streamed.zip"), streamed=True)
+        shapes = self.read_span(path, 'shapes.txt', 'trips.txt')
+        before, after = self.check_rewrite(path)
+        for n in ('shapes.txt', 'trips.txt'):
+            self.assertTrue(after[n][1] & 0x08)
+            self.assertEqual(before[n], after[n])
+        # the zip64 member (and its 24 byte data descriptor) came over byte for byte
+        self.assertEqual(shapes, self.read_span(path, 'shapes.txt', 'trips.txt'))
+
+    def test_rewrite_no_raw_copy(self):
+        class RecompressingRewriter(ZipRewriter):
+            @classmethod
+            def can_copy_raw(cls, zin, zout):
+                return False
+
+        path = self.make_zip(os.path.join(self.tmp_dir, "streamed.zip"), streamed=True)
+        self.check_rewrite(path, RecompressingRewriter)
@@ -0,0 +1,167 @@
+import os
+import io
+import csv
+import copy
+import struct
+import zipfile
+import datetime
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class ZipRewriter(object):
+    """
+    streaming rewrite of .txt members in a gtfs.zip, in a single pass over the archive:
+     - rows of a rewritten member are streamed out of the zip as lists (use column indexes, not dicts), handed to a
+       transform, and written straight into the new zip member ... nothing is extracted to disk
+     - only the rewritten members get recompressed; the compressed bytes of every other member are copied as is
+       (when this python's zipfile has the internals that raw copy needs ... else they're copied via read / writestr)
+
+    a transform is a callable: transform(header, rows) -> iterable of rows, where header is the list of column names
+    """
+    zip_path = None
+    chunk_size = 1024 * 1024
+    raw_copy_attrs = ('structFileHeader', 'sizeFileHeader', 'stringFileHeader', '_FH_SIGNATURE',
+                      '_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH')
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+
+    @classmethod
+    def read_rows(cls, zip_file, member_name):
+        """ :return: header (list of column names) and a generator of rows (lists) streamed out of an open ZipFile
+        """
+        reader = csv.reader(io.TextIOWrapper(zip_file.open(member_name), encoding='utf-8-sig', newline=''))
+        header = next(reader, [])
+        width = len(header)
+
+        def rows():
+            for row in reader:
+                if len(row) < width:
+                    row.extend([''] * (width - len(row)))
+                yield row
+        return header, rows()
+
+    def rewrite(self, transforms, out_path=None):
+        """
+        rewrite the zip, applying transforms ({member name: transform}) to their members
+        :param out_path: write the new zip here ... default is to replace the original zip (via a .tmp file)
+        :return: path to the new zip
+        """
+        tmp_path = (out_path or self.zip_path) + ".tmp"
+        try:
+            with zipfile.ZipFile(self.zip_path) as zin, zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zout:
+                raw = self.can_copy_raw(zin, zout)
+                for info in zin.infolist():
+                    transform = transforms.get(info.filename)
+                    if transform:
+                        self._write_member(zin, zout, info, transform)
+                    elif not raw or not self._copy_raw_member(zin, zout, info):
+                        self._copy_member(zin, zout, info)
+            os.replace(tmp_path, out_path or self.zip_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return out_path or self.zip_path
+
+    def export(self, member_name, transform, out_file):
+        """ stream a transformed member out to a (unzipped) .csv file, rather than back into the zip
+        """
+        with zipfile.ZipFile(self.zip_path) as zin:
+            header, rows = self.read_rows(zin, member_name)
+            with open(out_file, 'w', newline='', encoding='utf-8') as f:
+                w = csv.writer(f)
+                w.writerow(header)
+                w.writerows(transform(header, rows))
+        return out_file
+
+    def _write_member(self, zin, zout, info, transform):
+        """ stream rows out of the old member, thru the transform, and into a newly compressed member
+        """
+        header, rows = self.read_rows(zin, info.filename)
+        new_info = zipfile.ZipInfo(info.filename, datetime.datetime.now().timetuple()[:6])
+        new_info.compress_type = zipfile.ZIP_DEFLATED
+        new_info.external_attr = info.external_attr
+        with zout.open(new_info, 'w', force_zip64=True) as out:
+            with io.TextIOWrapper(out, encoding='utf-8', newline='') as f:
+                w = csv.writer(f)
+                w.writerow(header)
+                w.writerows(transform(header, rows))
+
+    @classmethod
+    def can_copy_raw(cls, zin, zout):
+        """ raw copy leans on zipfile internals (the local header struct, and ZipFile's fp, start_dir and _didModify),
+            so only use it when they're all there, and neither zip is busy with an open member stream
+        """
+        ret_val = all(hasattr(zipfile, a) for a in cls.raw_copy_attrs) and \
+            all(hasattr(zout, a) for a in ('fp', 'start_dir', '_didModify', 'filelist', 'NameToInfo')) and \
+            getattr(zin, 'fp', None) is not None and zout.fp is not None and \
+            not getattr(zin, '_writing', False) and not getattr(zout, '_writing', False)
+        if not ret_val:
+            log.info("this python's zipfile can't do raw member copies, so members will be recompressed")
+        return ret_val
+
+    @classmethod
+    def has_zip64_extra(cls, extra):
+        """ :return: True if a local header's extra field has a zip64 record (id 1) ... then the sizes in the member's
+                     data descriptor are 8 bytes each, not 4
+        """
+        i = 0
+        while i + 4 <= len(extra):
+            id, size = struct.unpack('<HH', extra[i:i + 4])
+            if id == 0x0001:
+                return True
+            i += 4 + size
+        return False
+
+    def _copy_member(self, zin, zout, info):
+        """ copy a member by decompressing & recompressing it (the fallback for when raw copy isn't possible) """
+        zout.writestr(copy.copy(info), zin.read(info), compress_type=info.compress_type)
+
+    def _copy_raw_member(self, zin, zout, info):
+        """ copy a member's local header, compressed data (and data descriptor) byte for byte into the new zip
+            note: zipfile has no public api for this, so we append the bytes to zout's stream and register the
+                  ZipInfo in zout's central directory ourselves
+            :return: False (with nothing written) if the member's local header doesn't look right
+        """
+        # step 1: size up the member's local header (file name and extra field lengths can differ from the central dir)
+        zin.fp.seek(info.header_offset)
+        local_header = zin.fp.read(zipfile.sizeFileHeader)
+        if len(local_header) != zipfile.sizeFileHeader:
+            return False
+        fh = struct.unpack(zipfile.structFileHeader, local_header)
+        if fh[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            return False
+        name_len = fh[zipfile._FH_FILENAME_LENGTH]
+        extra = zin.fp.read(name_len + fh[zipfile._FH_EXTRA_FIELD_LENGTH])[name_len:]
+        length = name_len + len(extra) + info.compress_size
+
+        # step 2: members written with a data descriptor (flag bit 3) have crc & sizes trailing the data ... with
+        #         an optional signature, and 8 byte sizes when the local header has a zip64 extra record (or when the
+        #         sizes don't fit in 4 bytes, for writers that leave the zip64 record out of the local header)
+        if info.flag_bits & 0x08:
+            zin.fp.seek(info.header_offset + zipfile.sizeFileHeader + length)
+            has_sig = zin.fp.read(4) == b'PK\x07\x08'
+            is_zip64 = self.has_zip64_extra(extra) or max(info.file_size, info.compress_size) > zipfile.ZIP64_LIMIT
+            length += (4 if has_sig else 0) + (20 if is_zip64 else 12)
+        zin.fp.seek(info.header_offset + zipfile.sizeFileHeader)
+
+        # step 3: stream the bytes over
+        new_info = copy.copy(info)
+        zout.fp.seek(zout.start_dir)
+        new_info.header_offset = zout.fp.tell()
+        zout.fp.write(local_header)
+        while length > 0:
+            chunk = zin.fp.read(min(self.chunk_size, length))
+            if not chunk:
+                raise IOError("{} is truncated in {}".format(info.filename, self.zip_path))
+            zout.fp.write(chunk)
+            length -= len(chunk)
+
+        # step 4: add the member to the new zip's central directory
+        zout.filelist.append(new_info)
+        zout.NameToInfo[new_info.filename] = new_info
+        zout.start_dir = zout.fp.tell()
+        zout._didModify = True
+        return True
@@ -0,0 +1,162 @@
+import io
+import csv
+import time
+import shutil
+import zipfile
+import tempfile
+
+from sqlalchemy import literal, text
+
+from gtfsdb import Database
+from gtfsdb import config as gtfsdb_config
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class BulkLoader(object):
+    """
+    load a gtfs.zip into a (PostgreSQL) gtfsdb schema, streaming the big tables (stop_times.txt, shapes.txt, etc...)
+    straight out of the zip with COPY FROM STDIN, rather than thru gtfsdb's ORM row-by-row inserts
+
+    the bulk tables are:
+     1. COPY'd (as text) into an UNLOGGED staging table
+     2. cleaned up & cast into gtfsdb's own table with one INSERT ... SELECT, following gtfsdb's make_record() rules:
+        values are trimmed, blanks become NULL, H:MM:SS times get a leading zero, missing columns get their defaults
+        and geometry (e.g., shapes.geom) is built from the lat/lon columns
+     3. indexed after the load (the table's indexes are dropped before the INSERT, and rebuilt after)
+
+    every other table is loaded by gtfsdb as usual, and gtfsdb's post-processing runs after all tables are loaded, so
+    the resulting schema is the same as a database_load() schema (@see GtfsdbExporter.dump and the current tables)
+    """
+    feed_path = None
+    bulk_tables = ['stop_times.txt', 'shapes.txt']
+
+    # geometry columns we build after the load: {table name: (lon column, lat column)}
+    geom_columns = {
+        'shapes': ('shape_pt_lon', 'shape_pt_lat'),
+        'stops': ('stop_lon', 'stop_lat'),
+    }
+
+    def __init__(self, feed_path, bulk_tables=None):
+        self.feed_path = feed_path
+        if bulk_tables:
+            self.bulk_tables = bulk_tables
+
+    def load(self, **kwargs):
+        """
+        same as gtfsdb.api.database_load(), but with the bulk tables COPY'd into the db
+        :param kwargs: gtfsdb Database args (@see GtfsdbLoader.get_gtfsdb_args)
+        :return: gtfsdb Database
+        """
+        start = time.time()
+
+        # step 1: create the gtfsdb schema and tables
+        db = Database(**kwargs)
+        if not db.is_postgresql:
+            raise ValueError("bulk loading needs a PostgreSQL database, not {}".format(db.dialect_name))
+        db.create()
+
+        # step 2: unzip everything but the bulk tables for gtfsdb to load (the bulk tables are streamed from the zip)
+        gtfs_directory = tempfile.mkdtemp()
+        try:
+            with zipfile.ZipFile(self.feed_path) as z:
+                for m in z.namelist():
+                    if m not in self.bulk_tables:
+                        z.extract(m, gtfs_directory)
+
+                # step 3: load the tables, in gtfsdb's order
+                for cls in db.sorted_classes:
+                    if cls.filename in self.bulk_tables and cls.datasource == gtfsdb_config.DATASOURCE_GTFS:
+                        if cls.filename in z.namelist():
+                            self.copy_table(db, cls, z)
+                    else:
+                        cls.load(db, gtfs_directory=gtfs_directory, **kwargs)
+        finally:
+            shutil.rmtree(gtfs_directory)
+
+        # step 4: gtfsdb's post processing (derived tables, current tables, etc...)
+        db.postprocess_tables(**kwargs)
+        log.info("bulk loaded {} in {:.1f} seconds".format(self.feed_path, time.time() - start))
+        return db
+
+    @classmethod
+    def read_header(cls, f):
+        """ :return: gtfs column names (stripped & lower-cased, like gtfsdb) from the first line of the csv stream
+        """
+        return [c.strip().lower() for c in next(csv.reader([f.readline()]), [])]
+
+    def copy_table(self, db, orm_cls, zip_file):
+        """ stream a table from the gtfs.zip into gtfsdb's table, via COPY into an unlogged staging table
+        """
+        start = time.time()
+        table = orm_cls.__table__
+        preparer = db.engine.dialect.identifier_preparer
+        target = preparer.format_table(table)
+        staging = preparer.quote(table.name + '_staging')
+        if table.schema:
+            staging = "{}.{}".format(preparer.quote_schema(table.schema), staging)
+
+        with db.engine.begin() as conn:
+            cursor = conn.connection.cursor()
+            with io.TextIOWrapper(zip_file.open(orm_cls.filename), encoding='utf-8-sig', newline='') as f:
+                # step 1: an UNLOGGED text staging table, with a column per column in the csv header
+                header = self.read_header(f)
+                stage_cols = ["c{}".format(i) for i in range(len(header))]
+                cursor.execute("DROP TABLE IF EXISTS {}".format(staging))
+                cursor.execute("CREATE UNLOGGED TABLE {} ({})".format(staging, ", ".join("{} text".format(c) for c in stage_cols)))
+
+                # step 2: COPY the rest of the csv stream (the rows) into staging
+                cursor.copy_expert("COPY {} FROM STDIN WITH (FORMAT csv)".format(staging), f)
+                log.info("copied {} rows into {} in {:.1f} seconds".format(cursor.rowcount, staging, time.time() - start))
+
+            # step 3: drop the indexes, so they're built once (after the insert) rather than row by row
+            indexes = list(table.indexes)
+            for i in indexes:
+                i.drop(bind=conn)
+
+            # step 4: clean, cast and insert the staged rows into the gtfsdb table
+            columns, values = self.make_insert_columns(db, table, header)
+            cursor.execute("INSERT INTO {} ({}) SELECT {} FROM {}".format(
+                target, ", ".join(preparer.quote(c) for c in columns), ", ".join(values), staging))
+            num_rows = cursor.rowcount
+            cursor.execute("DROP TABLE {}".format(staging))
+
+            # step 5: rebuild the indexes
+            for i in indexes:
+                i.create(bind=conn)
+
+        # step 6: fresh planner stats for the new table
+        with db.engine.begin() as conn:
+            conn.execute(text("ANALYZE {}".format(target)))
+        log.info("bulk loaded {} rows into {} in {:.1f} seconds".format(num_rows, target, time.time() - start))
+
+    def make_insert_columns(self, db, table, header):
+        """
+        :return: list of target column names, and a list of matching sql expressions that clean & cast the text
+                 staging columns in the same way gtfsdb's make_record() would clean up the row
+        """
+        columns = []
+        values = []
+        dialect = db.engine.dialect
+        geom = self.geom_columns.get(table.name)
+        for c in table.columns:
+            if c.name == 'geom':
+                # geometry from the staged lon/lat columns
+                if geom and geom[0] in header and geom[1] in header:
+                    lon = "NULLIF(btrim(c{}), '')::float".format(header.index(geom[0]))
+                    lat = "NULLIF(btrim(c{}), '')::float".format(header.index(geom[1]))
+                    srid = getattr(c.type, 'srid', gtfsdb_config.SRID)
+                    columns.append(c.name)
+                    values.append("ST_SetSRID(ST_MakePoint({}, {}), {})".format(lon, lat, srid))
+            elif c.name in header:
+                v = "NULLIF(btrim(c{}), '')".format(header.index(c.name))
+                if c.name.endswith('_time'):
+                    v = "CASE WHEN substr({0}, 2, 1) = ':' THEN '0' || {0} ELSE {0} END".format(v)
+                columns.append(c.name)
+                values.append("CAST({} AS {})".format(v, c.type.compile(dialect=dialect)))
+            elif c.default is not None and c.default.is_scalar:
+                columns.append(c.name)
+                default = literal(c.default.arg, type_=c.type)
+                values.append(str(default.compile(dialect=dialect, compile_kwargs={'literal_binds': True})))
+        return columns, values
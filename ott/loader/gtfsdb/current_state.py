@@ -0,0 +1,110 @@
+import os
+import json
+import hashlib
+import datetime
+
+from sqlalchemy import text
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class CurrentState(object):
+    """
+    tracks what a schema's current tables (current_routes, current_stops and current_route_stops) were last built from,
+    so the daily GtfsdbLoader.current_load can skip schemas where nothing that feeds those tables has changed
+
+    the current tables list what's active 'today', where gtfsdb says a route is active when today falls between the
+    first and last service dates (universal_calendar) of its trips.  so the state saved per schema is:
+      - a fingerprint of the loaded data (row counts and feed version), which changes on most new loads / restores
+      - the set of routes active on the date of the last build, which changes as service days enter and expire
+      - each route's first & last service dates, so a daily run on unchanged data can work out the active routes
+        without joining every trip to universal_calendar again
+
+    note: the fingerprint can miss a reload that edits stops or routes, but keeps the same counts (and feed_info
+          version) ... so GtfsdbLoader clears the state whenever it loads, restores or swaps a schema live
+
+    note: gtfsdb only knows how to rebuild the current tables from scratch, so when either changes we do a full rebuild
+    """
+    state_ext = ".current.json"
+
+    def __init__(self, engine, schema, state_dir):
+        self.engine = engine
+        self.schema = schema
+        self.state_path = os.path.join(state_dir, schema + self.state_ext)
+        self.new_state = None
+
+    def q(self, table):
+        return "{}.{}".format(self.engine.dialect.identifier_preparer.quote(self.schema), table)
+
+    def query_fingerprint(self, conn):
+        counts = []
+        for t in ('routes', 'trips', 'stops', 'universal_calendar'):
+            counts.append(conn.execute(text("SELECT count(*) FROM {}".format(self.q(t)))).scalar())
+        version = None
+        try:
+            version = conn.execute(text("SELECT max(feed_version) FROM {}".format(self.q('feed_info')))).scalar()
+        except Exception:
+            pass
+        return "{}:{}".format(version, counts)
+
+    def query_route_dates(self, conn):
+        """ :return: dict of each route's first & last service dates (as ISO strings), from its trips' universal_calendar
+        """
+        sql = "SELECT t.route_id, min(u.date), max(u.date) FROM {} t JOIN {} u ON u.service_id = t.service_id " \
+              "GROUP BY t.route_id".format(self.q('trips'), self.q('universal_calendar'))
+        return dict((r[0], [str(r[1]), str(r[2])]) for r in conn.execute(text(sql)))
+
+    @classmethod
+    def get_active_routes(cls, route_dates, date):
+        """ same active test as gtfsdb's Route.is_active(): first service date <= date <= last service date """
+        d = date.isoformat()
+        return sorted(r for r, (first, last) in route_dates.items() if first <= d <= last)
+
+    def load(self):
+        ret_val = None
+        try:
+            if os.path.exists(self.state_path):
+                with open(self.state_path) as f:
+                    ret_val = json.load(f)
+        except Exception as e:
+            log.warning("can't read {}: {}".format(self.state_path, e))
+        return ret_val
+
+    def is_unchanged(self, date=None):
+        """ :return: True if the current tables were built from the same data & active routes we'd build them from now
+        """
+        date = date or datetime.date.today()
+        old_state = self.load()
+        with self.engine.connect() as conn:
+            fingerprint = self.query_fingerprint(conn)
+            if old_state and old_state.get('fingerprint') == fingerprint and 'route_dates' in old_state:
+                route_dates = old_state['route_dates']
+            else:
+                route_dates = self.query_route_dates(conn)
+
+        routes = self.get_active_routes(route_dates, date)
+        self.new_state = {
+            'date': date.isoformat(),
+            'fingerprint': fingerprint,
+            'active_routes': hashlib.sha1(",".join(routes).encode('utf-8')).hexdigest(),
+            'num_active_routes': len(routes),
+            'route_dates': route_dates
+        }
+
+        ret_val = old_state is not None and \
+            old_state.get('fingerprint') == self.new_state['fingerprint'] and \
+            old_state.get('active_routes') == self.new_state['active_routes']
+        if ret_val:
+            log.info("{} current tables are up to date (built {}, {} active routes)".format(self.schema, old_state.get('date'), len(routes)))
+        return ret_val
+
+    def save(self):
+        if self.new_state:
+            with open(self.state_path, 'w') as f:
+                json.dump(self.new_state, f)
+
+    def clear(self):
+        """ forget the saved state (e.g., after the schema is reloaded or restored) """
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
@@ -1,9 +1,10 @@
 from ott.utils import file_utils
-from ott.utils import web_utils
 from ott.utils import exe_utils
 from ott.utils import db_utils
 
 from .gtfsdb_loader import GtfsdbLoader
+from . import schema_utils
+from ott.loader.deploy.transfer import Transfer, TransferReport
 
 import logging
 log = logging.getLogger(__file__)
@@ -29,52 +30,35 @@ class GtfsdbExporter(GtfsdbLoader):
         try:
             feed_name = self.get_feed_name(feed)
             dump_path = self.get_dump_path(feed_name)
-            dump_exe = self.config.get('dump', section='db').format(schema=feed_name, dump_file=dump_path)
-            log.info(dump_exe)
-            exe_utils.run_cmd(dump_exe, shell=True)
+
+            # blue/green: dump the shadow <feed>_next schema, which restore_feed() then checks & swaps live
+            schema = feed_name
+            if self.blue_green and schema_utils.schema_exists(schema_utils.get_engine(self.db_url), self.get_load_schema(feed)):
+                schema = self.get_load_schema(feed)
+
+            if self.pg_jobs > 0:
+                self.get_pg_dumper().dump(schema, dump_path)
+            else:
+                dump_exe = self.config.get('dump', section='db').format(schema=schema, dump_file=dump_path)
+                log.info(dump_exe)
+                exe_utils.run_cmd(dump_exe, shell=True)
         except Exception as e:
             ret_val = False
             log.error("DB DUMP ERROR {} : {}".format(feed_name, e))
         return ret_val
 
-    def _scp_dump_file(self, feed, server, user):
+    def get_scp_dump_path(self, feed):
         """
-        scp gtfsdb dump file to a a given server.
-        :returns path to the dump file
+        :returns path to the feed's dump file, if it's there and big enough to be worth sending to the servers
         """
         ret_val = None
-
-        # step 1: create file paths to dump files locally, and also path where we'll scp these files
-        feed_name = self.get_feed_name(feed)
-        dump_path = self.get_dump_path(feed_name)
-        gtfsdb_dir = self.config.get('gtfsdb_dir', section='deploy')
-
-        # step 2: we are going to attempt to scp the dump file over to the server
-        #         note: the server paths (e.g., graph_svr, etc...) are relative to the user's home account
-        if file_utils.exists(dump_path):
-            if file_utils.is_min_sized(dump_path, 200000):
-                ret_val = dump_path
-
-                scp = None
-                try:
-                    scp, ssh = web_utils.scp_client(host=server, user=user)
-
-                    mkdir = "mkdir -p ~/{}".format(gtfsdb_dir)
-                    log.info("ssh {} on {}@{}".format(mkdir, user, server))
-                    ssh.exec_command(mkdir)
-
-                    log.info("scp {} over to {}@{}:~/{}/".format(dump_path, user, server, gtfsdb_dir))
-                    scp.put(dump_path, gtfsdb_dir)
-                except Exception as e:
-                    log.warn("{} -- feed={}, server={}, user={}".format(e, feed_name, server, user))
-                    ret_val = False
-                finally:
-                    if scp:
-                        scp.close()
-            else:
-                log.warn("{} is suspiciously SMaLl, so *not* going SCP it to {}".format(dump_path, server))
+        dump_path = self.get_dump_path(self.get_feed_name(feed))
+        if not file_utils.exists(dump_path):
+            log.warn("{} doesn't exit, so *not* going to SCP it".format(dump_path))
+        elif not file_utils.is_min_sized(dump_path, 200000):
+            log.warn("{} is suspiciously SMaLl, so *not* going SCP it".format(dump_path))
         else:
-            log.warn("{} doesn't exit, so *not* going to SCP it to {}".format(dump_path, server))
+            ret_val = dump_path
         return ret_val
 
     def check_feeds(self, feeds):
@@ -88,42 +72,62 @@ class GtfsdbExporter(GtfsdbLoader):
     @classmethod
     def scp(cls, feeds=None, filter=None, rm_after_scp=True):
         """
-        loop thru servers in app.ini [deploy], looking to scp the pg_dump file over to production
-        :returns number of feeds that were scp'd
+        loop thru servers in app.ini [deploy], looking to scp the pg_dump files over to production
+        all the servers are loaded at once (up to [deploy] transfer_workers), over one ssh session per server,
+        and each upload is verified with a checksum (@see ott.loader.deploy.transfer)
+        :returns TransferReport of the per-server, per-dump results (report.files_ok() are the dumps that were scp'd)
         """
-        ret_val = 0
         exporter = GtfsdbExporter()
         user = exporter.config.get('user', section='deploy')
-        for feed in exporter.check_feeds(feeds):
-            dump_path = None
-            num_scp = 0
+        gtfsdb_dir = exporter.config.get('gtfsdb_dir', section='deploy')
+        prod_servers = exporter.config.get_json('servers', section='deploy')
+        servers = [s for s in prod_servers if filter is None or filter == 'all' or filter in s]
 
-            # scp the feed to the configured servers
-            prod_servers = exporter.config.get_json('servers', section='deploy')
-            for server in prod_servers:
-                if filter is None or filter == 'all' or filter in server:
-                    dump_path = exporter._scp_dump_file(feed, server, user)
-                    if dump_path:
-                        num_scp += 1
+        # step 1: find the dump files to send
+        dumps = []
+        for feed in exporter.check_feeds(feeds):
+            dump_path = exporter.get_scp_dump_path(feed)
+            if dump_path:
+                dumps.append((feed, dump_path))
+        if len(dumps) == 0 or len(servers) == 0:
+            return TransferReport()
+
+        # step 2: send all the dumps to all the servers
+        workers = int(exporter.config.get('transfer_workers', section='deploy', def_val=4))
+        verify = exporter.config.get_bool('verify_transfers', section='deploy', def_val=True)
+        delta = exporter.config.get_bool('delta_transfers', section='deploy', def_val=False)
+        transfer = Transfer(user, servers, max_workers=workers, verify=verify, delta=delta)
+        report = transfer.upload([d for f, d in dumps], gtfsdb_dir)
+
+        for feed, dump_path in dumps:
+            num_scp = len(report.servers_ok(dump_path))
 
             # move the dump.tar aside (but don't delete it), so it doesn't repeatedly get scp'd
-            if dump_path and rm_after_scp:
+            if num_scp > 0 and rm_after_scp:
                 file_utils.mv(dump_path, dump_path + "-did_scp")
 
             # report on number of times we scp'd to different servers, etc...
             if num_scp > 0:
-                ret_val += 1  # number of feeds scp'd
-                num_servers = len(prod_servers)
+                num_servers = len(servers)
                 feed_name = exporter.get_feed_name(feed)
                 if num_scp != num_servers:
                     log.warn("Tried to scp feed {} to {} production servers, but only able to scp {} times.".format(
                         feed_name,
                         num_servers,
-                        num_dumped
+                        num_scp
                     ))
                 else:
                     log.info("successfully scp'd feed {} to {} production servers".format(feed_name, num_servers))
-        return ret_val
+        return report
+
+    @classmethod
+    def scp_cmd(cls):
+        """
+        bin/gtfsdb_scp entry point: scp the pg_dump files to the servers in app.ini [deploy]
+        :returns exit status ... 0 when every upload made it (or there was nothing to send), else 1
+        """
+        report = cls.scp()
+        return 1 if len(report.failed()) > 0 else 0
 
     @classmethod
     def dump(cls, feeds=None, filter=None, clean_db=True):
@@ -175,8 +179,10 @@ class GtfsdbExporter(GtfsdbLoader):
         num_dumped = cls.dump(filter=p.agency_id, clean_db=p.clear)
 
         # step 3: scp feed(s)
+        num_scpd = 0
         if num_dumped > 0:
-            num_scpd = cls.scp(filter=p.server)
+            report = cls.scp(filter=p.server)
+            num_scpd = len(report.files_ok())
 
         if num_dumped != num_scpd:
             log.warn("There were {} feeds dumped, but only {} feeds were scp'd.".format(num_dumped, num_scpd))
@@ -6,12 +6,25 @@ from ott.utils import file_utils
 from ott.utils.parse.cmdline import gtfs_cmdline
 from ott.utils.cache_base import CacheBase
 from ott.loader.gtfs.gtfs_cache import GtfsCache
+from ott.loader.gtfs.diff import ChangeSet
+from ott.loader.gtfs.coverage import ServiceCoverage
+from ott.loader.gtfsdb.bulk_loader import BulkLoader
+from ott.loader.gtfsdb.preflight import Preflight
+from ott.loader.gtfsdb.pg_dumper import PgDumper
+from ott.loader.gtfsdb.current_state import CurrentState
+from ott.loader.gtfsdb.link_feeds import LinkFeeds
+from ott.loader.gtfsdb import schema_utils
 from ott.loader.gtfsdb_realtime.gtfsdb_realtime_loader import GtfsdbRealtimeLoader
 
 from gtfsdb.api import database_load
 from gtfsdb import scripts
 
 import os
+import time
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
 import logging
 log = logging.getLogger(__file__)
 
@@ -24,6 +37,12 @@ class GtfsdbLoader(CacheBase):
     db_url = None
     is_geospatial = False
     current_tables = True
+    load_workers = 1
+    bulk_load = False
+    bulk_tables = None
+    blue_green = False
+    pg_jobs = 0
+    restore_feeds = 1
     err_ext = "-error_loading"
 
     def __init__(self, feed_filter="all"):
@@ -32,6 +51,12 @@ class GtfsdbLoader(CacheBase):
         self.db_url = self.config.get('url', section='db', def_val='postgresql+psycopg2://ott@127.0.0.1:5432/ott')
         self.is_geospatial = self.config.get_bool('is_geospatial', section='db')
         self.current_tables = self.config.get_bool('current_tables', section='db', def_val=True)
+        self.load_workers = int(self.config.get('load_workers', section='db', def_val=self.load_workers))
+        self.bulk_load = self.config.get_bool('bulk_load', section='db', def_val=False)
+        self.bulk_tables = self.config.get_list('bulk_tables', section='db', def_val='stop_times.txt, shapes.txt')
+        self.blue_green = self.config.get_bool('blue_green', section='db', def_val=False)
+        self.pg_jobs = int(self.config.get('pg_jobs', section='db', def_val=self.pg_jobs))
+        self.restore_feeds = int(self.config.get('restore_feeds', section='db', def_val=self.restore_feeds))
 
     @classmethod
     def get_feed_name(cls, feed):
@@ -45,14 +70,23 @@ class GtfsdbLoader(CacheBase):
     def get_dump_path(self, feed_name):
         return "{}/{}.tar".format(self.cache_dir, feed_name)
 
-    def get_gtfsdb_args(self, feed, current_tables=False):
+    def get_load_schema(self, feed):
+        """ :return: schema we load a feed into ... the shadow <feed>_next schema when in blue_green mode
+        """
+        feed_name = self.get_feed_name(feed)
+        if self.blue_green:
+            feed_name = feed_name + schema_utils.NEXT_EXT
+        return feed_name
+
+    def get_gtfsdb_args(self, feed, current_tables=False, schema=None):
         """
         get the Database(kwargs) for gtfsdb from the feed
 
         :param feed: see app.ini [gtfs] section
+        :param schema: override the feed's schema name (e.g., to load the blue/green shadow schema)
         :return: hash table of args for gtfsdb
         """
-        feed_name = self.get_feed_name(feed)
+        feed_name = schema or self.get_feed_name(feed)
 
         kwargs = {}
         kwargs['url'] = self.db_url
@@ -73,18 +107,64 @@ class GtfsdbLoader(CacheBase):
         feed_name = self.get_feed_name(feed)
 
         # step 2: make args for gtfsdb
-        kwargs = self.get_gtfsdb_args(feed)
+        schema = self.get_load_schema(feed)
+        kwargs = self.get_gtfsdb_args(feed, schema=schema)
 
         # step 3: load this feed into gtfsdb
         log.info("loading {} ({}) into gtfsdb {}".format(feed_name, feed_path, self.db_url))
         try:
-            database_load(feed_path, **kwargs)
+            mode = self.config.get('coverage_check', section='gtfs', def_val='warn')
+            min_ratio = float(self.config.get('coverage_min_ratio', section='gtfs', def_val=0.25))
+            if not ServiceCoverage.is_feed_ok(feed_path, mode, min_ratio):
+                raise ValueError("{} has dates without (enough) service".format(feed_path))
+
+            if self.blue_green:
+                schema_utils.drop_schema(schema_utils.get_engine(self.db_url), schema)
+            if self.bulk_load and "postgres" in self.db_url:
+                BulkLoader(feed_path, self.bulk_tables).load(**kwargs)
+            else:
+                database_load(feed_path, **kwargs)
+
+            # step 4: blue/green loads get checked before they can be swapped live (@see promote_feed)
+            if self.blue_green and not self.preflight(feed, schema):
+                raise ValueError("schema {} failed its preflight checks".format(schema))
+            if not self.blue_green:
+                self.clear_current_state(feed)
         except Exception as e:
             ret_val = False
             file_utils.mv(feed_path, feed_path + self.err_ext)
             log.error("DATABASE ERROR : {}".format(e))
         return ret_val
 
+    def preflight(self, feed, schema):
+        """ check a newly loaded schema (row counts vs. the live schema, trips on each of the coming days, etc...)
+        """
+        p = Preflight(
+            schema_utils.get_engine(self.db_url), schema, live_schema=self.get_feed_name(feed),
+            num_days=int(self.config.get('preflight_days', section='db', def_val=14)),
+            max_drop=float(self.config.get('preflight_max_drop', section='db', def_val=0.5))
+        )
+        return p.check()
+
+    def promote_feed(self, feed):
+        """ blue/green: swap the feed's <feed>_next schema live (in a single transaction), keeping <feed>_old for rollback
+        """
+        ret_val = True
+        feed_name = self.get_feed_name(feed)
+        try:
+            schema_utils.swap_schemas(schema_utils.get_engine(self.db_url), feed_name)
+            self.clear_current_state(feed)
+        except Exception as e:
+            ret_val = False
+            log.error("SCHEMA SWAP ERROR {} : {}".format(feed_name, e))
+        return ret_val
+
+    def clear_current_state(self, feed):
+        """ the feed's live schema has new data, so make the next current_load rebuild its current tables
+            (even when the row counts & feed version match the last build ... @see CurrentState)
+        """
+        CurrentState(schema_utils.get_engine(self.db_url), self.get_feed_name(feed), self.cache_dir).clear()
+
     def check_db(self, force_update=False):
         """
         check the local cache of GTFS feeds, and decide whether we should reload a given feed based on feed info
@@ -97,8 +177,8 @@ class GtfsdbLoader(CacheBase):
         for f in self.feeds:
             reload = False
 
-            # step 2: see if the GTFS cache has a newer feed than what we have in this GTFS-DB cache
-            if GtfsCache.compare_feed_against_cache(f, self.cache_dir, force_update):
+            # step 2: see if the GTFS cache has a newer feed (with changes to its tables) than what we have in this GTFS-DB cache
+            if GtfsCache.compare_feed_against_cache(f, self.cache_dir, force_update, ChangeSet.affects_db):
                 reload = True
 
             # step 3: okay, reload this GTFS feed into the database
@@ -110,13 +190,61 @@ class GtfsdbLoader(CacheBase):
                     file_utils.purge(self.cache_dir, ".*" + self.err_ext)
                     purged = True
 
-                # step 3b: load the feed into the database
-                self.load_feed(f)
                 export_list.append(f)
 
-        if len(export_list) > 0:
+        # step 4: load the feeds into the database (each feed into its own schema), and pg_dump them for export
+        #         note: blue/green loads are dumped from their shadow schema, and then swapped live
+        if len(export_list) > 1 and self.load_workers > 1:
+            self.load_feeds_in_parallel(export_list)
+        elif len(export_list) > 0:
+            loaded = [f for f in export_list if self.load_feed(f)]
             from .gtfsdb_exporter import GtfsdbExporter
-            GtfsdbExporter.dump(export_list, clean_db=True)
+            GtfsdbExporter.dump(export_list if not self.blue_green else loaded, clean_db=True)
+            if self.blue_green:
+                for f in loaded:
+                    self.promote_feed(f)
+
+        # step 5: re-link the shared stops & route intersects between the feeds (@see LinkFeeds)
+        if len(export_list) > 0 and self.config.get_bool('link_feeds', section='db', def_val=False):
+            try:
+                LinkFeeds.link_cached_feeds(self)
+            except Exception as e:
+                log.warning("couldn't link feeds: {}".format(e))
+
+    def load_feeds_in_parallel(self, feeds):
+        """
+        load feeds into their (separate) schemas with a pool of load_workers processes (see [db] in app.ini)
+        each feed is pg_dump'd as soon as its load finishes, while the other feeds keep loading
+        note: a feed that fails to load is isolated (renamed with err_ext, just like a serial load) and isn't dumped
+        note: the db cleanup a serial load runs before dumping (GtfsdbExporter.dump(clean_db=True)) runs once, up front,
+              since the per-feed dumps below start while other feeds are still loading
+        """
+        from .gtfsdb_exporter import GtfsdbExporter
+
+        db_utils.postgres_db_cleanup(self.db_url)
+        num_workers = min(self.load_workers, len(feeds))
+        log.info("loading {} feeds into gtfsdb with {} processes".format(len(feeds), num_workers))
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            loads = dict((pool.submit(load_feed_process, f), f) for f in feeds)
+            for l in as_completed(loads):
+                f = loads[l]
+                feed_name = self.get_feed_name(f)
+                try:
+                    success, secs = l.result()
+                except Exception as e:
+                    success, secs = False, 0
+                    feed_path = self.get_feed_path(f)
+                    if os.path.exists(feed_path):
+                        file_utils.mv(feed_path, feed_path + self.err_ext)
+                    log.error("DATABASE ERROR : load process for {} died: {}".format(feed_name, e))
+
+                if success:
+                    log.info("loaded {} in {:.1f} seconds ... now dumping it".format(feed_name, secs))
+                    GtfsdbExporter.dump(f, clean_db=False)
+                    if self.blue_green:
+                        self.promote_feed(f)
+                else:
+                    log.warning("{} didn't load, so not dumping it".format(feed_name))
 
     def restore_feed(self, feed, bkup="-processed"):
         """
@@ -129,7 +257,11 @@ class GtfsdbLoader(CacheBase):
         try:
             feed_name = self.get_feed_name(feed)
             dump_path = self.get_dump_path(feed_name)
-            if file_utils.exists(dump_path):
+            if file_utils.exists(dump_path) and self.dump_has_schema(dump_path, feed_name + schema_utils.NEXT_EXT):
+                # a dump of a blue/green build's <feed>_next schema is always restored & swapped live (even with
+                # blue_green off here), since the steps below would move <feed> aside, then restore into <feed>_next
+                ret_val = self.restore_feed_blue_green(feed, dump_path, bkup)
+            elif file_utils.exists(dump_path):
                 # step a: remove <schema>_OLD
                 rm_schema_exe = self.config.get('rm_schema', section='db').format(schema=feed_name)
                 log.info(rm_schema_exe)
@@ -141,9 +273,8 @@ class GtfsdbLoader(CacheBase):
                 exe_utils.run_cmd(mv_schema_exe, shell=True)
 
                 # step c: restore new data
-                restore_exe = self.config.get('restore', section='db').format(schema=feed_name, dump_file=dump_path)
-                log.info(restore_exe)
-                exe_utils.run_cmd(restore_exe, shell=True)
+                self.run_restore(feed_name, dump_path)
+                self.clear_current_state(feed)
 
                 # step d:
                 file_utils.mv(dump_path, dump_path + bkup)
@@ -154,17 +285,78 @@ class GtfsdbLoader(CacheBase):
             log.error("DB RESTORE ERROR {} : {}".format(feed_name, e))
         return ret_val
 
+    def restore_feed_blue_green(self, feed, dump_path, bkup="-processed"):
+        """
+        restore a dump of the shadow <feed>_next schema, check it, then swap it live ... the live schema keeps serving
+        queries the whole time (vs. the rm_schema / mv_schema / pg_restore window of the restore_feed() above)
+        """
+        ret_val = False
+        schema = self.get_feed_name(feed) + schema_utils.NEXT_EXT
+
+        # step a: clear out any stale shadow schema, then restore the dump (which creates <feed>_next)
+        schema_utils.drop_schema(schema_utils.get_engine(self.db_url), schema)
+        self.run_restore(schema, dump_path)
+
+        # step b: check the restored schema, and only then swap it live
+        if self.preflight(feed, schema):
+            ret_val = self.promote_feed(feed)
+        else:
+            log.error("restored schema {} failed its preflight checks, so leaving {} as is".format(schema, self.get_feed_name(feed)))
+
+        # step c:
+        file_utils.mv(dump_path, dump_path + bkup)
+        return ret_val
+
+    def get_pg_dumper(self):
+        return PgDumper(self.config.get('db_name', section='db'), self.pg_jobs)
+
+    def run_restore(self, schema, dump_path):
+        """ restore a dump: parallel pg_restore -j for packed directory format dumps (@see PgDumper), else the
+            configured 'restore' command
+        """
+        if PgDumper.get_packed_schema(dump_path):
+            self.get_pg_dumper().restore(dump_path, self.cache_dir)
+        else:
+            restore_exe = self.config.get('restore', section='db').format(schema=schema, dump_file=dump_path)
+            log.info(restore_exe)
+            exe_utils.run_cmd(restore_exe, shell=True)
+
+    @classmethod
+    def dump_has_schema(cls, dump_path, schema):
+        """ :return: True if the pg_dump file (per its table of contents) creates the given schema
+        """
+        ret_val = False
+        packed_schema = PgDumper.get_packed_schema(dump_path)
+        if packed_schema:
+            return packed_schema == schema
+        try:
+            toc = subprocess.check_output(['pg_restore', '-l', dump_path]).decode('utf-8', 'replace')
+            ret_val = " SCHEMA - {} ".format(schema) in toc
+        except Exception as e:
+            log.warning("can't list the contents of {}: {}".format(dump_path, e))
+        return ret_val
+
+    @classmethod
+    def rollback(cls):
+        """ blue/green: swap the <feed>_old schema(s) back live (e.g., bin/gtfsdb_rollback -a TRIMET) """
+        args = gtfs_cmdline.gtfs_parser('bin/gtfsdb_rollback')
+        db = GtfsdbLoader(args.agency_id)
+        engine = schema_utils.get_engine(db.db_url)
+        for f in db.feeds:
+            if schema_utils.rollback_schema(engine, db.get_feed_name(f)):
+                db.clear_current_state(f)
+
     @classmethod
     def restore(cls):
         """ run pg_restore on any existing pg_dump cache/*.tar files """
 
-        # step 1: restore the gtfsdb feed
+        # step 1: restore the gtfsdb feeds (restore_feeds of them at a time)
         create_rt_tables = False
         db = GtfsdbLoader()
-        for f in db.feeds:
-            new_load = db.restore_feed(f)
-            if new_load:
-                create_rt_tables = True
+        with ThreadPoolExecutor(max_workers=max(db.restore_feeds, 1)) as pool:
+            for new_load in pool.map(db.restore_feed, db.feeds):
+                if new_load:
+                    create_rt_tables = True
 
         # step 2: re-create the RT tables on new db refresh
         if create_rt_tables:
@@ -191,6 +383,32 @@ class GtfsdbLoader(CacheBase):
         #import pdb; pdb.set_trace()
         args = gtfs_cmdline.gtfs_parser('bin/gtfsdb_current_load')
         db = GtfsdbLoader(args.agency_id)
+        incremental = db.config.get_bool('incremental_current', section='db', def_val=True) and "postgres" in db.db_url
         for f in db.feeds:
             kwargs = db.get_gtfsdb_args(f, current_tables=True)
+
+            # skip the rebuild when the schema's data and its set of active routes haven't changed since the last build
+            state = None
+            if incremental:
+                state = CurrentState(schema_utils.get_engine(db.db_url), db.get_feed_name(f), db.cache_dir)
+                try:
+                    if not args.force and state.is_unchanged():
+                        continue
+                except Exception as e:
+                    log.warning("can't check the current table state of {}: {}".format(db.get_feed_name(f), e))
+                    state = None
+
             scripts.current_tables_load(**kwargs)
+            if state:
+                state.save()
+
+
+def load_feed_process(feed):
+    """
+    process pool entry point (@see GtfsdbLoader.load_feeds_in_parallel): load a single feed into its gtfsdb schema
+    :return: success flag and load time in seconds
+    """
+    start = time.time()
+    db = GtfsdbLoader()
+    success = db.load_feed(feed)
+    return success, time.time() - start
@@ -3,7 +3,7 @@ SHARED STOPS TABLE
 shared_stop_id (seq), stop_id, agency_id, agency_stop_id, agency_db_schema, distance
 
 ROUTE INTERSECTS TABLE
-route_id, agency_id, agency_route_id, agency_db_schema, closest_shared_stop_id
+route_id, agency_id, agency_route_id, agency_db_schema, shared_stop_id
 (is this table really necessary? )
 
 Between 2 different GTFS feeds (e.g., TriMet and SMART, or TriMet and C-Tran, etc...) there are a handful of shared
@@ -19,8 +19,221 @@ https://github.com/laidig/transloc-gtfs-rectifier/blob/master/recitfy_gtfs.py#L3
 
 """
 
+import os
+import math
+import zipfile
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, Float, text
+
+from ott.loader.gtfs.zip_rewriter import ZipRewriter
+from ott.loader.gtfsdb import schema_utils
+
+import logging
+log = logging.getLogger(__file__)
+
+
 class LinkFeeds(object):
     """
+    find the shared stops (stops within distance meters of a stop in another feed) and the routes serving those stops
+    across all the cached gtfs feeds, and bulk write them into the SHARED STOPS and ROUTE INTERSECTS tables above
+
+    the stops of all the feeds go into a grid hash (cells of distance meters), so each stop is only measured against
+    the stops in its own and neighboring cells ... near-linear, vs. comparing every stop to every other feed's stops
+
+    notes:
+     - shared stops are grouped (a stop near two other stops puts all three in one group), and each group gets a
+       shared_stop_id ... stop_id is the group's first stop, and distance is each stop's distance from that stop
+     - route intersects has a row per route and shared stop it serves (so routes touching each other share a shared_stop_id)
     """
-    def __init__(self):
-        pass
+    earth_radius = 6371008.8
+
+    def __init__(self, feeds, distance=50.0):
+        """
+        :param feeds: list of (gtfs zip path, agency_db_schema) tuples
+        :param distance: max meters between two stops in different feeds for them to be 'shared'
+        """
+        self.feeds = feeds
+        self.distance = distance
+        self.stops = []   # (schema, agency_id, stop_id, lat, lon)
+        self.shared_stops = []
+        self.route_intersects = []
+
+    @classmethod
+    def haversine(cls, lat1, lon1, lat2, lon2):
+        p1, p2 = math.radians(lat1), math.radians(lat2)
+        dp = p2 - p1
+        dl = math.radians(lon2 - lon1)
+        a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+        return 2 * cls.earth_radius * math.asin(math.sqrt(a))
+
+    def read_stops(self):
+        """ read the stops (and agency id) of each feed straight from its zip """
+        self.stops = []
+        for gtfs_path, schema in self.feeds:
+            with zipfile.ZipFile(gtfs_path) as z:
+                agency_id = schema
+                if 'agency.txt' in z.namelist():
+                    header, rows = ZipRewriter.read_rows(z, 'agency.txt')
+                    row = next(rows, None)
+                    if row and 'agency_id' in header and row[header.index('agency_id')]:
+                        agency_id = row[header.index('agency_id')]
+
+                header, rows = ZipRewriter.read_rows(z, 'stops.txt')
+                id_i, lat_i, lon_i = header.index('stop_id'), header.index('stop_lat'), header.index('stop_lon')
+                for row in rows:
+                    try:
+                        self.stops.append((schema, agency_id, row[id_i], float(row[lat_i]), float(row[lon_i])))
+                    except ValueError:
+                        pass
+        log.info("read {} stops from {} feeds".format(len(self.stops), len(self.feeds)))
+
+    def find_pairs(self):
+        """
+        grid hash the stops, and measure each stop against the stops of other feeds in the 3x3 cells around it
+        :return: list of (stop index, stop index, meters) pairs
+        """
+        if len(self.stops) == 0:
+            return []
+
+        # step 1: cells are (at least) distance meters on a side, so any pair in range is in neighboring cells
+        #         (lon degrees shrink toward the poles, so size the cells for the stop furthest from the equator)
+        max_lat = max(abs(s[3]) for s in self.stops)
+        dlat = self.distance / (math.pi * self.earth_radius / 180.0)
+        dlon = dlat / max(math.cos(math.radians(min(max_lat, 89.0))), 0.01)
+        grid = {}
+        for i, s in enumerate(self.stops):
+            grid.setdefault((int(math.floor(s[3] / dlat)), int(math.floor(s[4] / dlon))), []).append(i)
+
+        # step 2: compare stops in neighboring cells (each pair once, and only across feeds)
+        ret_val = []
+        for (y, x), cell in grid.items():
+            for ny in (y - 1, y, y + 1):
+                for nx in (x - 1, x, x + 1):
+                    for j in grid.get((ny, nx), ()):
+                        for i in cell:
+                            if i < j and self.stops[i][0] != self.stops[j][0]:
+                                a, b = self.stops[i], self.stops[j]
+                                d = self.haversine(a[3], a[4], b[3], b[4])
+                                if d <= self.distance:
+                                    ret_val.append((i, j, d))
+        return ret_val
+
+    def group_pairs(self, pairs):
+        """ union the stop pairs into shared stop groups, and build the shared stop rows """
+        parent = {}
+
+        def find(i):
+            while parent.setdefault(i, i) != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i, j, d in pairs:
+            parent[find(max(i, j))] = find(min(i, j))
+
+        groups = {}
+        for i in sorted(parent):
+            groups.setdefault(find(i), []).append(i)
+
+        self.shared_stops = []
+        for shared_stop_id, root in enumerate(sorted(groups), 1):
+            first = self.stops[root]
+            for i in groups[root]:
+                s = self.stops[i]
+                self.shared_stops.append({
+                    'shared_stop_id': shared_stop_id, 'stop_id': first[2], 'agency_id': s[1], 'agency_stop_id': s[2],
+                    'agency_db_schema': s[0], 'distance': round(self.haversine(first[3], first[4], s[3], s[4]), 1)
+                })
+
+    def find_routes(self):
+        """ stream each feed's trips & stop_times, for the routes serving its shared stops """
+        self.route_intersects = []
+        for gtfs_path, schema in self.feeds:
+            shared = {}
+            for s in self.shared_stops:
+                if s['agency_db_schema'] == schema:
+                    shared[s['agency_stop_id']] = s
+            if len(shared) == 0:
+                continue
+
+            with zipfile.ZipFile(gtfs_path) as z:
+                header, rows = ZipRewriter.read_rows(z, 'trips.txt')
+                trip_i, route_i = header.index('trip_id'), header.index('route_id')
+                trip_routes = dict((r[trip_i], r[route_i]) for r in rows)
+
+                seen = set()
+                header, rows = ZipRewriter.read_rows(z, 'stop_times.txt')
+                trip_i, stop_i = header.index('trip_id'), header.index('stop_id')
+                for r in rows:
+                    s = shared.get(r[stop_i])
+                    route_id = trip_routes.get(r[trip_i])
+                    if s and route_id and (route_id, s['shared_stop_id']) not in seen:
+                        seen.add((route_id, s['shared_stop_id']))
+                        self.route_intersects.append({
+                            'agency_id': s['agency_id'], 'agency_route_id': route_id,
+                            'agency_db_schema': schema, 'shared_stop_id': s['shared_stop_id']
+                        })
+
+    def link(self):
+        self.read_stops()
+        pairs = self.find_pairs()
+        self.group_pairs(pairs)
+        self.find_routes()
+        log.info("found {} shared stop pairs, in {} groups served by {} routes".format(
+            len(pairs), len(set(s['shared_stop_id'] for s in self.shared_stops)), len(set((r['agency_db_schema'], r['agency_route_id']) for r in self.route_intersects))
+        ))
+
+    @classmethod
+    def make_tables(cls, schema=None):
+        metadata = MetaData()
+        shared_stops = Table(
+            'shared_stops', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('shared_stop_id', Integer, index=True, nullable=False),
+            Column('stop_id', String(255)),
+            Column('agency_id', String(255)),
+            Column('agency_stop_id', String(255), index=True),
+            Column('agency_db_schema', String(255)),
+            Column('distance', Float),
+            schema=schema
+        )
+        route_intersects = Table(
+            'route_intersects', metadata,
+            Column('route_id', Integer, primary_key=True),
+            Column('agency_id', String(255)),
+            Column('agency_route_id', String(255), index=True),
+            Column('agency_db_schema', String(255)),
+            Column('shared_stop_id', Integer, index=True),
+            schema=schema
+        )
+        return metadata, shared_stops, route_intersects
+
+    def save(self, db_url, schema=None):
+        """ (re)create the tables, and bulk insert the results in one transaction """
+        engine = schema_utils.get_engine(db_url)
+        metadata, shared_stops, route_intersects = self.make_tables(schema)
+        with engine.begin() as conn:
+            if schema:
+                conn.execute(text("CREATE SCHEMA IF NOT EXISTS {}".format(schema_utils.quote(engine, schema))))
+            metadata.drop_all(conn)
+            metadata.create_all(conn)
+            if self.shared_stops:
+                conn.execute(shared_stops.insert(), self.shared_stops)
+            if self.route_intersects:
+                conn.execute(route_intersects.insert(), self.route_intersects)
+        log.info("wrote {} shared stops and {} route intersects to {}".format(len(self.shared_stops), len(self.route_intersects), schema or db_url))
+
+    @classmethod
+    def link_cached_feeds(cls, loader):
+        """ link the feeds cached by a GtfsdbLoader, and write the tables to its db (@see GtfsdbLoader.check_db) """
+        feeds = []
+        for f in loader.feeds:
+            feed_path = loader.get_feed_path(f)
+            if os.path.exists(feed_path):
+                feeds.append((feed_path, loader.get_feed_name(f)))
+        if len(feeds) > 1:
+            distance = float(loader.config.get('link_distance', section='db', def_val=50.0))
+            schema = loader.config.get('link_schema', section='db', def_val='shared')
+            links = LinkFeeds(feeds, distance)
+            links.link()
+            links.save(loader.db_url, schema if "sqlite:" not in loader.db_url else None)
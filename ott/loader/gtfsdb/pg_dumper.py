@@ -0,0 +1,149 @@
+import os
+import re
+import time
+import shutil
+import tarfile
+import subprocess
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class PgDumper(object):
+    """
+    parallel pg_dump / pg_restore of a gtfsdb schema, using postgres' directory format (-Fd) and -j worker processes,
+    so the big tables (stop_times, shapes, etc...) dump and restore on their own cores
+
+    the dump directory is packed into a single (uncompressed ... the -Fd table files are already compressed) .tar for
+    transfer, with <schema>.dir as the tar's top level folder.  that's how get_packed_schema() tells these dumps apart
+    from the older pg_dump -F t archives (which have toc.dat at the top level)
+
+    the per-table timings are parsed from the -v output of pg_dump / pg_restore, and logged at the end of each run
+    """
+    item_re = re.compile(r"(launching|finished) item (\d+) (.*)$")
+    table_re = re.compile(r'dumping contents of table "(?:[^"]+\.)?([^"]+)"')
+    dir_ext = ".dir"
+
+    def __init__(self, db_name, jobs=4, db_args=None):
+        """
+        :param db_name: database to dump from / restore into
+        :param jobs: number of parallel pg_dump / pg_restore jobs (-j)
+        :param db_args: extra connection args (e.g., ['-U', 'ott', '-h', 'localhost'])
+        """
+        self.db_name = db_name
+        self.jobs = jobs
+        self.db_args = db_args or []
+
+    @classmethod
+    def get_packed_schema(cls, dump_path):
+        """ :return: schema name of a .tar'd directory format dump, or None for a pg_dump -F t .tar archive
+        """
+        ret_val = None
+        try:
+            with tarfile.open(dump_path) as t:
+                for m in t:
+                    if os.path.basename(m.name) == "toc.dat":
+                        if "/" in m.name:
+                            ret_val = m.name.split('/')[0][:-len(cls.dir_ext)]
+                        break
+        except Exception as e:
+            log.warning("can't read {}: {}".format(dump_path, e))
+        return ret_val
+
+    def dump(self, schema, dump_path):
+        """ pg_dump -Fd -j N the schema, and pack the dump directory into dump_path
+            :return: dict of {table item: seconds}
+        """
+        dump_dir = dump_path + self.dir_ext
+        self.rm(dump_dir)
+        try:
+            cmd = ['pg_dump', '-Fd', '-j', str(self.jobs), '-v', '-n', schema, '-f', dump_dir] + self.db_args + [self.db_name]
+            timings = self.run(cmd)
+
+            # pack the directory ... written to a .tmp file first, so a partial tar is never left at dump_path
+            with tarfile.open(dump_path + ".tmp", 'w') as t:
+                t.add(dump_dir, arcname=schema + self.dir_ext)
+            os.replace(dump_path + ".tmp", dump_path)
+        finally:
+            self.rm(dump_dir)
+            self.rm(dump_path + ".tmp")
+        return timings
+
+    def restore(self, dump_path, work_dir=None):
+        """ unpack a dump() .tar, and pg_restore -j N it
+            :return: dict of {table item: seconds}
+        """
+        work_dir = work_dir or os.path.dirname(os.path.abspath(dump_path))
+        unpack_dir = os.path.join(work_dir, os.path.basename(dump_path) + ".restore")
+        self.rm(unpack_dir)
+        try:
+            with tarfile.open(dump_path) as t:
+                dump_dir = self.check_members(t)
+                if hasattr(tarfile, 'data_filter'):
+                    t.extractall(unpack_dir, filter='data')
+                else:
+                    t.extractall(unpack_dir)
+            cmd = ['pg_restore', '-j', str(self.jobs), '-v', '-d', self.db_name] + self.db_args + [os.path.join(unpack_dir, dump_dir)]
+            return self.run(cmd)
+        finally:
+            self.rm(unpack_dir)
+
+    @classmethod
+    def check_members(cls, tar):
+        """ the dump .tar came over the network, so make sure it only holds plain files & folders, all under the one
+            top level <schema>.dir folder (no absolute paths, .. or links that could write outside the unpack dir)
+            :return: name of the top level folder
+        """
+        ret_val = None
+        for m in tar.getmembers():
+            parts = m.name.split('/')
+            if ret_val is None:
+                ret_val = parts[0]
+            if os.path.isabs(m.name) or '..' in parts or parts[0] != ret_val or not ret_val.endswith(cls.dir_ext):
+                raise ValueError("{} has an unexpected path in it: {}".format(tar.name, m.name))
+            if not (m.isfile() or m.isdir()):
+                raise ValueError("{} has a link or special file in it: {}".format(tar.name, m.name))
+        if ret_val is None:
+            raise ValueError("{} is empty".format(tar.name))
+        return ret_val
+
+    def run(self, cmd):
+        """
+        run pg_dump / pg_restore, timing each item from its start ('launching item' from pg_restore, or 'dumping
+        contents of table' from pg_dump) to its 'finished item' line in the -v output
+        :return: dict of {table item: seconds}
+        """
+        start = time.time()
+        log.info(" ".join(cmd))
+        timings = {}
+        launched = {}
+        p = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        for line in p.stderr:
+            line = line.strip()
+            now = time.time()
+            m = self.item_re.search(line)
+            t = self.table_re.search(line)
+            if t:
+                launched["TABLE DATA " + t.group(1)] = now
+            elif m:
+                state, item, desc = m.groups()
+                if state == 'launching':
+                    launched[item] = now
+                elif item in launched or desc in launched:
+                    timings[desc] = now - launched.get(item, launched.get(desc))
+            elif "error" in line.lower():
+                log.warning(line)
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+
+        for desc, secs in sorted(timings.items(), key=lambda t: -t[1]):
+            log.info("{:>8.1f} secs: {}".format(secs, desc))
+        log.info("{} finished in {:.1f} secs".format(cmd[0], time.time() - start))
+        return timings
+
+    @classmethod
+    def rm(cls, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
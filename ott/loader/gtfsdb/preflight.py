@@ -54,8 +54,81 @@ Thanks,
 
 """
 
+import datetime
+
+from sqlalchemy import text
+
+from ott.loader.gtfsdb import schema_utils
+
+import logging
+log = logging.getLogger(__file__)
+
+
 class Preflight(object):
     """ check the gtfsdb for proper tables and sizes
+
+        used to vet a freshly loaded (shadow) schema before it's swapped live (@see schema_utils.swap_schemas):
+         - the core gtfs tables have rows
+         - no table lost more than max_drop of its rows vs. the live schema
+         - every day in the next num_days has trips (the 'hole in the schedule' problems noted above)
     """
-    def __init__(self):
-        pass
+    required_tables = ['agency', 'routes', 'stops', 'trips', 'stop_times']
+    calendar_tables = ['calendar', 'calendar_dates']
+
+    def __init__(self, engine, schema, live_schema=None, num_days=14, min_trips=1, max_drop=0.5):
+        self.engine = engine
+        self.schema = schema
+        self.live_schema = live_schema
+        self.num_days = num_days
+        self.min_trips = min_trips
+        self.max_drop = max_drop
+        self.errors = []
+
+    def check_tables(self, counts):
+        for t in self.required_tables:
+            if counts.get(t, 0) <= 0:
+                self.errors.append("{}.{} is empty".format(self.schema, t))
+        if sum(counts.get(t, 0) for t in self.calendar_tables) <= 0:
+            self.errors.append("{} has no calendar or calendar_dates".format(self.schema))
+
+    def check_row_drops(self, counts):
+        """ compare row counts against the live schema, flagging any table that shrank by more than max_drop
+        """
+        if self.live_schema and schema_utils.schema_exists(self.engine, self.live_schema):
+            live_counts = schema_utils.get_table_counts(self.engine, self.live_schema)
+            for t, live in live_counts.items():
+                new = counts.get(t, 0)
+                if live > 0 and new < live * (1.0 - self.max_drop):
+                    self.errors.append("{}.{} has {} rows, down from {} rows in {}".format(self.schema, t, new, live, self.live_schema))
+
+    def check_service_days(self):
+        """ make sure each day from today thru num_days has at least min_trips active trips
+        """
+        start = datetime.date.today()
+        end = start + datetime.timedelta(days=self.num_days - 1)
+        q = self.engine.dialect.identifier_preparer.quote(self.schema)
+        sql = "SELECT u.date, count(t.trip_id) FROM {0}.universal_calendar u JOIN {0}.trips t ON t.service_id = u.service_id " \
+              "WHERE u.date BETWEEN :start AND :end GROUP BY u.date".format(q)
+        with self.engine.connect() as conn:
+            trips = dict((r[0], r[1]) for r in conn.execute(text(sql), {'start': start, 'end': end}))
+
+        for i in range(self.num_days):
+            d = start + datetime.timedelta(days=i)
+            if trips.get(d, 0) < self.min_trips:
+                self.errors.append("{} has {} trips on {}".format(self.schema, trips.get(d, 0), d))
+
+    def check(self):
+        """ :return: True if the schema passes all the checks (see self.errors for the failures)
+        """
+        self.errors = []
+        counts = schema_utils.get_table_counts(self.engine, self.schema)
+        log.info("{} row counts: {}".format(self.schema, counts))
+        self.check_tables(counts)
+        self.check_row_drops(counts)
+        if self.num_days > 0 and counts.get('universal_calendar', 0) > 0:
+            self.check_service_days()
+
+        for e in self.errors:
+            log.warning("PREFLIGHT: {}".format(e))
+        return len(self.errors) == 0
+
@@ -0,0 +1,85 @@
+from sqlalchemy import create_engine
+from sqlalchemy import text
+
+import logging
+log = logging.getLogger(__file__)
+
+
+"""
+blue/green helpers for gtfsdb schemas: a feed is loaded into a shadow schema (<feed>_next), checked, and then swapped
+with the live schema (<feed>) in a single transaction ... the previous live schema is kept as <feed>_old for rollback
+"""
+
+NEXT_EXT = "_next"
+OLD_EXT = "_old"
+
+
+def get_engine(db_url):
+    return create_engine(db_url)
+
+
+def quote(engine, name):
+    return engine.dialect.identifier_preparer.quote(name)
+
+
+def schema_exists(engine, schema):
+    with engine.connect() as conn:
+        return _exists(conn, schema)
+
+
+def drop_schema(engine, schema):
+    with engine.begin() as conn:
+        conn.execute(text("DROP SCHEMA IF EXISTS {} CASCADE".format(quote(engine, schema))))
+
+
+def get_table_counts(engine, schema):
+    """ :return: dict of {table name: row count} for the tables in a schema
+    """
+    ret_val = {}
+    with engine.connect() as conn:
+        sql = "SELECT table_name FROM information_schema.tables WHERE table_schema = :s AND table_type = 'BASE TABLE'"
+        tables = [r[0] for r in conn.execute(text(sql), {'s': schema})]
+        for t in tables:
+            sql = "SELECT count(*) FROM {}.{}".format(quote(engine, schema), quote(engine, t))
+            ret_val[t] = conn.execute(text(sql)).scalar()
+    return ret_val
+
+
+def swap_schemas(engine, schema, next_schema=None, old_schema=None):
+    """
+    promote <schema>_next to <schema> in one transaction (readers see either the old or the new schema, never a mix)
+    the live schema becomes <schema>_old (any older <schema>_old is dropped)
+    """
+    next_schema = next_schema or schema + NEXT_EXT
+    old_schema = old_schema or schema + OLD_EXT
+    with engine.begin() as conn:
+        conn.execute(text("DROP SCHEMA IF EXISTS {} CASCADE".format(quote(engine, old_schema))))
+        if _exists(conn, schema):
+            conn.execute(text("ALTER SCHEMA {} RENAME TO {}".format(quote(engine, schema), quote(engine, old_schema))))
+        conn.execute(text("ALTER SCHEMA {} RENAME TO {}".format(quote(engine, next_schema), quote(engine, schema))))
+    log.info("swapped schema {} into {} (previous {} kept as {})".format(next_schema, schema, schema, old_schema))
+
+
+def rollback_schema(engine, schema, next_schema=None, old_schema=None):
+    """
+    put <schema>_old back as the live <schema>, in one transaction
+    the rolled back schema is parked as <schema>_next (so a rollback can itself be undone with another swap)
+    :return: True if there was an <schema>_old to roll back to
+    """
+    next_schema = next_schema or schema + NEXT_EXT
+    old_schema = old_schema or schema + OLD_EXT
+    with engine.begin() as conn:
+        if not _exists(conn, old_schema):
+            log.warning("no {} schema, so can't roll {} back".format(old_schema, schema))
+            return False
+        conn.execute(text("DROP SCHEMA IF EXISTS {} CASCADE".format(quote(engine, next_schema))))
+        if _exists(conn, schema):
+            conn.execute(text("ALTER SCHEMA {} RENAME TO {}".format(quote(engine, schema), quote(engine, next_schema))))
+        conn.execute(text("ALTER SCHEMA {} RENAME TO {}".format(quote(engine, old_schema), quote(engine, schema))))
+    log.info("rolled schema {} back to {} (bad schema parked as {})".format(schema, old_schema, next_schema))
+    return True
+
+
+def _exists(conn, schema):
+    r = conn.execute(text("SELECT 1 FROM information_schema.schemata WHERE schema_name = :s"), {'s': schema})
+    return r.first() is not None
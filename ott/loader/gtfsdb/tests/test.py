@@ -0,0 +1,225 @@
+import io
+import os
+import math
+import datetime
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, text
+
+from ott.loader.gtfsdb.link_feeds import LinkFeeds
+from ott.loader.gtfsdb.current_state import CurrentState
+from ott.loader.gtfsdb.pg_dumper import PgDumper
+
+
+class TestLinkFeeds(unittest.TestCase):
+    """ two small feeds, with stops placed at known distances (in meters, north / east of an origin) """
+    distance = 50.0
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        # put the origin just below a grid cell boundary, so stops a few meters north of it are in the next cell
+        self.dlat = self.distance / (math.pi * LinkFeeds.earth_radius / 180.0)
+        self.lat = (math.floor(45.5 / self.dlat) + 1) * self.dlat - self.dlat / 20.0
+        self.lon = -122.6
+
+        self.feed_a = self.make_feed("A", [
+            ("a1", 0, 0),        # near b1 & b2 (a shared stop group of 3)
+            ("a2", 0, 500),      # 45m from b3
+            ("a3", 0, 1000),     # 60m from b4 ... too far
+            ("a4", 0, 1005),     # 5m from a3, but same feed
+        ], [("A1", ["a1", "a2"]), ("A2", ["a3"])])
+        self.feed_b = self.make_feed("B", [
+            ("b1", 5, 0),        # 5m north of a1, across the cell boundary
+            ("b2", -20, 0),
+            ("b3", 0, 545),
+            ("b4", 0, 1060),
+        ], [("B1", ["b1", "b3"]), ("B2", ["b2"])])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def offset(self, north, east):
+        """ :return: lat, lon that's north & east meters from the origin """
+        lat = self.lat + north / (math.pi * LinkFeeds.earth_radius / 180.0)
+        lon = self.lon + east / (math.pi * LinkFeeds.earth_radius / 180.0) / math.cos(math.radians(self.lat))
+        return lat, lon
+
+    def make_feed(self, agency_id, stops, routes):
+        path = os.path.join(self.tmp_dir, agency_id + ".zip")
+        with zipfile.ZipFile(path, 'w') as z:
+            z.writestr('agency.txt', "agency_id,agency_name\n{0},Agency {0}\n".format(agency_id))
+            z.writestr('stops.txt', "stop_id,stop_name,stop_lat,stop_lon\n" + "".join(
+                "{},{},{:.7f},{:.7f}\n".format(id, id, *self.offset(n, e)) for id, n, e in stops))
+            z.writestr('trips.txt', "route_id,service_id,trip_id\n" + "".join(
+                "{0},W,{0}-1\n".format(r) for r, s in routes))
+            z.writestr('stop_times.txt', "trip_id,stop_id,stop_sequence\n" + "".join(
+                "{}-1,{},{}\n".format(r, stop_id, i) for r, s in routes for i, stop_id in enumerate(s)))
+        return path
+
+    def make_links(self):
+        links = LinkFeeds([(self.feed_a, "a"), (self.feed_b, "b")], self.distance)
+        links.read_stops()
+        return links
+
+    def get_pairs(self, links):
+        """ :return: dict of {(stop id, stop id): meters} """
+        ret_val = {}
+        for i, j, d in links.find_pairs():
+            ret_val[tuple(sorted((links.stops[i][2], links.stops[j][2])))] = d
+        return ret_val
+
+    def test_pairs_across_cells(self):
+        links = self.make_links()
+        a1 = [s for s in links.stops if s[2] == 'a1'][0]
+        b1 = [s for s in links.stops if s[2] == 'b1'][0]
+        self.assertNotEqual(math.floor(a1[3] / self.dlat), math.floor(b1[3] / self.dlat))
+
+        pairs = self.get_pairs(links)
+        self.assertIn(('a1', 'b1'), pairs)
+        self.assertAlmostEqual(pairs[('a1', 'b1')], 5.0, delta=0.5)
+
+    def test_distance_cutoff(self):
+        pairs = self.get_pairs(self.make_links())
+        self.assertEqual(sorted(pairs), [('a1', 'b1'), ('a1', 'b2'), ('a2', 'b3')])
+        self.assertAlmostEqual(pairs[('a2', 'b3')], 45.0, delta=0.5)
+        self.assertNotIn(('a3', 'b4'), pairs)   # 60m
+        self.assertNotIn(('a3', 'a4'), pairs)   # same feed
+
+    def test_grouping(self):
+        links = self.make_links()
+        links.group_pairs(links.find_pairs())
+        groups = {}
+        for s in links.shared_stops:
+            groups.setdefault(s['shared_stop_id'], []).append(s)
+        self.assertEqual(len(groups), 2)
+
+        by_stop = dict((s['agency_stop_id'], s) for s in links.shared_stops)
+        self.assertEqual(sorted(by_stop), ['a1', 'a2', 'b1', 'b2', 'b3'])
+        self.assertEqual(by_stop['a1']['shared_stop_id'], by_stop['b1']['shared_stop_id'])
+        self.assertEqual(by_stop['a1']['shared_stop_id'], by_stop['b2']['shared_stop_id'])
+        self.assertEqual(by_stop['a2']['shared_stop_id'], by_stop['b3']['shared_stop_id'])
+        self.assertNotEqual(by_stop['a1']['shared_stop_id'], by_stop['a2']['shared_stop_id'])
+
+        # stop_id is the group's first stop, and distance is from that stop
+        self.assertEqual(set(by_stop[s]['stop_id'] for s in ('a1', 'b1', 'b2')), {'a1'})
+        self.assertEqual(by_stop['a1']['distance'], 0.0)
+        self.assertAlmostEqual(by_stop['b2']['distance'], 20.0, delta=0.5)
+        self.assertEqual((by_stop['b1']['agency_id'], by_stop['b1']['agency_db_schema']), ('B', 'b'))
+
+    def test_routes(self):
+        links = LinkFeeds([(self.feed_a, "a"), (self.feed_b, "b")], self.distance)
+        links.link()
+        routes = sorted((r['agency_db_schema'], r['agency_route_id'], r['shared_stop_id']) for r in links.route_intersects)
+        self.assertEqual([r[:2] for r in routes], [('a', 'A1'), ('a', 'A1'), ('b', 'B1'), ('b', 'B1'), ('b', 'B2')])
+
+
+class TestCurrentState(unittest.TestCase):
+    """ a tiny gtfsdb-like schema in sqlite: route 1 runs in june, route 2 in july """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.engine = create_engine("sqlite://")
+        with self.engine.begin() as conn:
+            conn.execute(text("CREATE TABLE routes (route_id TEXT)"))
+            conn.execute(text("CREATE TABLE stops (stop_id TEXT)"))
+            conn.execute(text("CREATE TABLE trips (trip_id TEXT, route_id TEXT, service_id TEXT)"))
+            conn.execute(text("CREATE TABLE universal_calendar (service_id TEXT, date DATE)"))
+            conn.execute(text("INSERT INTO routes VALUES ('1'), ('2')"))
+            conn.execute(text("INSERT INTO trips VALUES ('a', '1', 'jun'), ('b', '2', 'jul')"))
+            conn.execute(text("INSERT INTO universal_calendar VALUES ('jun', '2020-06-01'), ('jun', '2020-06-30'), "
+                              "('jul', '2020-07-01'), ('jul', '2020-07-31')"))
+        self.june = datetime.date(2020, 6, 15)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.tmp_dir)
+
+    def make_state(self):
+        return CurrentState(self.engine, "main", self.tmp_dir)
+
+    def build(self, date):
+        """ :return: True if current_load would rebuild the current tables on this date (saving the new state, as it does) """
+        state = self.make_state()
+        ret_val = not state.is_unchanged(date)
+        if ret_val:
+            state.save()
+        return ret_val
+
+    def test_active_routes(self):
+        dates = {'1': ['2020-06-01', '2020-06-30'], '2': ['2020-07-01', '2020-07-31']}
+        self.assertEqual(CurrentState.get_active_routes(dates, self.june), ['1'])
+        self.assertEqual(CurrentState.get_active_routes(dates, datetime.date(2020, 6, 30)), ['1'])
+        self.assertEqual(CurrentState.get_active_routes(dates, datetime.date(2020, 8, 1)), [])
+        with self.engine.connect() as conn:
+            self.assertEqual(self.make_state().query_route_dates(conn), dates)
+
+    def test_skip(self):
+        self.assertTrue(self.build(self.june))
+        self.assertFalse(self.build(self.june))
+        self.assertFalse(self.build(datetime.date(2020, 6, 20)))
+
+        # route 2 starts running, then a new trip is loaded
+        self.assertTrue(self.build(datetime.date(2020, 7, 1)))
+        self.assertFalse(self.build(datetime.date(2020, 7, 2)))
+        with self.engine.begin() as conn:
+            conn.execute(text("INSERT INTO trips VALUES ('c', '1', 'jul')"))
+        self.assertTrue(self.build(datetime.date(2020, 7, 2)))
+
+    def test_cached_route_dates(self):
+        """ with the same fingerprint, the active routes come from the saved route dates (no trips join) """
+        self.build(self.june)
+        state = self.make_state()
+        state.query_route_dates = None
+        self.assertTrue(state.is_unchanged(datetime.date(2020, 6, 16)))
+        self.assertFalse(state.is_unchanged(datetime.date(2020, 7, 16)))
+
+    def test_clear(self):
+        """ a reload with the same counts & version isn't seen by the fingerprint ... clear() forces the rebuild """
+        self.build(self.june)
+        with self.engine.begin() as conn:
+            conn.execute(text("UPDATE routes SET route_id = 'X' WHERE route_id = '2'"))
+        self.assertFalse(self.build(self.june))
+        self.make_state().clear()
+        self.assertTrue(self.build(self.june))
+
+
+class TestPgDumper(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "TRIMET.tar")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_tar(self, names, link_name=None):
+        with tarfile.open(self.path, 'w') as t:
+            for n in names:
+                i = tarfile.TarInfo(n)
+                i.size = 4
+                t.addfile(i, io.BytesIO(b"data"))
+            if link_name:
+                i = tarfile.TarInfo(link_name)
+                i.type = tarfile.SYMTYPE
+                i.linkname = "/etc/passwd"
+                t.addfile(i)
+        return tarfile.open(self.path)
+
+    def check(self, names, link_name=None):
+        with self.make_tar(names, link_name) as t:
+            return PgDumper.check_members(t)
+
+    def test_check_members(self):
+        self.assertEqual(self.check(["trimet.dir/toc.dat", "trimet.dir/3456.dat.gz"]), "trimet.dir")
+        self.assertEqual(PgDumper.get_packed_schema(self.path), "trimet")
+
+    def test_bad_members(self):
+        self.assertRaises(ValueError, self.check, ["trimet.dir/toc.dat", "trimet.dir/../../evil"])
+        self.assertRaises(ValueError, self.check, ["/tmp/evil"])
+        self.assertRaises(ValueError, self.check, ["trimet.dir/toc.dat", "other.dir/toc.dat"])
+        self.assertRaises(ValueError, self.check, ["toc.dat"])
+        self.assertRaises(ValueError, self.check, ["trimet.dir/toc.dat"], "trimet.dir/link")
+        self.assertRaises(ValueError, self.check, [])
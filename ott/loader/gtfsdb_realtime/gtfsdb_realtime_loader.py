@@ -36,11 +36,43 @@ class GtfsdbRealtimeLoader(CacheBase):
             # load db feed
             loader.load_feeds_via_config(f, self.db_url, do_trips, do_alerts, do_vehicles, is_geospatial, create_db)
 
+    def make_daemon(self, api_key=None, is_geospatial=True, create_db=False, vehicles_only=False):
+        """ :return: a GtfsrtDaemon that polls each feed endpoint on its own [gtfs_realtime] *_interval (in seconds)
+        """
+        from .rt_daemon import GtfsrtDaemon
+        if api_key and len(api_key) > 3:
+            for f in self.feeds:
+                f['api_key'] = api_key
+
+        intervals = {
+            'trips': float(self.config.get('trips_interval', section='gtfs_realtime', def_val=30)),
+            'alerts': float(self.config.get('alerts_interval', section='gtfs_realtime', def_val=60)),
+            'vehicles': float(self.config.get('vehicles_interval', section='gtfs_realtime', def_val=5))
+        }
+        if vehicles_only:
+            intervals['trips'] = intervals['alerts'] = 0
+
+        return GtfsrtDaemon(
+            self, intervals,
+            jitter=float(self.config.get('poll_jitter', section='gtfs_realtime', def_val=0.1)),
+            max_backoff=float(self.config.get('max_backoff', section='gtfs_realtime', def_val=300)),
+            workers=int(self.config.get('poll_workers', section='gtfs_realtime', def_val=4)),
+            http_timeout=float(self.config.get('http_timeout', section='gtfs_realtime', def_val=10)),
+            is_geospatial=is_geospatial, create_db=create_db, state_dir=self.get_state_dir()
+        )
+
+    def get_state_dir(self):
+        """ where the daemon publishes the memory-mapped <agency_id>.rt state files (None if publish_state is off) """
+        ret_val = None
+        if self.config.get_bool('publish_state', section='gtfs_realtime', def_val=True):
+            ret_val = self.config.get('state_dir', section='gtfs_realtime', def_val=None) or self.cache_dir
+        return ret_val
+
     @classmethod
-    def make_cmdline(cls):
+    def make_cmdline(cls, exe_name='bin/gtfsrt_load'):
         """ make a command line with options for app keys and creating new dbs, etc... """
         from ott.utils.parse.cmdline.gtfs_cmdline import gtfs_rt_parser
-        p = gtfs_rt_parser(exe_name='bin/gtfsrt_load', do_parse=False)
+        p = gtfs_rt_parser(exe_name=exe_name, do_parse=False)
         p.add_argument(
             '--vehicles_only',
             '-vo',
@@ -62,3 +94,13 @@ class GtfsdbRealtimeLoader(CacheBase):
         args = cls.make_cmdline()
         rt = GtfsdbRealtimeLoader()
         rt.load_all(args.api_key, args.is_geospatial, args.create, args.vehicles_only)
+
+    @classmethod
+    def serve(cls):
+        """
+        long-running version of load(): keep polling the realtime feeds from config/app.ini (until SIGINT / SIGTERM)
+        NOTE: run this instead of a cron'd gtfsrt_load, e.g. bin/gtfsrt_serve -vo to just poll vehicles every few seconds
+        """
+        args = cls.make_cmdline(exe_name='bin/gtfsrt_serve')
+        rt = GtfsdbRealtimeLoader()
+        rt.make_daemon(args.api_key, args.is_geospatial, args.create, args.vehicles_only).serve()
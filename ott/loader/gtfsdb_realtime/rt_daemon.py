@@ -0,0 +1,215 @@
+import os
+import time
+import random
+import signal
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+log = logging.getLogger(__file__)
+
+from .rt_snapshot import FeedSnapshot, parse_feed
+from .rt_state import RtStateWriter
+
+
+class Endpoint(object):
+    """ one gtfs-rt endpoint (the trips, alerts or vehicles url of an agency's feed) and its polling state
+    """
+    types = ('trips', 'alerts', 'vehicles')
+
+    def __init__(self, feed, type, interval):
+        self.feed = feed
+        self.type = type
+        self.interval = interval
+        self.name = "{}:{}".format(feed.get('agency_id'), type)
+        self.url = feed.get(type, '').format(api_key=feed.get('api_key', ''))
+        self.failures = 0
+        self.snapshot = FeedSnapshot()
+        self.feed_msg = None
+        self.num_runs = 0
+        self.num_skips = 0
+
+
+class GtfsrtDaemon(object):
+    """
+    long-running gtfs-rt poller (in place of a cron'd GtfsdbRealtimeLoader.load_all):
+     - an asyncio scheduler, with a poll interval per endpoint type (e.g., vehicles every few seconds, alerts every minute)
+     - each endpoint polls in its own loop, so a slow run delays that endpoint's next poll rather than overlapping it
+     - endpoints poll concurrently (up to workers at once), in threads
+     - +/- jitter on each interval (so agencies don't all hit their servers in lock step), and exponential backoff
+       (up to max_backoff seconds) after a failed poll
+     - at start, the daemon opens one pooled (keep-alive) requests.Session, and (with create_db) creates each agency's
+       ott.gtfsdb_realtime tables once ... every poll shares them
+     - endpoints are fetched over that session, and decoded & checked against a snapshot of the last feed loaded
+       (see FeedSnapshot) ... a feed whose header timestamp hasn't advanced, or where no entity was inserted, changed
+       or removed, is skipped without touching the db
+     - otherwise, just that endpoint's data is loaded into the same ott.gtfsdb_realtime trip, alert & vehicle tables
+       load_all populates (see load())
+
+    note: ott.gtfsdb_realtime's loader does its own fetch & db write (of the whole feed), so a changed feed is fetched
+          again by it ... the write savings come from skipping the unchanged polls
+
+    with a state_dir, each poll also publishes the agency's latest decoded trips, vehicles and alerts to a memory-mapped
+    <state_dir>/<agency_id>.rt file (see rt_state.py), for local readers that don't want to go to the db
+    """
+    def __init__(self, rt_loader, intervals, jitter=0.1, max_backoff=300, workers=4, http_timeout=10, is_geospatial=True,
+                 create_db=False, state_dir=None):
+        self.rt_loader = rt_loader
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.http_timeout = http_timeout
+        self.is_geospatial = is_geospatial
+        self.create_db = create_db
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.state_writers = {}
+        self.session = None
+        self.stopping = None
+
+        self.endpoints = []
+        for f in rt_loader.feeds:
+            for t in Endpoint.types:
+                if f.get(t) and intervals.get(t, 0) > 0:
+                    self.endpoints.append(Endpoint(f, t, intervals[t]))
+
+        if state_dir:
+            if not os.path.exists(state_dir):
+                os.makedirs(state_dir)
+            for f in rt_loader.feeds:
+                path = os.path.join(state_dir, "{}.rt".format(f.get('agency_id')))
+                self.state_writers[f.get('agency_id')] = RtStateWriter(path)
+
+    def open(self):
+        """ open the http session every poll shares, and (with create_db) create each agency's tables (once) """
+        import requests
+
+        # step 1: one keep-alive http connection pool, with a connection per endpoint
+        self.session = requests.Session()
+        size = len(self.endpoints) or 1
+        adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # step 2: (re)create the tables with one full load per agency, before any endpoint polls
+        if self.create_db:
+            from ott.gtfsdb_realtime import loader
+            for f in self.rt_loader.feeds:
+                types = [ep.type for ep in self.endpoints if ep.feed is f]
+                if types:
+                    log.info("creating the {} gtfs-rt tables".format(f.get('agency_id')))
+                    loader.load_feeds_via_config(
+                        f, self.rt_loader.db_url,
+                        'trips' in types, 'alerts' in types, 'vehicles' in types,
+                        self.is_geospatial, True
+                    )
+
+    def close(self):
+        if self.session:
+            self.session.close()
+
+    def fetch(self, ep):
+        """ :return: the endpoint's current response body """
+        r = self.session.get(ep.url, timeout=self.http_timeout)
+        r.raise_for_status()
+        return r.content
+
+    def load(self, ep):
+        """ load just this endpoint's data into the ott.gtfsdb_realtime tables (same as load_all does) """
+        from ott.gtfsdb_realtime import loader
+        loader.load_feeds_via_config(
+            ep.feed, self.rt_loader.db_url,
+            ep.type == 'trips', ep.type == 'alerts', ep.type == 'vehicles',
+            self.is_geospatial, False
+        )
+
+    def poll(self, ep):
+        """
+        poll one endpoint (runs in a worker thread)
+        :return: True if the endpoint was loaded into the db, False if its feed hasn't changed since the last load
+        """
+        # step 1: fetch & decode the feed, and check it against the last one we loaded
+        ep.feed_msg = parse_feed(self.fetch(ep))
+        self.publish_state(ep)
+        diff = ep.snapshot.diff(ep.feed_msg)
+        if not diff.has_changes() and ep.num_runs > 0:
+            log.debug("{} skipped: {}".format(ep.name, diff))
+            ep.num_skips += 1
+            return False
+
+        # step 2: load the endpoint's data
+        log.debug("{}: {}".format(ep.name, diff))
+        self.load(ep)
+        ep.snapshot.update(diff)
+        ep.num_runs += 1
+        return True
+
+    def publish_state(self, ep):
+        """ swap in a new state file for the endpoint's agency, from the latest feeds polled from each of its endpoints """
+        agency_id = ep.feed.get('agency_id')
+        writer = self.state_writers.get(agency_id)
+        if writer:
+            msgs = dict((e.type, e.feed_msg) for e in self.endpoints if e.feed.get('agency_id') == agency_id)
+            try:
+                writer.publish(msgs.get('trips'), msgs.get('vehicles'), msgs.get('alerts'))
+            except Exception as e:
+                log.warning("can't publish {}: {}".format(writer.path, e))
+
+    def next_delay(self, ep, secs):
+        """ seconds until the endpoint's next poll: its interval (+/- jitter) from the start of this run, or backoff """
+        if ep.failures > 0:
+            delay = min(ep.interval * (2 ** ep.failures), self.max_backoff)
+        else:
+            delay = ep.interval - secs
+            if secs > ep.interval:
+                log.info("{} poll took {:.1f} secs, longer than its {} sec interval".format(ep.name, secs, ep.interval))
+        delay *= 1.0 + random.uniform(-self.jitter, self.jitter)
+        return max(delay, 0.0)
+
+    async def run_endpoint(self, ep):
+        loop = asyncio.get_event_loop()
+
+        # stagger the first polls over the interval, so the endpoints don't all fire at once
+        await self.sleep(random.uniform(0, ep.interval * self.jitter))
+        while not self.stopping.is_set():
+            start = time.time()
+            try:
+                loaded = await loop.run_in_executor(self.executor, self.poll, ep)
+                ep.failures = 0
+                log.debug("{} {} in {:.2f} secs".format(ep.name, "loaded" if loaded else "unchanged", time.time() - start))
+            except Exception as e:
+                ep.failures += 1
+                log.warning("{} poll failed ({} in a row): {}".format(ep.name, ep.failures, e))
+            await self.sleep(self.next_delay(ep, time.time() - start))
+
+    async def sleep(self, secs):
+        """ sleep, but wake up right away when the daemon is stopped """
+        try:
+            await asyncio.wait_for(self.stopping.wait(), timeout=secs)
+        except asyncio.TimeoutError:
+            pass
+
+    def stop(self):
+        log.info("stopping the gtfs-rt daemon")
+        self.stopping.set()
+
+    async def main(self):
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        for s in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(s, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        log.info("polling {} gtfs-rt endpoints: {}".format(len(self.endpoints), ", ".join(
+            "{} every {}s".format(ep.name, ep.interval) for ep in self.endpoints)))
+        await asyncio.gather(*[self.run_endpoint(ep) for ep in self.endpoints])
+
+    def serve(self):
+        try:
+            self.open()
+            asyncio.run(self.main())
+        finally:
+            self.executor.shutdown(wait=True)
+            self.close()
+            for ep in self.endpoints:
+                log.info("{}: {} loads, {} unchanged polls".format(ep.name, ep.num_runs, ep.num_skips))
@@ -0,0 +1,74 @@
+import hashlib
+
+import logging
+log = logging.getLogger(__file__)
+
+
+def parse_feed(body):
+    """ :return: the gtfs-rt FeedMessage decoded from a response body """
+    from google.transit import gtfs_realtime_pb2
+    msg = gtfs_realtime_pb2.FeedMessage()
+    msg.ParseFromString(body)
+    return msg
+
+
+class FeedDiff(object):
+    """ what changed between two polls of an endpoint: the entity ids inserted, changed and removed """
+    def __init__(self, timestamp, digests, inserted=None, changed=None, removed=None, is_stale=False):
+        self.timestamp = timestamp
+        self.digests = digests
+        self.inserted = inserted or []
+        self.changed = changed or []
+        self.removed = removed or []
+        self.is_stale = is_stale
+
+    def has_changes(self):
+        return not self.is_stale and (len(self.inserted) + len(self.changed) + len(self.removed)) > 0
+
+    def __str__(self):
+        if self.is_stale:
+            return "header timestamp {} hasn't advanced".format(self.timestamp)
+        return "{} inserted, {} changed, {} removed".format(len(self.inserted), len(self.changed), len(self.removed))
+
+
+class FeedSnapshot(object):
+    """
+    in-memory snapshot of the last gtfs-rt feed loaded from an endpoint: the header timestamp, plus a digest of each
+    entity keyed by entity id, so the next poll can be checked for change before it's written to the db
+
+    a poll is skipped when its header timestamp hasn't advanced past the snapshot's (feeds without a header timestamp
+    fall through to the entity check), or when no entity was inserted, changed or removed
+    """
+    def __init__(self):
+        self.timestamp = None
+        self.digests = {}
+
+    @classmethod
+    def entity_digest(cls, entity):
+        return hashlib.sha1(entity.SerializeToString(deterministic=True)).digest()
+
+    def diff(self, msg):
+        """ :return: FeedDiff of the decoded FeedMessage vs. this snapshot """
+        timestamp = msg.header.timestamp if msg.header.HasField('timestamp') else None
+        if timestamp and self.timestamp and timestamp <= self.timestamp:
+            return FeedDiff(timestamp, self.digests, is_stale=True)
+
+        digests = {}
+        inserted = []
+        changed = []
+        for e in msg.entity:
+            d = self.entity_digest(e)
+            digests[e.id] = d
+            old = self.digests.get(e.id)
+            if old is None:
+                inserted.append(e.id)
+            elif old != d:
+                changed.append(e.id)
+        removed = [i for i in self.digests if i not in digests]
+        return FeedDiff(timestamp, digests, inserted, changed, removed)
+
+    def update(self, diff):
+        """ make the polled feed the new snapshot (call once it's been written to the db) """
+        if not diff.is_stale:
+            self.timestamp = diff.timestamp
+            self.digests = diff.digests
@@ -0,0 +1,250 @@
+import os
+import time
+import mmap
+import struct
+import threading
+
+import logging
+log = logging.getLogger(__file__)
+
+
+"""
+compact, memory-mapped snapshot of an agency's latest decoded gtfs-rt state, for readers on the same box that want
+current vehicles, trip delays or alerts without a db round trip
+
+file layout (little endian, every section is a packed array of fixed size records, so a reader just unpacks the
+records it needs straight out of the mmap):
+  header        magic, version, created, and the number of strings, vehicles, delays, alerts and alert keys
+  strings       (n_strings + 1) uint32 offsets into the utf-8 string blob that follows (padded to 8 bytes)
+  vehicles      route, trip, vehicle, lat, lon, bearing, speed, timestamp ... sorted by route_id
+  delays        trip, delay secs, timestamp ... sorted by trip_id
+  alerts        id, header text, description text, effect, start, end ... the alerts active when the file was written
+  alert keys    kind (route / stop), key, alert index ... sorted by kind & route_id / stop_id
+
+the file is written to a .tmp beside it, and os.replace()'d into place, so a reader never sees a partial file
+"""
+
+MAGIC = b'OTTRTST1'
+VERSION = 1
+HEADER = struct.Struct('<8sIQIIIII')
+OFFSET = struct.Struct('<I')
+VEHICLE = struct.Struct('<IIIffffQ')
+DELAY = struct.Struct('<IiQ')
+ALERT = struct.Struct('<IIIIQQ')
+ALERT_KEY = struct.Struct('<BII')
+ROUTE = 0
+STOP = 1
+
+
+def _pad(n):
+    return (8 - n % 8) % 8
+
+
+def _text(translated):
+    """ first translation of a gtfs-rt TranslatedString """
+    return translated.translation[0].text if len(translated.translation) > 0 else ''
+
+
+class RtStateWriter(object):
+    """ build & publish an agency's state file from its latest decoded trips, vehicles and alerts FeedMessages
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.strings = None
+        self.string_ids = None
+
+    def sid(self, s):
+        s = s or ''
+        if s not in self.string_ids:
+            self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.string_ids[s]
+
+    def publish(self, trips=None, vehicles=None, alerts=None, now=None):
+        """ write a new state file (any of the feeds can be None) ... safe to call from multiple poller threads """
+        now = int(now or time.time())
+        with self.lock:
+            self.strings = []
+            self.string_ids = {}
+            data = self.build(trips, vehicles, alerts, now)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        return len(data)
+
+    def build(self, trips, vehicles, alerts, now):
+        # step 1: vehicles, sorted by route
+        vehicle_recs = []
+        for e in (vehicles.entity if vehicles else []):
+            if e.HasField('vehicle'):
+                v = e.vehicle
+                p = v.position
+                route_id = v.trip.route_id
+                vehicle_recs.append((route_id, v.vehicle.id or e.id, (
+                    self.sid(route_id), self.sid(v.trip.trip_id), self.sid(v.vehicle.id or e.id),
+                    p.latitude, p.longitude, p.bearing, p.speed, v.timestamp
+                )))
+        vehicle_recs.sort(key=lambda r: (r[0], r[1]))
+
+        # step 2: trip delays, sorted by trip ... the trip's delay, else the first stop time update's delay
+        delay_recs = {}
+        for e in (trips.entity if trips else []):
+            if e.HasField('trip_update'):
+                t = e.trip_update
+                delay = None
+                if t.HasField('delay'):
+                    delay = t.delay
+                elif len(t.stop_time_update) > 0:
+                    u = t.stop_time_update[0]
+                    if u.HasField('arrival') and u.arrival.HasField('delay'):
+                        delay = u.arrival.delay
+                    elif u.HasField('departure') and u.departure.HasField('delay'):
+                        delay = u.departure.delay
+                if delay is not None and t.trip.trip_id:
+                    delay_recs[t.trip.trip_id] = (self.sid(t.trip.trip_id), delay, t.timestamp)
+        delay_recs = [delay_recs[k] for k in sorted(delay_recs)]
+
+        # step 3: active alerts, and the routes / stops they're keyed by
+        alert_recs = []
+        key_recs = []
+        for e in (alerts.entity if alerts else []):
+            if e.HasField('alert'):
+                a = e.alert
+                periods = [(p.start or 0, p.end or 0) for p in a.active_period]
+                if periods and not any(s <= now and (t == 0 or now <= t) for s, t in periods):
+                    continue
+                start = min(s for s, t in periods) if periods else 0
+                end = 0 if not periods or any(t == 0 for s, t in periods) else max(t for s, t in periods)
+                i = len(alert_recs)
+                alert_recs.append((self.sid(e.id), self.sid(_text(a.header_text)), self.sid(_text(a.description_text)), a.effect, start, end))
+                keys = set()
+                for s in a.informed_entity:
+                    if s.route_id:
+                        keys.add((ROUTE, s.route_id))
+                    if s.stop_id:
+                        keys.add((STOP, s.stop_id))
+                for kind, key in keys:
+                    key_recs.append(((kind, key, i), (kind, self.sid(key), i)))
+        key_recs.sort(key=lambda r: r[0])
+
+        # step 4: pack it all up
+        blob = b''.join(s.encode('utf-8') for s in self.strings)
+        offsets = [0]
+        for s in self.strings:
+            offsets.append(offsets[-1] + len(s.encode('utf-8')))
+
+        out = [HEADER.pack(MAGIC, VERSION, now, len(self.strings), len(vehicle_recs), len(delay_recs), len(alert_recs), len(key_recs))]
+        out.extend(OFFSET.pack(o) for o in offsets)
+        out.append(blob + b'\0' * _pad(HEADER.size + OFFSET.size * len(offsets) + len(blob)))
+        out.extend(VEHICLE.pack(*r[2]) for r in vehicle_recs)
+        out.extend(DELAY.pack(*r) for r in delay_recs)
+        out.extend(ALERT.pack(*r) for r in alert_recs)
+        out.extend(ALERT_KEY.pack(*r[1]) for r in key_recs)
+        return b''.join(out)
+
+
+class RtStateReader(object):
+    """
+    read an agency's state file via mmap ... lookups binary search the sorted record arrays in place
+    the file is re-opened whenever the writer has swapped in a new one (checked on each lookup)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mm = None
+        self.inode = None
+
+    def open(self):
+        st = os.stat(self.path)
+        if self.mm is not None and (st.st_ino, st.st_mtime) == self.inode:
+            return
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.created, ns, nv, nd, na, nk = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            mm.close()
+            raise ValueError("{} isn't a version {} rt state file".format(self.path, VERSION))
+        self.close()
+        self.mm = mm
+        self.inode = (st.st_ino, st.st_mtime)
+        self.counts = {'strings': ns, 'vehicles': nv, 'delays': nd, 'alerts': na, 'alert_keys': nk}
+
+        self.offsets_at = HEADER.size
+        self.blob_at = self.offsets_at + OFFSET.size * (ns + 1)
+        blob_len = OFFSET.unpack_from(mm, self.offsets_at + OFFSET.size * ns)[0]
+        self.vehicles_at = self.blob_at + blob_len + _pad(self.blob_at + blob_len)
+        self.delays_at = self.vehicles_at + VEHICLE.size * nv
+        self.alerts_at = self.delays_at + DELAY.size * nd
+        self.keys_at = self.alerts_at + ALERT.size * na
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def string(self, i):
+        s, e = struct.unpack_from('<II', self.mm, self.offsets_at + OFFSET.size * i)
+        return self.mm[self.blob_at + s:self.blob_at + e].decode('utf-8')
+
+    def record(self, rec, at, i):
+        return rec.unpack_from(self.mm, at + rec.size * i)
+
+    def lower_bound(self, n, key_of, key):
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key_of(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get_vehicles(self, route_id):
+        """ :return: list of vehicle dicts on a route """
+        self.open()
+        ret_val = []
+        n = self.counts['vehicles']
+        route_of = lambda i: self.string(self.record(VEHICLE, self.vehicles_at, i)[0])
+        i = self.lower_bound(n, route_of, route_id)
+        while i < n:
+            r = self.record(VEHICLE, self.vehicles_at, i)
+            if self.string(r[0]) != route_id:
+                break
+            ret_val.append({
+                'route_id': route_id, 'trip_id': self.string(r[1]), 'vehicle_id': self.string(r[2]),
+                'lat': r[3], 'lon': r[4], 'bearing': r[5], 'speed': r[6], 'timestamp': r[7]
+            })
+            i += 1
+        return ret_val
+
+    def get_delay(self, trip_id):
+        """ :return: a trip's delay in seconds, or None """
+        self.open()
+        n = self.counts['delays']
+        i = self.lower_bound(n, lambda i: self.string(self.record(DELAY, self.delays_at, i)[0]), trip_id)
+        if i < n:
+            r = self.record(DELAY, self.delays_at, i)
+            if self.string(r[0]) == trip_id:
+                return r[1]
+        return None
+
+    def get_alerts(self, route_id=None, stop_id=None):
+        """ :return: list of the active alert dicts for a route or stop """
+        self.open()
+        kind, key = (ROUTE, route_id) if route_id is not None else (STOP, stop_id)
+        n = self.counts['alert_keys']
+        key_of = lambda i: self.record(ALERT_KEY, self.keys_at, i)[0:1] + (self.string(self.record(ALERT_KEY, self.keys_at, i)[1]),)
+        ret_val = []
+        i = self.lower_bound(n, key_of, (kind, key))
+        while i < n:
+            k = self.record(ALERT_KEY, self.keys_at, i)
+            if k[0] != kind or self.string(k[1]) != key:
+                break
+            a = self.record(ALERT, self.alerts_at, k[2])
+            ret_val.append({
+                'alert_id': self.string(a[0]), 'header': self.string(a[1]), 'description': self.string(a[2]),
+                'effect': a[3], 'start': a[4], 'end': a[5]
+            })
+            i += 1
+        return ret_val
@@ -0,0 +1,227 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from google.transit import gtfs_realtime_pb2
+
+from ott.loader.gtfsdb_realtime.rt_snapshot import FeedSnapshot, parse_feed
+from ott.loader.gtfsdb_realtime.rt_daemon import GtfsrtDaemon
+from ott.loader.gtfsdb_realtime.rt_state import RtStateWriter, RtStateReader
+
+
+def make_vehicles(timestamp, vehicles):
+    """ :return: vehicle positions FeedMessage, from a dict of {vehicle id: (route id, trip id, lat, lon)} """
+    msg = gtfs_realtime_pb2.FeedMessage()
+    msg.header.gtfs_realtime_version = "2.0"
+    msg.header.timestamp = timestamp
+    for id, (route_id, trip_id, lat, lon) in sorted(vehicles.items()):
+        e = msg.entity.add()
+        e.id = id
+        e.vehicle.vehicle.id = id
+        e.vehicle.trip.route_id = route_id
+        e.vehicle.trip.trip_id = trip_id
+        e.vehicle.position.latitude = lat
+        e.vehicle.position.longitude = lon
+    return msg
+
+
+class TestFeedSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = FeedSnapshot()
+        self.first = make_vehicles(100, {'1': ('10', 't1', 45.5, -122.6), '2': ('20', 't2', 45.6, -122.7)})
+
+    def tearDown(self):
+        pass
+
+    def test_first_poll(self):
+        diff = self.snapshot.diff(parse_feed(self.first.SerializeToString()))
+        self.assertTrue(diff.has_changes())
+        self.assertEqual(sorted(diff.inserted), ['1', '2'])
+        self.assertEqual((diff.changed, diff.removed), ([], []))
+
+    def test_changes(self):
+        self.snapshot.update(self.snapshot.diff(self.first))
+        diff = self.snapshot.diff(make_vehicles(100, {'1': ('10', 't1', 45.5, -122.6), '2': ('20', 't2', 45.6, -122.7)}))
+        self.assertTrue(diff.is_stale)
+        self.assertFalse(diff.has_changes())
+
+        # newer header: vehicle 1 moved, 2 left and 3 showed up
+        second = make_vehicles(130, {'1': ('10', 't1', 45.51, -122.6), '3': ('30', 't3', 45.7, -122.8)})
+        diff = self.snapshot.diff(second)
+        self.assertEqual((diff.inserted, diff.changed, diff.removed), (['3'], ['1'], ['2']))
+
+        # same entities, newer header ... nothing to load
+        self.snapshot.update(diff)
+        second.header.timestamp = 160
+        self.assertFalse(self.snapshot.diff(second).has_changes())
+
+    def test_no_header_timestamp(self):
+        self.first.header.ClearField('timestamp')
+        self.snapshot.update(self.snapshot.diff(self.first))
+        diff = self.snapshot.diff(self.first)
+        self.assertFalse(diff.is_stale)
+        self.assertFalse(diff.has_changes())
+
+
+class RecordingDaemon(GtfsrtDaemon):
+    """ daemon that polls canned feed bodies, and records which endpoints it loaded (vs. loading the db) """
+    def __init__(self, *args, **kwargs):
+        super(RecordingDaemon, self).__init__(*args, **kwargs)
+        self.bodies = {}
+        self.loads = []
+
+    def fetch(self, ep):
+        return self.bodies[ep.name]
+
+    def load(self, ep):
+        self.loads.append(ep.name)
+
+
+class RtLoader(object):
+    feeds = [{'agency_id': 'TRIMET', 'vehicles': 'http://localhost/vehicles', 'alerts': 'http://localhost/alerts'}]
+    db_url = "sqlite://"
+
+
+class TestGtfsrtDaemon(unittest.TestCase):
+    def setUp(self):
+        self.daemon = RecordingDaemon(RtLoader(), {'trips': 30, 'alerts': 60, 'vehicles': 5})
+        self.ep = self.daemon.endpoints[0]
+
+    def tearDown(self):
+        self.daemon.executor.shutdown()
+
+    def poll(self, msg):
+        self.daemon.bodies[self.ep.name] = msg.SerializeToString()
+        return self.daemon.poll(self.ep)
+
+    def test_endpoints(self):
+        """ one endpoint per configured url with a poll interval ... the feed has no trips url """
+        self.assertEqual([ep.name for ep in self.daemon.endpoints], ['TRIMET:alerts', 'TRIMET:vehicles'])
+        d = RecordingDaemon(RtLoader(), {'trips': 0, 'alerts': 0, 'vehicles': 5})
+        self.assertEqual([ep.name for ep in d.endpoints], ['TRIMET:vehicles'])
+        d.executor.shutdown()
+
+    def test_poll(self):
+        self.ep = self.daemon.endpoints[1]
+        self.assertTrue(self.poll(make_vehicles(100, {'1': ('10', 't1', 45.5, -122.6)})))
+
+        # same timestamp, then a new timestamp but the same vehicles ... neither touches the db
+        self.assertFalse(self.poll(make_vehicles(100, {'1': ('10', 't1', 45.9, -122.6)})))
+        self.assertFalse(self.poll(make_vehicles(130, {'1': ('10', 't1', 45.5, -122.6)})))
+
+        # a vehicle moved
+        self.assertTrue(self.poll(make_vehicles(160, {'1': ('10', 't1', 45.9, -122.6)})))
+        self.assertEqual(self.daemon.loads, ['TRIMET:vehicles', 'TRIMET:vehicles'])
+        self.assertEqual((self.ep.num_runs, self.ep.num_skips), (2, 2))
+
+    def test_failed_load(self):
+        """ a load that fails leaves the snapshot alone, so the next poll of the same feed tries again """
+        self.ep = self.daemon.endpoints[1]
+        msg = make_vehicles(100, {'1': ('10', 't1', 45.5, -122.6)})
+        self.poll(msg)
+
+        def fail(ep):
+            raise IOError("db is down")
+        self.daemon.load = fail
+        msg = make_vehicles(130, {'1': ('10', 't1', 45.9, -122.6)})
+        self.assertRaises(IOError, self.poll, msg)
+        del self.daemon.load
+        self.assertTrue(self.poll(msg))
+
+
+class TestRtState(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "TRIMET.rt")
+        self.now = 1500000000
+
+        self.vehicles = make_vehicles(self.now, {
+            '1': ('10', 't1', 45.5, -122.6), '2': ('20', 't2', 45.6, -122.7), '3': ('10', 't3', 45.7, -122.8)
+        })
+
+        self.trips = gtfs_realtime_pb2.FeedMessage()
+        self.trips.header.gtfs_realtime_version = "2.0"
+        e = self.trips.entity.add()
+        e.id = 'a'
+        e.trip_update.trip.trip_id = 't1'
+        e.trip_update.delay = 120
+        e = self.trips.entity.add()
+        e.id = 'b'
+        e.trip_update.trip.trip_id = 't2'
+        e.trip_update.stop_time_update.add().arrival.delay = -30
+
+        self.alerts = gtfs_realtime_pb2.FeedMessage()
+        self.alerts.header.gtfs_realtime_version = "2.0"
+        self.add_alert('active', u"Détour sur la ligne 10 \u2192 Gresham", [('10', None), (None, 's1')], self.now - 60, self.now + 60)
+        self.add_alert('open', u"Elevator out", [(None, 's1')], self.now - 60, 0)
+        self.add_alert('expired', u"Old news", [('10', None)], self.now - 120, self.now - 60)
+        self.add_alert('future', u"Not yet", [('20', None)], self.now + 60, self.now + 120)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def add_alert(self, id, header, keys, start, end):
+        e = self.alerts.entity.add()
+        e.id = id
+        e.alert.header_text.translation.add().text = header
+        e.alert.description_text.translation.add().text = header + u" (details)"
+        p = e.alert.active_period.add()
+        p.start = start
+        if end:
+            p.end = end
+        for route_id, stop_id in keys:
+            i = e.alert.informed_entity.add()
+            if route_id:
+                i.route_id = route_id
+            if stop_id:
+                i.stop_id = stop_id
+
+    def test_round_trip(self):
+        RtStateWriter(self.path).publish(self.trips, self.vehicles, self.alerts, now=self.now)
+        r = RtStateReader(self.path)
+
+        # vehicles by route
+        v = r.get_vehicles('10')
+        self.assertEqual([x['vehicle_id'] for x in v], ['1', '3'])
+        self.assertEqual([x['trip_id'] for x in v], ['t1', 't3'])
+        self.assertAlmostEqual(v[0]['lat'], 45.5, places=4)
+        self.assertAlmostEqual(v[0]['lon'], -122.6, places=4)
+        self.assertEqual(len(r.get_vehicles('20')), 1)
+        self.assertEqual(r.get_vehicles('99'), [])
+
+        # delays
+        self.assertEqual(r.get_delay('t1'), 120)
+        self.assertEqual(r.get_delay('t2'), -30)
+        self.assertIsNone(r.get_delay('t3'))
+
+        # active alerts only, keyed by route & stop (with non-ascii text intact)
+        a = r.get_alerts(route_id='10')
+        self.assertEqual([x['alert_id'] for x in a], ['active'])
+        self.assertEqual(a[0]['header'], u"Détour sur la ligne 10 \u2192 Gresham")
+        self.assertEqual(a[0]['description'], u"Détour sur la ligne 10 \u2192 Gresham (details)")
+        self.assertEqual((a[0]['start'], a[0]['end']), (self.now - 60, self.now + 60))
+        self.assertEqual(sorted(x['alert_id'] for x in r.get_alerts(stop_id='s1')), ['active', 'open'])
+        self.assertEqual([x['end'] for x in r.get_alerts(stop_id='s1') if x['alert_id'] == 'open'], [0])
+        self.assertEqual(r.get_alerts(route_id='20'), [])
+        r.close()
+
+    def test_republish(self):
+        """ the reader picks up a new file once the writer swaps it in """
+        w = RtStateWriter(self.path)
+        w.publish(None, self.vehicles, None, now=self.now)
+        r = RtStateReader(self.path)
+        self.assertEqual(len(r.get_vehicles('10')), 2)
+        self.assertIsNone(r.get_delay('t1'))
+
+        w.publish(self.trips, make_vehicles(self.now, {'4': ('40', 't4', 45.0, -122.0)}), None, now=self.now + 1)
+        self.assertEqual(r.get_vehicles('10'), [])
+        self.assertEqual(r.get_vehicles('40')[0]['vehicle_id'], '4')
+        self.assertEqual(r.get_delay('t1'), 120)
+        r.close()
+
+    def test_empty(self):
+        RtStateWriter(self.path).publish(now=self.now)
+        r = RtStateReader(self.path)
+        self.assertEqual((r.get_vehicles('10'), r.get_delay('t1'), r.get_alerts(stop_id='s1')), ([], None, []))
+        r.close()
@@ -10,7 +10,6 @@ from ott.loader.gtfsdb.gtfsdb_exporter import GtfsdbExporter
 from ott.loader.gtfsdb_realtime.gtfsdb_realtime_loader import GtfsdbRealtimeLoader
 from ott.loader.sum.sum_cache import SumCache
 from ott.loader.solr.solr_loader import SolrLoader
-from ott.loader.gtfs.fix import Fix
 
 import logging
 log = logging.getLogger(__file__)
@@ -32,12 +31,16 @@ def download_data():
     gtfs = GtfsCache()
     updated_feeds = gtfs.check_cached_feeds(force_update=force_update)
     if updated_feeds and len(updated_feeds) > 0:
-        log.info("step 1 IMPORTANT: loading on GTFS changes in feed(s): {}!".format(updated_feeds))
-        force_update = True
-
-    # step 1b: TODO temp gtfs_fix until OTP is fixed -- commented due to fixed OTP - April 2020
-    #f = Fix("TRIMET.zip")
-    #f.remove_deadhead_stop_times(stop="8169", cull=True)
+        # step 1a: only force the rebuilds if the changes matter to the graphs (e.g., not just a feed_info.txt bump)
+        graph_feeds = [n for n in updated_feeds if n not in gtfs.change_sets or gtfs.change_sets[n].affects_graph()]
+        if len(graph_feeds) > 0:
+            log.info("step 1 IMPORTANT: loading on GTFS changes in feed(s): {}!".format(graph_feeds))
+            force_update = True
+        else:
+            log.info("step 1: feed(s) {} only have metadata changes, so not forcing a reload".format(updated_feeds))
+
+    # step 1b: gtfs fixes (e.g., the April 2020 TRIMET.zip stop 8169 deadhead cull) are now applied as part of step 1,
+    #          via a "fix" rule file on the feed in app.ini [gtfs] (@see ott.loader.gtfs.fix_plan.FixPlan)
 
     log.info("step 2: cache latest osm data")
     updated_osm = OsmCache.update(force_update=force_update)
@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import threading
+
+import logging
+log = logging.getLogger(__file__)
+
+
+def get_mem_available_mb():
+    """ :return: MemAvailable from /proc/meminfo (in MB), or None """
+    try:
+        with open('/proc/meminfo') as f:
+            for l in f:
+                if l.startswith('MemAvailable:'):
+                    return int(l.split()[1]) // 1024
+    except Exception:
+        pass
+    return None
+
+
+class BuildHistory(object):
+    """ per-graph build stats (secs, input size and peak memory) from past runs, kept in a .json in the cache dir """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.history = {}
+        try:
+            with open(path) as f:
+                self.history = json.load(f)
+        except Exception:
+            pass
+
+    def get(self, name):
+        return self.history.get(name, {})
+
+    def record(self, name, **stats):
+        with self.lock:
+            h = self.history.setdefault(name, {})
+            h.update(dict((k, v) for k, v in stats.items() if v is not None))
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.history, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
+class BuildJob(object):
+    def __init__(self, graph, heap_mb, input_mb, key=None):
+        self.graph = graph
+        self.name = graph.get('name')
+        self.heap_mb = heap_mb
+        self.input_mb = input_mb
+        self.key = key
+        self.queued = time.time()
+        self.start = None
+        self.end = None
+        self.success = None
+        self.blocked_by = None
+
+    def secs(self):
+        return (self.end or time.time()) - (self.start or self.queued)
+
+
+class BuildScheduler(object):
+    """
+    run the build & test of several graphs at once, as many as the memory budget (and max_parallel) allows
+
+    - each graph's JVM heap need is estimated from the size of its inputs (the .osm / .pbf and gtfs .zip files), scaled
+      from its peak memory on past builds when we have them, else heap_per_input_mb per MB of input
+    - a graph starts when its estimate fits in what's left of the budget (a graph bigger than the whole budget still
+      runs, but on its own), the longest running graphs (from past builds) first
+    - graphs with the same inputs (same graph cache key) never run at once ... the second waits, and then picks up the
+      first one's Graph.obj from the graph cache
+    - at the end, each graph's wait / run times are logged, along with the critical path: the last graph to finish,
+      and the chain of graphs it had to wait on
+    """
+    input_exts = ('.osm', '.pbf', '.zip')
+
+    def __init__(self, history, budget_mb=None, max_parallel=1, base_heap_mb=1024, heap_per_input_mb=10, margin=1.2):
+        self.history = history
+        self.max_parallel = max(1, max_parallel)
+        self.base_heap_mb = base_heap_mb
+        self.heap_per_input_mb = heap_per_input_mb
+        self.margin = margin
+        if budget_mb is None:
+            avail = get_mem_available_mb()
+            budget_mb = int(avail * 0.9) if avail else base_heap_mb * 2
+        self.budget_mb = budget_mb
+        self.cond = threading.Condition()
+        self.jobs = []
+
+    @classmethod
+    def get_input_mb(cls, graph):
+        ret_val = 0.0
+        dir = graph.get('dir')
+        for f in os.listdir(dir):
+            if f.lower().endswith(cls.input_exts):
+                ret_val += os.path.getsize(os.path.join(dir, f)) / 1048576.0
+        return ret_val
+
+    def estimate_heap(self, graph, input_mb):
+        """ :return: estimated JVM heap need (in MB) of a graph build / OTP server """
+        h = self.history.get(graph.get('name'))
+        if h.get('peak_mb') and h.get('input_mb'):
+            ret_val = h['peak_mb'] * max(input_mb / h['input_mb'], 1.0)
+        else:
+            ret_val = self.base_heap_mb + input_mb * self.heap_per_input_mb
+        return int(ret_val * self.margin)
+
+    def add(self, graph, key=None):
+        input_mb = self.get_input_mb(graph)
+        job = BuildJob(graph, self.estimate_heap(graph, input_mb), input_mb, key)
+        self.jobs.append(job)
+        return job
+
+    def next_job(self, pending, running):
+        """ :return: the next pending job that can start now, or None """
+        used = sum(j.heap_mb for j in running)
+        keys = set(j.key for j in running if j.key)
+        for j in pending:
+            if j.key and j.key in keys:
+                continue
+            if not running or used + j.heap_mb <= self.budget_mb:
+                return j
+        return None
+
+    def run(self, fn):
+        """
+        call fn(graph) for each job, in parallel as the budget allows
+        :return: list of the BuildJobs (with each job's fn() return value as job.success)
+        """
+        # longest running graphs (from past builds ... secs & input_mb are recorded by the builder, only when it actually
+        # ran) first, the config order otherwise
+        pending = sorted(self.jobs, key=lambda j: -self.history.get(j.name).get('secs', 0))
+        running = []
+        last_done = [None]
+        log.info("scheduling {} graph(s) in a {} MB budget: {}".format(len(pending), self.budget_mb, ", ".join(
+            "{} ~{} MB".format(j.name, j.heap_mb) for j in pending)))
+
+        def work(job):
+            try:
+                job.success = fn(job.graph)
+            except Exception as e:
+                log.warning("graph {} failed: {}".format(job.name, e))
+                job.success = False
+            finally:
+                with self.cond:
+                    job.end = time.time()
+                    running.remove(job)
+                    last_done[0] = job
+                    self.cond.notify_all()
+
+        with self.cond:
+            while pending or running:
+                job = None
+                if len(running) < self.max_parallel:
+                    job = self.next_job(pending, running)
+                if job:
+                    pending.remove(job)
+                    running.append(job)
+                    job.start = time.time()
+                    job.blocked_by = last_done[0] if job.start - job.queued > 1.0 else None
+                    log.info("starting graph {} (~{} MB; {} MB of {} MB in use)".format(
+                        job.name, job.heap_mb, sum(j.heap_mb for j in running), self.budget_mb))
+                    threading.Thread(target=work, args=(job,), name="graph-{}".format(job.name)).start()
+                else:
+                    self.cond.wait()
+
+        for j in self.jobs:
+            self.history.record(j.name, success=j.success)
+        self.report()
+        return self.jobs
+
+    def critical_path(self):
+        """ :return: the chain of jobs that ended with the last one to finish (first job first) """
+        ret_val = []
+        job = max(self.jobs, key=lambda j: j.end or 0) if self.jobs else None
+        while job and job not in ret_val:
+            ret_val.insert(0, job)
+            job = job.blocked_by
+        return ret_val
+
+    def report(self):
+        if not self.jobs:
+            return
+        t0 = min(j.queued for j in self.jobs)
+        for j in sorted(self.jobs, key=lambda j: j.start or 0):
+            log.info("graph {:<12} waited {:>7.1f}s, ran {:>7.1f}s, done at {:>7.1f}s, ~{} MB, {}".format(
+                j.name, (j.start or t0) - j.queued, j.secs(), (j.end or t0) - t0, j.heap_mb, "ok" if j.success else "FAILED"))
+        path = self.critical_path()
+        log.info("critical path ({:.1f}s): {}".format((path[-1].end or t0) - t0, " -> ".join(
+            "{} ({:.1f}s)".format(j.name, j.secs()) for j in path)))
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class GraphCache(object):
+    """
+    content-addressed cache of built OTP graphs, keyed by a hash of everything the graph builder reads from a graph
+    dir: the otp .jar, the .osm / .pbf files, the gtfs .zips and the *.json configs
+
+    - a graph whose inputs hash to the key it was built from (kept beside Graph.obj as a Graph.obj.key sidecar) isn't
+      rebuilt, no matter what the file mtimes say (e.g., copying the same feed back into place, or touching a config)
+    - a graph whose inputs match a graph already built (by this or another graph dir ... e.g., prod and mod both build
+      from TRIMET.gtfs.zip) gets that Graph.obj hard linked (or copied) in, rather than built again
+    - entries are pruned down to max_entries, and anything older than max_days (by last use) is dropped ... except for
+      the entries this cache has fetched or stored (they're in use, e.g., a graph still to be built from the same
+      inputs is waiting to pick one up), so the cache can run over max_entries until the next run
+
+    note: the cache's own bookkeeping (the file hash memo) lives in the cache dir ... never write .json files into a
+          graph dir, since OTP reads every *.json there as config
+    """
+    input_exts = ('.jar', '.osm', '.pbf', '.zip', '.json')
+    key_ext = ".key"
+    hash_memo = "file_hashes.json"
+
+    def __init__(self, cache_dir, max_entries=6, max_days=30):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_days = max_days
+        self.lock = threading.Lock()
+        self.entry_lock = threading.RLock()
+        self.in_use = set()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.memo_path = os.path.join(cache_dir, self.hash_memo)
+        self.memo = self.load_memo()
+
+    def load_memo(self):
+        try:
+            with open(self.memo_path) as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def save_memo(self):
+        tmp_path = self.memo_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.memo, f)
+        os.replace(tmp_path, self.memo_path)
+
+    def file_hash(self, path, chunk_size=1024*1024):
+        """ sha256 of a file ... memoized by path, size and mtime, so the big .jar / .pbf files aren't re-read every run """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        with self.lock:
+            m = self.memo.get(path)
+            if m and m[0:2] == stamp:
+                return m[2]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha.update(chunk)
+        with self.lock:
+            self.memo[path] = stamp + [sha.hexdigest()]
+        return sha.hexdigest()
+
+    @classmethod
+    def input_files(cls, graph_dir):
+        ret_val = []
+        for f in sorted(os.listdir(graph_dir)):
+            path = os.path.join(graph_dir, f)
+            if os.path.isfile(path) and f.lower().endswith(cls.input_exts):
+                ret_val.append(path)
+        return ret_val
+
+    def get_key(self, graph):
+        """ :return: hash of the graph's otp version and each of its input files (name & content) """
+        sha = hashlib.sha256()
+        sha.update("version:{}\n".format(graph.get('version')).encode('utf-8'))
+        for path in self.input_files(graph.get('dir')):
+            sha.update("{}:{}\n".format(os.path.basename(path), self.file_hash(path)).encode('utf-8'))
+        with self.lock:
+            self.save_memo()
+        return sha.hexdigest()
+
+    def get_key_path(self, graph):
+        return graph.get('path') + self.key_ext
+
+    def get_graph_key(self, graph):
+        """ :return: the key the graph's current Graph.obj was built from (None if unknown) """
+        ret_val = None
+        try:
+            with open(self.get_key_path(graph)) as f:
+                ret_val = f.read().strip()
+        except Exception:
+            pass
+        return ret_val
+
+    def set_graph_key(self, graph, key):
+        with open(self.get_key_path(graph), 'w') as f:
+            f.write(key + "\n")
+
+    def clear_graph_key(self, graph):
+        if os.path.exists(self.get_key_path(graph)):
+            os.remove(self.get_key_path(graph))
+
+    def is_current(self, graph, key):
+        return os.path.exists(graph.get('path')) and self.get_graph_key(graph) == key
+
+    def get_entry_path(self, key, graph):
+        return os.path.join(self.cache_dir, key, os.path.basename(graph.get('path')))
+
+    def fetch(self, graph, key):
+        """ link (or copy) a cached Graph.obj with this key into the graph dir
+            :return: True if there was one
+        """
+        entry = self.get_entry_path(key, graph)
+        with self.entry_lock:
+            if not os.path.exists(entry):
+                return False
+            self.in_use.add(key)
+            os.utime(os.path.dirname(entry), None)
+            tmp_path = graph.get('path') + ".tmp"
+            self._link(entry, tmp_path)
+        os.replace(tmp_path, graph.get('path'))
+        self.set_graph_key(graph, key)
+        log.info("graph {} inputs match cached graph {}, so re-using it rather than building".format(graph.get('name'), key[:12]))
+        return True
+
+    def store(self, graph, key):
+        """ add a newly built Graph.obj to the cache (and mark it as built from key) """
+        self.set_graph_key(graph, key)
+        entry = self.get_entry_path(key, graph)
+        with self.entry_lock:
+            self.in_use.add(key)
+            if not os.path.exists(entry):
+                entry_dir = os.path.dirname(entry)
+                if not os.path.exists(entry_dir):
+                    os.makedirs(entry_dir)
+                self._link(graph.get('path'), entry + ".tmp")
+                os.replace(entry + ".tmp", entry)
+            os.utime(os.path.dirname(entry), None)
+            self.prune()
+
+    def prune(self):
+        """ keep the newest max_entries cached graphs (by last use), and drop any older than max_days ... but never the
+            entries in use (fetched or stored by this cache)
+        """
+        with self.entry_lock:
+            entries = []
+            for d in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, d)
+                if os.path.isdir(path) and d not in self.in_use:
+                    entries.append((os.path.getmtime(path), path))
+            entries.sort(reverse=True)
+
+            too_old = time.time() - self.max_days * 86400
+            keep = max(self.max_entries - len(self.in_use), 0)
+            for i, (mtime, path) in enumerate(entries):
+                if i >= keep or mtime < too_old:
+                    log.info("pruning cached graph {}".format(path))
+                    shutil.rmtree(path, ignore_errors=True)
+
+        # forget the hashes of files that no longer exist
+        with self.lock:
+            for p in [p for p in self.memo if not os.path.exists(p)]:
+                del self.memo[p]
+            self.save_memo()
+
+    @classmethod
+    def _link(cls, src, dst):
+        if os.path.exists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
@@ -0,0 +1,194 @@
+import os
+import re
+import json
+import time
+import shutil
+import datetime
+import threading
+import subprocess
+
+from ott.loader.otp.graph.readiness import find_java_pids
+
+import logging
+log = logging.getLogger(__file__)
+
+
+# gc pause lines: java 8 -Xloggc ("[GC (Allocation Failure) ..., 0.0123456 secs]") and java 9+ unified logging
+# ("[gc] GC(3) Pause Young (Normal) (G1 Evacuation Pause) 24M->4M(256M) 12.345ms")
+GC8_RE = re.compile(r"\[(Full GC|GC)[^\]]*?, ([\d.]+) secs\]")
+GC9_RE = re.compile(r"GC\(\d+\) Pause .* ([\d.]+)ms")
+
+
+class JvmProfiler(object):
+    """
+    sample the java process(es) of a graph dir (an OTP graph build or server) while they run:
+      - RSS and CPU from /proc every interval secs
+      - GC pauses, from the gc log each profiled JVM writes to gc_dir/gc-<pid>.log ... the gc flag is added to just
+        the profiled launch's java args (see java_args()): -Xlog:gc on java 9+, -Xloggc on java 8
+
+    stop() writes the attempt's time series to <graph dir>/profile/<kind>-<time>-<attempt>.jsonl (a header line, one
+    [secs, rss MB, cpu %] line per sample, and a summary line), and puts the gc logs in beside it (moved when the JVM
+    has exited, else copied, since e.g. an OTP server is still running and writing to its log)
+
+    note: the profiles are .jsonl in a sub dir ... never .json in the graph dir, since OTP reads *.json there as config
+    """
+    profile_dir = "profile"
+
+    def __init__(self, graph, kind='build', attempt=1, interval=2.0, gc_dir=None):
+        self.graph = graph
+        self.graph_dir = os.path.abspath(graph.get('dir'))
+        self.kind = kind
+        self.attempt = attempt
+        self.interval = interval
+        self.gc_dir = gc_dir
+        self.samples = []
+        self.pids = set()
+        self.ignore_pids = set()
+        self.cpu_ticks = {}
+        self.hz = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self.start_time = None
+        self.stopping = threading.Event()
+        self.thread = None
+        self.summary = None
+
+    java_version = None
+
+    @classmethod
+    def get_java_version(cls):
+        """ :return: major version of the java on the path (8 for 1.8.x, 11, 17, ...), or 0 if unknown """
+        if cls.java_version is None:
+            cls.java_version = 0
+            try:
+                out = subprocess.run(['java', '-version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60).stdout
+                m = re.search(r'version "(\d+)(?:\.(\d+))?', out.decode('utf-8', 'replace'))
+                if m:
+                    cls.java_version = int(m.group(2) or 0) if m.group(1) == '1' else int(m.group(1))
+            except Exception as e:
+                log.info("can't get the java version: {}".format(e))
+        return cls.java_version
+
+    def java_args(self, java_mem=None):
+        """ :return: java_mem, plus the flag that has this (profiled) JVM write its gc log to gc_dir/gc-<pid>.log """
+        ret_val = java_mem
+        version = self.get_java_version()
+        if self.gc_dir and version:
+            if not os.path.exists(self.gc_dir):
+                os.makedirs(self.gc_dir)
+            path = os.path.join(self.gc_dir, "gc-%p.log")
+            flag = "-Xlog:gc:file={}".format(path) if version >= 9 else "-Xloggc:{}".format(path)
+            ret_val = "{} {}".format(java_mem, flag) if java_mem else flag
+        return ret_val
+
+    def start(self):
+        self.start_time = time.time()
+        self.ignore_pids = set(find_java_pids(self.graph_dir))  # e.g., the graph's OTP server, still up during a build
+        self.thread = threading.Thread(target=self.run, name="profile-{}".format(self.graph.get('name')))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.sample()
+            self.stopping.wait(self.interval)
+
+    @classmethod
+    def read_rss_mb(cls, pid):
+        with open("/proc/{}/status".format(pid)) as f:
+            for l in f:
+                if l.startswith('VmRSS:'):
+                    return int(l.split()[1]) / 1024.0
+        return 0.0
+
+    @classmethod
+    def read_cpu_ticks(cls, pid):
+        with open("/proc/{}/stat".format(pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return int(fields[11]) + int(fields[12])  # utime + stime
+
+    def sample(self):
+        now = time.time()
+        rss = 0.0
+        cpu = 0.0
+        for pid in find_java_pids(self.graph_dir):
+            if pid in self.ignore_pids:
+                continue
+            try:
+                rss += self.read_rss_mb(pid)
+                ticks = self.read_cpu_ticks(pid)
+                last = self.cpu_ticks.get(pid)
+                if last:
+                    cpu += (ticks - last[1]) / float(self.hz) / max(now - last[0], 0.001) * 100.0
+                self.cpu_ticks[pid] = (now, ticks)
+                self.pids.add(pid)
+            except (OSError, IOError, IndexError, ValueError):
+                pass
+        if rss > 0:
+            self.samples.append([round(now - self.start_time, 1), round(rss, 1), round(cpu, 1)])
+
+    @classmethod
+    def parse_gc_log(cls, path):
+        """ :return: (number of gc pauses, total pause secs, max pause secs) """
+        pauses = []
+        with open(path, errors='replace') as f:
+            for l in f:
+                m = GC8_RE.search(l)
+                if m:
+                    pauses.append(float(m.group(2)))
+                else:
+                    m = GC9_RE.search(l)
+                    if m:
+                        pauses.append(float(m.group(1)) / 1000.0)
+        return len(pauses), sum(pauses), max(pauses) if pauses else 0.0
+
+    def stop(self, success=None):
+        """ stop sampling, and write the profile
+            :return: summary dict
+        """
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+        self.sample()
+
+        # step 1: where this attempt's profile goes
+        dir = os.path.join(self.graph_dir, self.profile_dir)
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        stamp = datetime.datetime.fromtimestamp(self.start_time).strftime("%Y%m%d-%H%M%S")
+        name = "{}-{}-{}".format(self.kind, stamp, self.attempt)
+
+        # step 2: gc pauses, from the logs of the JVMs we saw (moved in beside the profile, or copied if still running)
+        gcs, gc_secs, gc_max = 0, 0.0, 0.0
+        for pid in sorted(self.pids):
+            gc_path = os.path.join(self.gc_dir, "gc-{}.log".format(pid)) if self.gc_dir else None
+            if gc_path and os.path.exists(gc_path):
+                n, total, longest = self.parse_gc_log(gc_path)
+                gcs, gc_secs, gc_max = gcs + n, gc_secs + total, max(gc_max, longest)
+                to_path = os.path.join(dir, "{}-gc-{}.log".format(name, pid))
+                if os.path.exists("/proc/{}".format(pid)):
+                    shutil.copyfile(gc_path, to_path)
+                else:
+                    shutil.move(gc_path, to_path)
+
+        # step 3: summary & time series
+        self.summary = {
+            'graph': self.graph.get('name'), 'kind': self.kind, 'attempt': self.attempt, 'start': stamp,
+            'secs': round(time.time() - self.start_time, 1), 'success': success,
+            'peak_rss_mb': max([s[1] for s in self.samples] or [0]),
+            'avg_cpu_pct': round(sum(s[2] for s in self.samples) / len(self.samples), 1) if self.samples else 0,
+            'gc_pauses': gcs, 'gc_secs': round(gc_secs, 3), 'gc_max_secs': round(gc_max, 3)
+        }
+        with open(os.path.join(dir, name + ".jsonl"), 'w') as f:
+            f.write(json.dumps({'graph': self.graph.get('name'), 'kind': self.kind, 'attempt': self.attempt,
+                                'pids': sorted(self.pids), 'columns': ['secs', 'rss_mb', 'cpu_pct']}) + "\n")
+            for s in self.samples:
+                f.write(json.dumps(s) + "\n")
+            f.write(json.dumps(self.summary) + "\n")
+        log.info(self.get_msg())
+        return self.summary
+
+    def get_msg(self):
+        s = self.summary or {}
+        return "{} {} attempt {}: {} secs, peak RSS {} MB, avg CPU {}%, {} GC pauses ({} secs total, {} max){}".format(
+            s.get('graph'), s.get('kind'), s.get('attempt'), s.get('secs'), s.get('peak_rss_mb'), s.get('avg_cpu_pct'),
+            s.get('gc_pauses'), s.get('gc_secs'), s.get('gc_max_secs'), "" if s.get('success') is not False else " FAILED")
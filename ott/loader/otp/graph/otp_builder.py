@@ -10,10 +10,16 @@ from ott.utils import file_utils
 from ott.utils.cache_base import CacheBase
 
 from ott.loader.gtfs.gtfs_cache import GtfsCache
+from ott.loader.gtfs.diff import ChangeSet
 from ott.osm.osm_cache import OsmCache
 from ott.osm.stats.osm_info import OsmInfo
 from ott.loader.gtfs.gtfs_info import GtfsInfo
 from ott.loader.otp.preflight.test_runner import TestRunner
+from ott.loader.otp.graph.graph_cache import GraphCache
+from ott.loader.otp.graph.street_cache import StreetGraphCache
+from ott.loader.otp.graph.readiness import Readiness
+from ott.loader.otp.graph.build_scheduler import BuildScheduler, BuildHistory
+from ott.loader.otp.graph.jvm_profiler import JvmProfiler
 
 import os
 import sys
@@ -36,6 +42,31 @@ class OtpBuilder(CacheBase):
         super(OtpBuilder, self).__init__('otp')
         self.feeds = self.config.get_json('feeds', section='gtfs')
         self.graphs = self.config_graph_dirs(name, force_update, dont_update)
+        self.build_timeout = int(self.config.get('build_ready_timeout', section='otp', def_val=600))
+        self.server_timeout = int(self.config.get('server_ready_timeout', section='otp', def_val=900))
+        self.build_history = BuildHistory(os.path.join(self.cache_dir, 'graph_build_history.json'))
+
+        # profile the JVMs of graph builds & OTP servers (each profiled java writes a gc log to gc_dir)
+        self.profile_interval = None
+        self.gc_dir = os.path.join(self.cache_dir, 'gc_logs')
+        if self.config.get_bool('jvm_profile', section='otp', def_val=True):
+            self.profile_interval = float(self.config.get('profile_interval', section='otp', def_val=2))
+        self.graph_cache = None
+        if self.config.get_bool('graph_cache', section='otp', def_val=True):
+            cache_dir = self.config.get('graph_cache_dir', section='otp', def_val=None) or os.path.join(self.cache_dir, 'graph_cache')
+            self.graph_cache = GraphCache(
+                cache_dir,
+                max_entries=int(self.config.get('graph_cache_max', section='otp', def_val=6)),
+                max_days=int(self.config.get('graph_cache_days', section='otp', def_val=30))
+            )
+        self.street_cache = None
+        if self.config.get_bool('street_cache', section='otp', def_val=True):
+            cache_dir = self.config.get('street_cache_dir', section='otp', def_val=None) or os.path.join(self.cache_dir, 'street_cache')
+            self.street_cache = StreetGraphCache(
+                cache_dir,
+                max_entries=int(self.config.get('street_cache_max', section='otp', def_val=3)),
+                max_days=int(self.config.get('graph_cache_days', section='otp', def_val=30))
+            )
 
     def config_graph_dirs(self, name, force_update=False, dont_update=False):
         """
@@ -66,7 +97,8 @@ class OtpBuilder(CacheBase):
                 if force_update or not dont_update:
                     # import pdb; pdb.set_trace()
                     OsmCache.check_osm_file_against_cache(dir, force_update, otp_utils.build_with_pbf(g.get('version')))
-                    GtfsCache.check_feeds_against_cache(self.feeds, dir, force_update, filter)
+                    # note: feeds with only metadata changes (feed_info.txt) aren't copied in, so they won't trigger a rebuild
+                    GtfsCache.check_feeds_against_cache(self.feeds, dir, force_update, filter, ChangeSet.affects_graph)
         return graphs
 
     def update_vlog(self, graph):
@@ -75,42 +107,118 @@ class OtpBuilder(CacheBase):
         """
         gtfs_msg = GtfsInfo.get_cache_msgs(graph.get('dir'), self.feeds, graph.get('filter'))
         osm_msg = OsmInfo.get_cache_msgs(graph.get('dir'))
-        otp_utils.append_vlog_file(graph.get('dir'), gtfs_msg + osm_msg)
+        profile_msg = "".join(" {}\n".format(m) for m in graph.pop('profiles', []))
+        otp_utils.append_vlog_file(graph.get('dir'), gtfs_msg + osm_msg + profile_msg)
+
+    def start_profiler(self, graph, kind, attempt=1):
+        """ :return: a running JvmProfiler for the graph's java process(es), or None if profiling is off """
+        ret_val = None
+        if self.profile_interval:
+            ret_val = JvmProfiler(graph, kind, attempt, self.profile_interval, self.gc_dir).start()
+        return ret_val
+
+    def stop_profiler(self, graph, profiler, success):
+        """ write the profile, and keep its summary for the vlog (and a successful build's peak memory for the scheduler) """
+        if profiler:
+            summary = profiler.stop(success)
+            graph.setdefault('profiles', []).append(profiler.get_msg())
+            if success and profiler.kind == 'build' and summary.get('peak_rss_mb'):
+                self.build_history.record(graph.get('name'), peak_mb=summary['peak_rss_mb'])
+
+    def is_graph_stale(self, graph):
+        """ mtime check: is the Graph.obj missing, undersized or older than any of the files it's built from?
+        """
+        ret_val = False
+        if not file_utils.exists_and_sized(graph.get('path'), self.graph_size):
+            ret_val = True
+        elif file_utils.dir_has_newer_files(graph.get('path'), graph.get('dir'), offset_minutes=60, include_filter=".jar,.json,.osm,.pbf,.zip"):
+            ret_val = True
+        return ret_val
+
+    def check_graph_cache(self, graph, key, force_update=False):
+        """
+        content check of the graph's inputs against the graph cache
+        :return: 'current' if the Graph.obj was built from these inputs, 'cached' if a Graph.obj built from the same
+                 inputs was pulled from the cache, else None (needs a build)
+        """
+        ret_val = None
+        if not force_update:
+            if self.graph_cache.is_current(graph, key) and file_utils.exists_and_sized(graph.get('path'), self.graph_size):
+                ret_val = 'current'
+            elif self.graph_cache.get_graph_key(graph) is None and not self.is_graph_stale(graph):
+                # graph built before the cache existed, and it looks up to date ... adopt it
+                self.graph_cache.store(graph, key)
+                ret_val = 'current'
+            elif self.graph_cache.fetch(graph, key):
+                ret_val = 'cached'
+        return ret_val
+
+    def run_graph_builder(self, graph, java_mem=None):
+        """
+        run the OTP graph builder ... OTP 2.x graphs are built in two steps (when the street cache is on), so the street
+        graph can be re-used when only the transit data changed
+        """
+        if self.street_cache and StreetGraphCache.is_two_step(graph):
+            try:
+                if self.street_cache.build(graph, java_mem):
+                    return
+            except Exception as e:
+                log.warning("two step build of {} failed ({}), so doing a full build".format(graph.get('name'), e))
+        otp_utils.run_graph_builder(graph.get('dir'), graph.get('version'), java_mem=java_mem)
 
     def build_graph(self, graph, java_mem=None, force_update=False):
         """
         build the graph...as long as the Graph.obj file looks out of date
+        :return: success, and whether the graph is new (built, or re-used from the graph cache)
         """
         success = True
 
         # step 1: set some params
         rebuild_graph = force_update
-
-        # step 2: check graph file is fairly recent and properly sized
-        if not file_utils.exists_and_sized(graph.get('path'), self.graph_size):
+        key = None
+
+        # step 2: check graph file against the hash of its inputs (or when there's no graph cache, against input mtimes)
+        if self.graph_cache:
+            key = self.graph_cache.get_key(graph)
+            state = self.check_graph_cache(graph, key, force_update)
+            if state == 'current':
+                return True, False
+            elif state == 'cached':
+                return True, True
             rebuild_graph = True
-
-        # step 3: check the cache files
-        if file_utils.dir_has_newer_files(graph.get('path'), graph.get('dir'), offset_minutes=60, include_filter=".jar,.json,.osm,.pbf,.zip"):
+        elif self.is_graph_stale(graph):
             rebuild_graph = True
 
-        # step 4: build graph is needed
+        # step 3: build graph is needed
         if rebuild_graph:
             success = False
+            start = time.time()
 
-            # step 4b: run the builder multiple times until we get a good looking Graph.obj
+            # step 3b: run the builder multiple times until we get a good looking Graph.obj
             for n in range(1, 5):
                 # import pdb; pdb.set_trace()
                 log.info(" build attempt {0} of a new graph ".format(n))
                 file_utils.rm(graph.get('path'))
-                otp_utils.run_graph_builder(graph.get('dir'), graph.get('version'), java_mem=java_mem)
-                time.sleep(10)
-                if file_utils.exists_and_sized(graph.get('path'), self.graph_size, self.expire_days):
+                if self.graph_cache:
+                    self.graph_cache.clear_graph_key(graph)
+                ready = Readiness(graph.get('dir'), timeout=self.build_timeout)
+                profiler = self.start_profiler(graph, 'build', n)
+                self.run_graph_builder(graph, java_mem=profiler.java_args(java_mem) if profiler else java_mem)
+                ready.wait_for_graph(graph.get('path'), self.graph_size)
+                built = file_utils.exists_and_sized(graph.get('path'), self.graph_size, self.expire_days)
+                self.stop_profiler(graph, profiler, built)
+                if built:
                     success = True
+                    if self.graph_cache:
+                        self.graph_cache.store(graph, key)
                     break
                 else:
                     log.warn("\n\nGRAPH DIDN'T BUILD ... WILL TRY TO BUILD AGAIN\n\n")
-                    time.sleep(15)
+
+            # step 3c: how long the builder took (and on how much input), so the scheduler can start the longest builds
+            #          first next time, and scale its heap estimates from this build's peak memory
+            input_mb = round(BuildScheduler.get_input_mb(graph), 1)
+            self.build_history.record(graph.get('name'), secs=round(time.time() - start, 1), input_mb=input_mb)
 
         return success, rebuild_graph
 
@@ -119,57 +227,85 @@ class OtpBuilder(CacheBase):
         will test a given graph against a suite of tests
         """
         success = True
-        delay = 1
+        profiler = None
         if start_server:
-            success = otp_utils.run_otp_server(graph.get('dir'), graph.get('version'), java_mem=java_mem, **graph)
-            delay = 60
+            # wait for the server to answer (vs. a fixed delay), giving up early if it dies or the timeout hits
+            ready = Readiness(graph.get('dir'), timeout=self.server_timeout)
+            profiler = self.start_profiler(graph, 'server')
+            mem = profiler.java_args(java_mem) if profiler else java_mem
+            success = otp_utils.run_otp_server(graph.get('dir'), graph.get('version'), java_mem=mem, **graph)
+            if success:
+                success = ready.wait_for_server(graph.get('port'))
         if success:
-            success = TestRunner.test_graph_factory_config(graph, suite_dir=suite_dir, delay=delay)
+            success = TestRunner.test_graph_factory_config(graph, suite_dir=suite_dir, delay=1)
             if not success:
                 log.warn("graph {} *did not* pass some tests!!!".format(graph.get('name')))
         else:
             log.warn("was unable to start the OTP server using graph {}!!!".format(graph.get('name')))
+        self.stop_profiler(graph, profiler, success)
+        return success
+
+    def build_and_test_graph(self, g, java_mem=None, force_update=False, start_server=True):
+        """
+        will build and test a single graph
+        """
+        # step 2: build this graph
+        success, rebuilt = self.build_graph(g, java_mem, force_update)
+
+        # step 3: test the successfully built new graph (restarting a new OTP server for the graph)
+        if success and rebuilt and not g.get('skip_tests'):
+            success = self.test_graph(graph=g, java_mem=java_mem, start_server=start_server)
+
+        # step 3b: failed to build the graph ... send a warning
+        elif not success:
+            log.warn("graph build failed for graph {}".format(g.get('name')))
+
+        # step 4: so we rebuilt the graph and any testing that was done was also a success...
+        if rebuilt:
+            dir = g.get('dir', './')
+            version = g.get('version', otp_utils.OTP_VERSION)
+
+            # step 4b: update the vlog and package the graph as new
+            if success:
+                self.update_vlog(graph=g)
+                otp_utils.package_new(graph_dir=dir, otp_version=version)
+
+            # step 4c: shut down any graph that
+            if g.get('post_shutdown'):
+                otp_utils.kill_otp_server(dir)
         return success
 
+    def make_scheduler(self):
+        """ scheduler for building graphs in parallel, up to max_parallel_builds at once within memory_budget_mb """
+        budget = self.config.get('memory_budget_mb', section='otp', def_val=None)
+        return BuildScheduler(
+            self.build_history,
+            budget_mb=int(budget) if budget else None,
+            max_parallel=int(self.config.get('max_parallel_builds', section='otp', def_val=1)),
+            heap_per_input_mb=float(self.config.get('heap_per_input_mb', section='otp', def_val=10))
+        )
+
     def build_and_test_graphs(self, java_mem=None, force_update=False, start_server=True, graph_filter=None):
         """
         will build and test each of the graphs we have in self.graphs
+        (in parallel, when [otp] max_parallel_builds > 1 and there's memory for it)
         """
         ret_val = True
         if self.graphs:
-            # step 1: loop thru all graph configs ... building and testing new graphs
+            # step 1: loop thru all graph configs ... scheduling the graphs to build and test
+            scheduler = self.make_scheduler()
             for g in self.graphs:
-                #import pdb; pdb.set_trace()
                 # step 1b: if we're filtering graphs by name, only run that specific graph
                 if graph_filter and g.get('name') != graph_filter: continue
                 elif graph_filter is None and g.get('skip'): continue
+                key = self.graph_cache.get_key(g) if self.graph_cache else None
+                scheduler.add(g, key)
 
-                # step 2: build this graph
-                success, rebuilt = self.build_graph(g, java_mem, force_update)
-
-                # step 3: test the successfully built new graph (restarting a new OTP server for the graph)
-                if success and rebuilt and not g.get('skip_tests'):
-                    success = self.test_graph(graph=g, java_mem=java_mem, start_server=start_server)
-                    ret_val = success
-
-                # step 3b: failed to build the graph ... send a warning
-                elif not success:
+            # step 2: build and test the graphs
+            jobs = scheduler.run(lambda g: self.build_and_test_graph(g, java_mem, force_update, start_server))
+            for j in jobs:
+                if not j.success:
                     ret_val = False
-                    log.warn("graph build failed for graph {}".format(g.get('name')))
-
-                # step 4: so we rebuilt the graph and any testing that was done was also a success...
-                if rebuilt:
-                    dir = g.get('dir', './')
-                    version = g.get('version', otp_utils.OTP_VERSION)
-
-                    # step 4b: update the vlog and package the graph as new
-                    if success:
-                        self.update_vlog(graph=g)
-                        otp_utils.package_new(graph_dir=dir, otp_version=version)
-
-                    # step 4c: shut down any graph that
-                    if g.get('post_shutdown'):
-                        otp_utils.kill_otp_server(dir)
         return ret_val
 
     def only_test_graphs(self, java_mem=None, break_on_fail=False, start_server=True, graph_filter=None):
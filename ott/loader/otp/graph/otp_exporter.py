@@ -1,4 +1,3 @@
-from ott.utils import web_utils
 from ott.utils import file_utils
 from ott.utils import otp_utils
 from ott.utils import object_utils
@@ -6,6 +5,7 @@ from ott.utils import object_utils
 from ott.utils.parse.cmdline import otp_cmdline
 
 from .otp_builder import OtpBuilder
+from ott.loader.deploy.transfer import Transfer
 
 import os
 import datetime
@@ -20,9 +20,53 @@ class OtpExporter(OtpBuilder):
         super(OtpExporter, self).__init__(dont_update=True)
         self.graphs = otp_utils.get_graphs(self)
 
+    def get_graph_files(self, graph, otp_base_dir):
+        """ :return: list of (local path, server path) pairs to send for a graph: Graph.obj-new, otp.v-new and
+                     (optionally) otp.jar-new, plus the graph's OSM, GTFS and JSON (config) files ... or an empty list
+                     if the graph has no Graph.obj-new to deploy.  crazy part of this code is all the path (string)
+                     manipulation below...
+        """
+        ret_val = []
+        graph_dir = otp_utils.config_graph_dir(graph, self.this_module_dir)
+        server_dir = file_utils.append_to_path(otp_base_dir, graph.get('name'))
+
+        # step 1: create file paths to *-new files locally, and also path where we'll scp these files
+        log_v_path = otp_utils.get_vlog_file_path(graph_dir)
+        log_v_new = file_utils.make_new_path(log_v_path)
+        log_v_svr = file_utils.append_to_path(server_dir, os.path.basename(log_v_new), False)
+
+        graph_path = otp_utils.get_graph_path(graph_dir, otp_version=graph.get('version'))
+        graph_new = file_utils.make_new_path(graph_path)
+        graph_svr = file_utils.append_to_path(server_dir, os.path.basename(graph_new), False)
+
+        jar_path = otp_utils.get_otp_path(graph_dir)
+        jar_new = file_utils.make_new_path(jar_path)
+        jar_svr = file_utils.append_to_path(server_dir, os.path.basename(jar_new), False)
+
+        # step 1b: these are the other OTP artifacts, like OSM, GTFS and JSON (config) files
+        osm_paths = otp_utils.get_osm_paths(graph_dir)
+        gtfs_paths = otp_utils.get_gtfs_paths(graph_dir)
+        config_paths = otp_utils.get_config_paths(graph_dir)
+
+        # step 2: only graphs with a Graph.obj-new get deployed
+        #         note: the server paths (e.g., graph_svr, etc...) are relative to the user's home account
+        if file_utils.is_min_sized(graph_new):
+            ret_val = [(graph_new, graph_svr), (log_v_new, log_v_svr)]
+            if file_utils.is_min_sized(jar_new):
+                ret_val.append((jar_new, jar_svr))
+            for paths in (osm_paths, gtfs_paths, config_paths):
+                for p in paths:
+                    ret_val.append((p, file_utils.append_to_path(server_dir, os.path.basename(p), False)))
+        return ret_val
+
     def export_graphs(self, server_filter=None, graph_filter=None):
         """ copy new graphs from build server to configured set of production servers
             (basically scp Graph.obj-new, otp.v-new and otp.jar-new over to another server)
+
+            all the graphs go to all the servers at once (@see Transfer): one ssh / sftp session per server, with the
+            servers loaded in parallel, identical files (e.g., the same OSM .pbf in several graphs) sent to a server
+            just once, an optional per-server bandwidth cap, and every file checksum verified on the server.
+            a graph's -new files are only removed once all of its files are verified on all of the servers
         """
         ret_val = True
 
@@ -35,73 +79,34 @@ class OtpExporter(OtpBuilder):
         user = self.config.get_json('user', section='deploy')
         servers = self.config.get_json('servers', section='deploy')
         otp_base_dir = self.config.get_json('otp_base_dir', section='deploy')
-
-        def scp_graph(server, graph):
-            """ sub-routine to scp Graph.obj-new, otp.v-new and (optionally) otp.jar-new over to
-                a given server.  crazy part of this code is all the path (string) manipulation
-                in step 1 below...
-            """
-            global ret_val
-
-            graph_dir = otp_utils.config_graph_dir(graph, self.this_module_dir)
-            server_dir = file_utils.append_to_path(otp_base_dir, graph.get('name'))
-
-            # step 1: create file paths to *-new files locally, and also path where we'll scp these files
-            log_v_path = otp_utils.get_vlog_file_path(graph_dir)
-            log_v_new = file_utils.make_new_path(log_v_path)
-            log_v_svr = file_utils.append_to_path(server_dir, os.path.basename(log_v_new), False)
-
-            graph_path = otp_utils.get_graph_path(graph_dir, otp_version=graph.get('version'))
-            graph_new = file_utils.make_new_path(graph_path)
-            graph_svr = file_utils.append_to_path(server_dir, os.path.basename(graph_new), False)
-
-            jar_path = otp_utils.get_otp_path(graph_dir)
-            jar_new = file_utils.make_new_path(jar_path)
-            jar_svr = file_utils.append_to_path(server_dir, os.path.basename(jar_new), False)
-
-            # step 1b: these are the other OTP artifacts, like OSM, GTFS and JSON (config) files
-            osm_paths = otp_utils.get_osm_paths(graph_dir)
-            gtfs_paths = otp_utils.get_gtfs_paths(graph_dir)
-            config_paths = otp_utils.get_config_paths(graph_dir)
-
-            # step 2: we are going to attempt to scp Graph.obj-new over to the server(s)
-            #         note: the server paths (e.g., graph_svr, etc...) are relative to the user's home account
-            if file_utils.is_min_sized(graph_new):
-                scp = None
-                try:
-                    log.info("scp {} over to {}@{}:{}".format(graph_new, user, server, graph_svr))
-                    scp, ssh = web_utils.scp_client(host=server, user=user)
-                    scp.put(graph_new, graph_svr)
-                    scp.put(log_v_new, log_v_svr)
-                    if file_utils.is_min_sized(jar_new):
-                        scp.put(jar_new, jar_svr)
-                    for p in osm_paths:
-                        scp.put(p, server_dir)
-                    for p in gtfs_paths:
-                        scp.put(p, server_dir)
-                    for p in config_paths:
-                        scp.put(p, server_dir)
-                except Exception as e:
-                    log.warning(e)
+        workers = int(self.config.get('transfer_workers', section='deploy', def_val=4))
+        delta = self.config.get_bool('delta_transfers', section='deploy', def_val=False)
+        dedupe = self.config.get_bool('dedupe_transfers', section='deploy', def_val=True)
+        bwlimit = float(self.config.get('bandwidth_limit_mbps', section='deploy', def_val=0)) or None
+        base_dir = os.path.join(self.cache_dir, "deployed")
+
+        # step B: gather up the files of each graph to deploy
+        servers = [s for s in servers if not object_utils.is_not_match(server_filter, s)]
+        graphs = [g for g in self.graphs if not object_utils.is_not_match(graph_filter, g.get('name'))]
+        graph_files = [(g, self.get_graph_files(g, otp_base_dir)) for g in graphs]
+
+        # step C: send every graph to every server (always checksum verified, since it decides what rm_new runs on)
+        files = [f for g, gf in graph_files for f in gf]
+        report = None
+        if files and servers:
+            transfer = Transfer(user, servers, max_workers=workers, verify=True, delta=delta, base_dir=base_dir,
+                                dedupe=dedupe, bwlimit_mbps=bwlimit)
+            report = transfer.upload(files)
+
+        # step D: remove the -new files (so we don't keep deploying / scp-ing) ... but only for graphs that made it
+        #         (every file verified) to every server, so a partial upload gets sent again next time
+        for g, gf in graph_files:
+            if gf and servers:
+                failed = [s for s in servers for l, r in gf if s not in report.servers_ok(l)]
+                if failed:
+                    log.warning("graph {} didn't deploy to {}, so keeping its -new files".format(g.get('name'), ", ".join(sorted(set(failed)))))
                     ret_val = False
-                finally:
-                    if scp:
-                        scp.close()
-
-        # step B: loop thru each server, and scp a graph (and log and jar) to that server
-        # import pdb; pdb.set_trace()
-        for s in servers:
-            if object_utils.is_not_match(server_filter, s):
-                continue
-            for g in self.graphs:
-                if object_utils.is_not_match(graph_filter, g.get('name')):
                     continue
-                scp_graph(server=s, graph=g)
-
-        # step C: remove the -new files (so we don't keep deploying / scp-ing)
-        for g in self.graphs:
-            if object_utils.is_not_match(graph_filter, g.get('name')):
-                continue
             otp_utils.rm_new(graph_dir=g.get('dir'), otp_version=g.get('version'))
 
         return ret_val
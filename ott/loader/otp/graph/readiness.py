@@ -0,0 +1,193 @@
+import os
+import re
+import glob
+import time
+from urllib.request import urlopen
+
+import logging
+log = logging.getLogger(__file__)
+
+
+"""
+readiness checks for OTP graph builds & servers, so the builder moves on the moment a graph is written or a server
+answers (and gives up early when the java process dies or logs a fatal error), with a hard timeout in place of the
+old fixed sleeps
+
+each wait polls (every poll_secs):
+  - the *.log files in the graph dir, tailed from where they ended when the wait started
+  - the java process(es) running in the graph dir, or given it (or a file in it) as an arg (read from /proc)
+  - the thing we're waiting on: a Graph.obj whose size has settled and that no process still has open, or a server
+    that answers a cheap router info request
+"""
+
+FATAL_RE = re.compile(r"OutOfMemoryError|Exception in thread \"main\"")
+
+
+class LogTail(object):
+    """ return the lines appended to a set of log files since the tail was started """
+    def __init__(self, log_dir, pattern="*.log"):
+        self.log_dir = log_dir
+        self.pattern = pattern
+        self.offsets = {}
+        for p in self.paths():
+            self.offsets[p] = os.path.getsize(p)
+
+    def paths(self):
+        return glob.glob(os.path.join(self.log_dir, self.pattern)) if self.log_dir else []
+
+    def read(self):
+        ret_val = []
+        for p in self.paths():
+            try:
+                size = os.path.getsize(p)
+                offset = self.offsets.get(p, 0)
+                if size < offset:
+                    offset = 0  # truncated / rotated
+                if size > offset:
+                    with open(p, 'rb') as f:
+                        f.seek(offset)
+                        data = f.read(size - offset)
+                    self.offsets[p] = offset + data.rfind(b'\n') + 1
+                    ret_val.extend(data[:data.rfind(b'\n') + 1].decode('utf-8', 'replace').splitlines())
+            except OSError:
+                pass
+        return ret_val
+
+
+def is_dir_arg(arg, dir):
+    """ True if a command line arg is dir itself (or --opt=dir), or a path inside it ... but not e.g. dir-test """
+    arg = arg.split('=', 1)[1] if arg.startswith('-') and '=' in arg else arg
+    if not arg or arg.startswith('-'):
+        return False
+    arg = os.path.normpath(arg)
+    return arg == dir or arg.startswith(dir + os.sep)
+
+
+def find_java_pids(dir):
+    """ :return: pids of java processes running in (cwd) or given a path (an arg) in dir (e.g., a graph dir) """
+    ret_val = []
+    dir = os.path.normpath(os.path.abspath(dir))
+    for pid in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if pid.isdigit():
+            try:
+                with open(os.path.join('/proc', pid, 'cmdline'), 'rb') as f:
+                    args = f.read().decode('utf-8', 'replace').split('\0')
+                if not args or 'java' not in os.path.basename(args[0]):
+                    continue
+                try:
+                    cwd = os.readlink(os.path.join('/proc', pid, 'cwd'))
+                except OSError:
+                    cwd = None
+                if cwd == dir or any(is_dir_arg(a, dir) for a in args[1:]):
+                    ret_val.append(int(pid))
+            except (OSError, IOError):
+                pass
+    return ret_val
+
+
+def is_file_open(path):
+    """ :return: True if any process (that we can see) still has the file open """
+    path = os.path.abspath(path)
+    for pid in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if pid.isdigit():
+            fd_dir = os.path.join('/proc', pid, 'fd')
+            try:
+                for fd in os.listdir(fd_dir):
+                    if os.readlink(os.path.join(fd_dir, fd)) == path:
+                        return True
+            except (OSError, IOError):
+                pass
+    return False
+
+
+class Readiness(object):
+    def __init__(self, graph_dir, timeout=600, poll_secs=1.0):
+        self.graph_dir = os.path.abspath(graph_dir)
+        self.timeout = timeout
+        self.poll_secs = poll_secs
+        self.logs = LogTail(graph_dir)
+        self.seen_pids = set()
+        self.ignore_pids = set(find_java_pids(self.graph_dir))  # java already running here (e.g., the old OTP server)
+        self.error = None
+
+    def find_pids(self):
+        """ :return: pids of the java processes for this graph dir that started after this wait was set up """
+        return [p for p in find_java_pids(self.graph_dir) if p not in self.ignore_pids]
+
+    def check_logs(self):
+        """ :return: list of the new log lines (and remember the first fatal looking one) """
+        lines = self.logs.read()
+        for l in lines:
+            if self.error is None and FATAL_RE.search(l):
+                self.error = l.strip()
+                log.warning("{}: {}".format(self.graph_dir, self.error))
+        return lines
+
+    def process_died(self):
+        """ True when a java process for this graph dir was running earlier in the wait, and now none are """
+        pids = self.find_pids()
+        died = len(self.seen_pids) > 0 and len(pids) == 0
+        self.seen_pids.update(pids)
+        return died
+
+    def wait(self, is_ready, what):
+        """
+        poll is_ready() until it's True, the process dies / logs a fatal error, or the timeout hits
+        :return: True if ready
+        """
+        start = time.time()
+        while True:
+            self.check_logs()
+            if is_ready():
+                log.info("{} ready after {:.1f} secs".format(what, time.time() - start))
+                return True
+            if self.error:
+                log.warning("{} NOT ready: {}".format(what, self.error))
+                return False
+            if self.process_died():
+                log.warning("{}: the java process exited before it was ready".format(what))
+                return False
+            if time.time() - start > self.timeout:
+                log.warning("{} NOT ready after {} secs".format(what, self.timeout))
+                return False
+            time.sleep(self.poll_secs)
+
+    def wait_for_graph(self, graph_path, min_size=1, builder_done=True):
+        """
+        wait for a Graph.obj to be completely written: it's big enough, its size has stopped changing, and no process
+        has it open
+        :param builder_done: the builder already returned (so once nothing is running, there's no reason to keep waiting)
+        """
+        last = {'size': -1}
+
+        def is_ready():
+            size = os.path.getsize(graph_path) if os.path.exists(graph_path) else -1
+            settled = size >= min_size and size == last['size'] and not is_file_open(graph_path)
+            last['size'] = size
+            return settled
+
+        def is_done():
+            if is_ready():
+                return True
+            if builder_done and not self.find_pids() and last['size'] < min_size:
+                # builder's exited and there's no graph ... no sense waiting on it
+                self.error = self.error or "no graph was written"
+            return False
+
+        return self.wait(is_done, graph_path)
+
+    def wait_for_server(self, port, hostname="localhost", paths=("/otp/routers/default", "/otp")):
+        """ wait for an OTP server to answer a (cheap) router info request """
+        urls = ["http://{}:{}{}".format(hostname, port, p) for p in paths]
+
+        def is_ready():
+            for u in urls:
+                try:
+                    with urlopen(u, timeout=5) as r:
+                        if r.status == 200:
+                            return True
+                except Exception:
+                    pass
+            return False
+
+        return self.wait(is_ready, "OTP server on port {}".format(port))
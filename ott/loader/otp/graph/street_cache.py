@@ -0,0 +1,80 @@
+import os
+import glob
+import subprocess
+
+from ott.loader.otp.graph.graph_cache import GraphCache
+
+import logging
+log = logging.getLogger(__file__)
+
+
+class StreetGraphCache(GraphCache):
+    """
+    OTP 2.x two step builds: the street only graph (streetGraph.obj, from the OSM + elevation data) is cached by a hash
+    of the .jar, the .osm / .pbf / .tif files and build-config.json ... so when only the gtfs changed, the build is just
+    the (much shorter) transit step, run against the cached street graph:
+
+      java -jar otp.jar --buildStreet <graph dir>          # only when there's no cached streetGraph.obj for the key
+      java -jar otp.jar --loadStreet --save <graph dir>    # transit, loaded on top of streetGraph.obj => graph.obj
+    """
+    input_exts = ('.jar', '.osm', '.pbf', '.tif')
+    config_files = ('build-config.json',)
+    street_name = "streetGraph.obj"
+    log_name = "otp_build.log"
+
+    @classmethod
+    def input_files(cls, graph_dir):
+        ret_val = []
+        for f in sorted(os.listdir(graph_dir)):
+            path = os.path.join(graph_dir, f)
+            if os.path.isfile(path) and (f.lower().endswith(cls.input_exts) or f in cls.config_files):
+                ret_val.append(path)
+        return ret_val
+
+    @classmethod
+    def is_two_step(cls, graph):
+        return str(graph.get('version', '')).startswith('2')
+
+    def get_street_graph(self, graph):
+        """ the street graph 'graph' (same dir & version as the graph, but streetGraph.obj as its path) """
+        return {
+            'name': "{} streets".format(graph.get('name')), 'dir': graph.get('dir'), 'version': graph.get('version'),
+            'path': os.path.join(graph.get('dir'), self.street_name)
+        }
+
+    @classmethod
+    def find_jar(cls, graph_dir):
+        jars = sorted(glob.glob(os.path.join(graph_dir, "otp*.jar"))) or sorted(glob.glob(os.path.join(graph_dir, "*.jar")))
+        return jars[0] if jars else None
+
+    def run_otp(self, graph_dir, java_mem, *args):
+        jar = self.find_jar(graph_dir)
+        if jar is None:
+            raise IOError("no otp .jar in {}".format(graph_dir))
+        cmd = ['java'] + (java_mem.split() if java_mem else []) + ['-jar', jar] + list(args) + [graph_dir]
+        log.info(" ".join(cmd))
+        with open(os.path.join(graph_dir, self.log_name), 'a') as f:
+            return subprocess.call(cmd, cwd=graph_dir, stdout=f, stderr=subprocess.STDOUT) == 0
+
+    def build(self, graph, java_mem=None):
+        """
+        build graph.obj against a cached (or newly built & cached) street graph
+        :return: True if the transit step ran ok (the caller still checks the graph.obj)
+        """
+        streets = self.get_street_graph(graph)
+        key = self.get_key(streets)
+
+        # step 1: get the street graph for these osm & build config inputs ... from the cache, or by building it
+        if not self.is_current(streets, key) and not self.fetch(streets, key):
+            log.info("no cached street graph for {}, so building one".format(graph.get('name')))
+            self.clear_graph_key(streets)
+            if os.path.exists(streets.get('path')):
+                os.remove(streets.get('path'))  # might be a hard link into the cache, so don't let java write over it
+            if not self.run_otp(graph.get('dir'), java_mem, '--buildStreet') or not os.path.exists(streets.get('path')):
+                log.warning("street graph build failed for {}".format(graph.get('name')))
+                return False
+            self.store(streets, key)
+
+        # step 2: the transit step, on top of the street graph
+        log.info("building {} transit graph on street graph {}".format(graph.get('name'), key[:12]))
+        return self.run_otp(graph.get('dir'), java_mem, '--loadStreet', '--save')
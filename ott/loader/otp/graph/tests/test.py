@@ -0,0 +1,223 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from ott.loader.otp.graph.graph_cache import GraphCache
+from ott.loader.otp.graph.build_scheduler import BuildScheduler, BuildHistory
+
+
+class TestGraphCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, "graph_cache")
+        self.cache = GraphCache(self.cache_dir, max_entries=2, max_days=30)
+        self.prod = self.make_graph("prod", {"otp.jar": "jar", "TRIMET.gtfs.zip": "gtfs", "or-wa.osm.pbf": "osm"})
+        self.mod = self.make_graph("mod", {"otp.jar": "jar", "TRIMET.gtfs.zip": "gtfs", "or-wa.osm.pbf": "osm"})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_graph(self, name, files, version="1.x"):
+        dir = os.path.join(self.tmp_dir, name)
+        os.makedirs(dir)
+        for f, content in files.items():
+            self.write(os.path.join(dir, f), content)
+        return {'name': name, 'dir': dir, 'path': os.path.join(dir, "Graph.obj"), 'version': version}
+
+    @classmethod
+    def write(cls, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def build(self, graph, content="graph"):
+        """ 'build' a graph, and add it to the cache """
+        self.write(graph['path'], content)
+        key = self.cache.get_key(graph)
+        self.cache.store(graph, key)
+        return key
+
+    def entries(self):
+        return sorted(d for d in os.listdir(self.cache_dir) if os.path.isdir(os.path.join(self.cache_dir, d)))
+
+    def test_key(self):
+        key = self.cache.get_key(self.prod)
+        self.assertEqual(key, self.cache.get_key(self.mod))  # same inputs in another dir
+
+        # not inputs, or the same content re-written ... same key
+        self.write(os.path.join(self.prod['dir'], "otp.v"), "log")
+        self.write(os.path.join(self.prod['dir'], "TRIMET.gtfs.zip"), "gtfs")
+        self.assertEqual(key, self.cache.get_key(self.prod))
+
+        # new content, a new input, or another otp version ... new key
+        self.write(os.path.join(self.prod['dir'], "TRIMET.gtfs.zip"), "gtfs 2")
+        key2 = self.cache.get_key(self.prod)
+        self.assertNotEqual(key, key2)
+        self.write(os.path.join(self.prod['dir'], "router-config.json"), "{}")
+        key3 = self.cache.get_key(self.prod)
+        self.assertNotIn(key3, (key, key2))
+        self.prod['version'] = "2.x"
+        self.assertNotIn(self.cache.get_key(self.prod), (key, key2, key3))
+
+    def test_fetch(self):
+        self.assertFalse(self.cache.fetch(self.mod, self.cache.get_key(self.mod)))
+        key = self.build(self.prod)
+        self.assertTrue(self.cache.is_current(self.prod, key))
+
+        self.assertTrue(self.cache.fetch(self.mod, key))
+        self.assertTrue(self.cache.is_current(self.mod, key))
+        with open(self.mod['path']) as f:
+            self.assertEqual(f.read(), "graph")
+
+        self.write(os.path.join(self.mod['dir'], "TRIMET.gtfs.zip"), "gtfs 2")
+        self.assertFalse(self.cache.is_current(self.mod, self.cache.get_key(self.mod)))
+
+    def test_prune_keeps_entries_in_use(self):
+        keys = []
+        for i in range(4):
+            self.write(os.path.join(self.prod['dir'], "TRIMET.gtfs.zip"), "gtfs {}".format(i))
+            keys.append(self.build(self.prod, "graph {}".format(i)))
+
+        # this run's entries are all still in use (over max_entries), so all of them are kept
+        self.assertEqual(self.entries(), sorted(keys))
+        for i, k in enumerate(keys):
+            t = time.time() - (len(keys) - i) * 60
+            os.utime(os.path.join(self.cache_dir, k), (t, t))
+
+        # the next run only uses the last one, so prune keeps it and the newest other entry
+        cache = GraphCache(self.cache_dir, max_entries=2, max_days=30)
+        self.assertTrue(cache.fetch(self.mod, keys[-1]))
+        cache.prune()
+        self.assertEqual(self.entries(), sorted(keys[-2:]))
+
+    def test_prune_keeps_fetched_entry(self):
+        key = self.build(self.prod)
+
+        # an old entry that gets fetched is used again, so it's not too old anymore
+        old = time.time() - 60 * 86400
+        os.utime(os.path.join(self.cache_dir, key), (old, old))
+        cache = GraphCache(self.cache_dir, max_entries=1, max_days=30)
+        self.assertTrue(cache.fetch(self.mod, key))
+        os.utime(os.path.join(self.cache_dir, key), (old, old))
+
+        # and storing another graph (over max_entries) doesn't prune it either
+        self.write(os.path.join(self.prod['dir'], "TRIMET.gtfs.zip"), "gtfs 2")
+        self.write(self.prod['path'], "graph 2")
+        key2 = cache.get_key(self.prod)
+        cache.store(self.prod, key2)
+        self.assertEqual(self.entries(), sorted([key, key2]))
+        self.assertTrue(GraphCache(self.cache_dir).fetch(self.mod, key))
+
+    def test_prune_old(self):
+        key = self.build(self.prod)
+        old = time.time() - 60 * 86400
+        os.utime(os.path.join(self.cache_dir, key), (old, old))
+        GraphCache(self.cache_dir, max_entries=2, max_days=30).prune()
+        self.assertEqual(self.entries(), [])
+
+
+class TestBuildScheduler(unittest.TestCase):
+    """ graphs with 1 MB of input (a 110 MB heap estimate, without history), run by a fake builder """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.history = BuildHistory(os.path.join(self.tmp_dir, "history.json"))
+        self.lock = threading.Lock()
+        self.started = []
+        self.running = 0
+        self.max_running = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_graph(self, name, input_mb=1):
+        dir = os.path.join(self.tmp_dir, name)
+        os.makedirs(dir)
+        with open(os.path.join(dir, "TRIMET.gtfs.zip"), 'wb') as f:
+            f.write(b"x" * int(input_mb * 1048576))
+        with open(os.path.join(dir, "router-config.json"), 'w') as f:
+            f.write("{}")
+        return {'name': name, 'dir': dir}
+
+    def make_scheduler(self, budget_mb=1000, max_parallel=4):
+        return BuildScheduler(self.history, budget_mb=budget_mb, max_parallel=max_parallel, base_heap_mb=100,
+                              heap_per_input_mb=10, margin=1.0)
+
+    def build(self, graph):
+        with self.lock:
+            self.started.append(graph['name'])
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        return graph['name'] != 'bad'
+
+    def test_estimate_heap(self):
+        s = self.make_scheduler()
+        self.assertEqual(BuildScheduler.get_input_mb(self.make_graph("prod", 2)), 2.0)
+        self.assertEqual(s.estimate_heap({'name': 'prod'}, 2.0), 120)
+
+        # scaled from the graph's past peak memory (but never below it)
+        self.history.record('prod', peak_mb=500, input_mb=2.0)
+        self.assertEqual(s.estimate_heap({'name': 'prod'}, 4.0), 1000)
+        self.assertEqual(s.estimate_heap({'name': 'prod'}, 1.0), 500)
+
+    def test_order(self):
+        """ longest running graphs (per history) first, then config order """
+        self.history.record('b', secs=100)
+        self.history.record('c', secs=10)
+        s = self.make_scheduler(max_parallel=1)
+        for n in ('a', 'b', 'c', 'd'):
+            s.add(self.make_graph(n))
+        s.run(self.build)
+        self.assertEqual(self.started, ['b', 'c', 'a', 'd'])
+
+    def test_budget(self):
+        s = self.make_scheduler(budget_mb=250)
+        for n in ('a', 'b', 'c', 'd'):
+            s.add(self.make_graph(n))
+        jobs = s.run(self.build)
+        self.assertEqual(self.max_running, 2)
+        self.assertTrue(all(j.success for j in jobs))
+
+        # a graph bigger than the budget still runs, on its own
+        self.started, self.max_running = [], 0
+        s = self.make_scheduler(budget_mb=50)
+        for n in ('e', 'f'):
+            s.add(self.make_graph(n))
+        s.run(self.build)
+        self.assertEqual((sorted(self.started), self.max_running), (['e', 'f'], 1))
+
+    def test_same_key(self):
+        """ graphs with the same cache key never build at once """
+        s = self.make_scheduler()
+        s.add(self.make_graph("a"), key="k1")
+        s.add(self.make_graph("b"), key="k1")
+        s.run(self.build)
+        self.assertEqual(self.max_running, 1)
+
+    def test_history(self):
+        """ run() only records success ... secs & input_mb come from the builder, when it actually built """
+        s = self.make_scheduler()
+        s.add(self.make_graph("ok"))
+        s.add(self.make_graph("bad"))
+        s.run(self.build)
+        self.assertEqual(BuildHistory(self.history.path).history, {'ok': {'success': True}, 'bad': {'success': False}})
+
+    def test_critical_path(self):
+        s = self.make_scheduler(max_parallel=1)
+        for n in ('a', 'b', 'c'):
+            s.add(self.make_graph(n))
+        for j in s.jobs:
+            j.queued -= 10  # every job waits (on the one that finished before it)
+        s.run(self.build)
+        self.assertEqual([j.name for j in s.critical_path()], ['a', 'b', 'c'])
+
+        # nothing waited ... the path is just the last graph to finish
+        s = self.make_scheduler()
+        a = s.add(self.make_graph("x"))
+        s.run(self.build)
+        self.assertEqual(s.critical_path(), [a])
+        self.assertEqual(self.make_scheduler().critical_path(), [])
@@ -383,10 +383,10 @@ class TestSuite(object):
             if run_test:
                 for i in range(1, num_tries):
                     t.call_otp()
-                    time.sleep(1)
                     if t.itinerary and len(t.itinerary) > MIN_SIZE_ITIN:
                         break
-                    time.sleep(i)
+                    if i < num_tries - 1:
+                        time.sleep(i)
             else:
                 t.result = TestResult.PASS
 
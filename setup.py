@@ -14,6 +14,9 @@ requires = [
     'ott.osm',
     'ott.utils',
     'psycopg2',
+    'numpy',
+    'requests',
+    'gtfs-realtime-bindings',
     'mako',
     'scp',
     'paramiko',
@@ -69,11 +72,13 @@ setup(
         gtfsdb_load = ott.loader.gtfsdb.gtfsdb_loader:GtfsdbLoader.load
         gtfsdb_current_load = ott.loader.gtfsdb.gtfsdb_loader:GtfsdbLoader.current_load
         gtfsdb_restore = ott.loader.gtfsdb.gtfsdb_loader:GtfsdbLoader.restore
+        gtfsdb_rollback = ott.loader.gtfsdb.gtfsdb_loader:GtfsdbLoader.rollback
         gtfsdb_dump = ott.loader.gtfsdb.gtfsdb_exporter:GtfsdbExporter.dump
-        gtfsdb_scp = ott.loader.gtfsdb.gtfsdb_exporter:GtfsdbExporter.scp
+        gtfsdb_scp = ott.loader.gtfsdb.gtfsdb_exporter:GtfsdbExporter.scp_cmd
         gtfsdb_dump_scp = ott.loader.gtfsdb.gtfsdb_exporter:GtfsdbExporter.dump_and_scp
 
         gtfsrt_load = ott.loader.gtfsdb_realtime.gtfsdb_realtime_loader:GtfsdbRealtimeLoader.load
+        gtfsrt_serve = ott.loader.gtfsdb_realtime.gtfsdb_realtime_loader:GtfsdbRealtimeLoader.serve
 
         otp_restart_new_graphs = ott.loader.otp.graph.otp_runner:OtpRunner.restart_new_graphs
         otp_run = ott.loader.otp.graph.otp_runner:OtpRunner.run